@@ -14,12 +14,15 @@ try:
     from scipy import optimize
 except ImportError:
     print("scipy not installed: UCHIIfitter may fail")
-from pyspeckit import mpfit
+from pyspeckit.mpfit import mpfit
 from astropy import units as u
 from astropy import constants
+from astropy.table import Table
 import radio_beam
 from dust_emissivity import dust
 
+from batch_lm import batch_levmar
+
 #kb = 1.38e-16
 #c=3e10
 #mu = 1.4
@@ -100,7 +103,8 @@ def inufit(nu, em, normfac, Te=8500, unit='mJy', frequnit='GHz'):
     _nu = nu*freqfactor[frequnit]
     I0 = 2 * constants.k_B * Te * _nu[0]**2 / constants.c**2
     model_intensity = Inu(_nu,tnu(Te,_nu/1e9,em),Te,I0=I0)  # tnu takes GHz
-    model_norm = normfac * model_intensity / unitfactor[unit]
+    # plain numbers (SI intensity), so the model can be subtracted from fluxes
+    model_norm = normfac * model_intensity.si.value / unitfactor[unit]
     return model_norm
 
 
@@ -177,7 +181,7 @@ class HIIregion(object):
 
     def __init__(self, nu, flux, fluxerr, fluxunit='mJy', frequnit='GHz',
                  beamsize_as2=0.25, dist_kpc=1.0, resolved=False, Te=8500,
-                 **kwargs):
+                 fit=True, **kwargs):
         order = np.argsort(np.asarray(nu))
         self.nu           = np.asarray(nu)[order]
         self.flux         = np.asarray(flux)[order]
@@ -188,11 +192,12 @@ class HIIregion(object):
         self.dist_kpc = dist_kpc
         self.resolved = resolved
         self.Te = Te
-        self.em, self.nutau, self.normfac, self.chi2 = emtau(self.nu,
-                                                             self.flux,
-                                                             self.fluxerr,
-                                                             Te=self.Te,
-                                                             **kwargs)
+        if fit:
+            self.em, self.nutau, self.normfac, self.chi2 = emtau(self.nu,
+                                                                 self.flux,
+                                                                 self.fluxerr,
+                                                                 Te=self.Te,
+                                                                 **kwargs)
 
     def refit(self,**kwargs):
         """ refit, presumably using different inputs to emtau """
@@ -305,4 +310,214 @@ def qlyc_of_tb(TB, Te=default_te, nu=default_freq, radius=1*u.pc):
             (Te/(1e4*u.K))**1.35 * (nu/u.GHz)**2.1 * np.log(1-TB/Te) * u.cm**-6 *
             u.pc).to(u.s**-1)
 
-__all__ = [tnu,Inu,unitfactor,freqfactor,inufit,emtau,mpfitfun,HIIregion]
+
+def _pad_seds(freq, flux, err):
+    """
+    Stack per-source SEDs (lists of possibly different lengths, or 2D arrays)
+    into [nsrc, nfreq] arrays with NaN padding
+    """
+    if isinstance(flux, np.ndarray) and flux.ndim == 2:
+        flux = flux.astype('float')
+        freq = np.broadcast_to(np.asarray(freq, dtype='float'), flux.shape)
+        err = (np.ones_like(flux) if err is None else
+               np.broadcast_to(np.asarray(err, dtype='float'), flux.shape))
+        return np.array(freq), np.array(flux), np.array(err)
+
+    nsrc = len(flux)
+    nfreq = max(len(ff) for ff in flux)
+    arrays = [np.full([nsrc, nfreq], np.nan) for ii in range(3)]
+    if err is None:
+        err = [np.ones(len(ff)) for ff in flux]
+    if not hasattr(freq[0], '__len__'):
+        freq = [freq]*nsrc
+    for ii in range(nsrc):
+        for arr, values in zip(arrays, (freq[ii], flux[ii], err[ii])):
+            arr[ii, :len(values)] = values
+    return arrays
+
+def _freefree_shape(nu, logem, Te, unit='mJy'):
+    """
+    inufit's free-free spectrum for unit normalization and its derivative with
+    respect to log10(EM); nu in GHz.  The Rayleigh-Jeans intensity is in the
+    (SI) units inufit computes it in and is divided by the same
+    ``unitfactor[unit]``, so ``normfac`` means the same as in `inufit` and
+    `emtau`.
+    """
+    tau = tnu(Te, nu, 10**logem)
+    bnu = (2 * constants.k_B.value * Te * (nu*1e9)**2 / constants.c.value**2 /
+           unitfactor[unit])
+    thin = tau < 1
+    shape = np.where(thin, tau*np.exp(1-tau), 1.0) * bnu
+    dshape = (np.where(thin, (1-tau)*np.exp(1-tau), 0.0) * bnu *
+              tau * np.log(10))
+    return shape, dshape
+
+def _batch_sed_model(Te, dust=False, unit='mJy'):
+    """
+    Model function for `batch_lm.batch_levmar`; the parameters are
+    [log10(EM), normfac] (+ [alpha, normfac2] with a power-law dust term)
+    """
+    def model(params, nu):
+        shape, dshape = _freefree_shape(nu, params[:,0,None], Te, unit=unit)
+        normfac = params[:,1,None]
+        result = normfac * shape
+        jac = np.empty(nu.shape + (params.shape[1],))
+        jac[:,:,0] = normfac * dshape
+        jac[:,:,1] = shape
+        if dust:
+            alpha, normfac2 = params[:,2,None], params[:,3,None]
+            powerlaw = nu**alpha
+            result = result + normfac2 * powerlaw
+            jac[:,:,2] = normfac2 * powerlaw * np.log(nu)
+            jac[:,:,3] = powerlaw
+        return result, jac
+    return model
+
+def _linear_chi2(basis, flux, weights):
+    """
+    Weighted least-squares amplitudes of the basis functions ([..., nfreq,
+    nbasis]) and the resulting chi^2; negative amplitudes get chi^2 = inf
+    """
+    wb = basis * weights[..., None]
+    alpha = np.einsum('...mp,...mq->...pq', wb, basis)
+    beta = np.einsum('...mp,...m->...p', wb, flux)
+    nb = basis.shape[-1]
+    alpha = alpha + np.eye(nb) * 1e-12 * alpha.max(axis=(-1,-2))[..., None, None]
+    amps = np.linalg.solve(alpha, beta[..., None])[..., 0]
+    model = np.einsum('...mp,...p->...m', basis, amps)
+    chi2 = (weights * (flux - model)**2).sum(axis=-1)
+    chi2[np.any(amps < 0, axis=-1)] = np.inf
+    return amps, chi2
+
+def emtau_batch(freq, flux, err=None, Te=8500, dust=False, unit='mJy',
+                logem_grid=np.linspace(3, 11, 161),
+                alpha_grid=np.linspace(1, 4, 31), refine=True, maxiter=100):
+    """
+    Fit the free-free (optionally + power-law dust) SEDs of many sources at
+    once.
+
+    The normalizations are linear, so for each source every EM on
+    ``logem_grid`` (and dust index on ``alpha_grid``) is tried with the
+    normalizations solved in closed form; the best grid point is then refined
+    with a batched Levenberg-Marquardt fit of all parameters.
+
+    Parameters
+    ----------
+    freq : array
+        Frequencies in GHz: one array shared by all sources, or one per source
+    flux : array
+        [nsrc, nfreq] array of fluxes (in ``unit``), or a list of per-source
+        arrays; NaNs are ignored
+    err : array
+        Flux errors with the same layout as ``flux``
+    Te : float
+        Electron temperature (K), shared by all sources
+    dust : bool
+        Add a ``normfac2 * nu**alpha`` dust term (as in `inufit_dust`, with nu
+        in GHz)
+
+    Returns
+    -------
+    result : `~astropy.table.Table`
+        EM, nu(tau=1), normfac (and alpha, normfac2), their errors, and chi^2
+        for each source, in the input order
+    """
+    freq, flux, err = _pad_seds(freq, flux, err)
+    good = np.isfinite(freq) & np.isfinite(flux) & np.isfinite(err) & (err > 0)
+    weights = np.where(good, 1/np.where(good, err, 1)**2, 0)
+    nu = np.where(good, freq, 1.0)
+    data = np.where(good, flux, 0)
+
+    # grid search: [nsrc, ngrid, nfreq] free-free shapes
+    shapes = _freefree_shape(nu[:,None,:], logem_grid[None,:,None], Te,
+                             unit=unit)[0]
+    if dust:
+        powerlaws = nu[:,None,:]**alpha_grid[None,:,None]
+        basis = np.stack(np.broadcast_arrays(shapes[:,:,None,:],
+                                             powerlaws[:,None,:,:]), axis=-1)
+        amps, chi2 = _linear_chi2(basis, data[:,None,None,:],
+                                  weights[:,None,None,:])
+        best = np.argmin(chi2.reshape(len(data), -1), axis=1)
+        iem, ialpha = np.unravel_index(best, chi2.shape[1:])
+        rows = np.arange(len(data))
+        params0 = np.array([logem_grid[iem], amps[rows,iem,ialpha,0],
+                            alpha_grid[ialpha], amps[rows,iem,ialpha,1]]).T
+        lower = [logem_grid.min(), 0, -np.inf, 0]
+        upper = [logem_grid.max(), np.inf, np.inf, np.inf]
+    else:
+        amps, chi2 = _linear_chi2(shapes[...,None], data[:,None,:],
+                                  weights[:,None,:])
+        iem = np.argmin(chi2, axis=1)
+        rows = np.arange(len(data))
+        params0 = np.array([logem_grid[iem], amps[rows,iem,0]]).T
+        lower = [logem_grid.min(), 0]
+        upper = [logem_grid.max(), np.inf]
+
+    if refine:
+        params, perrors, chi2, niter = batch_levmar(_batch_sed_model(Te,
+                                                                     dust=dust,
+                                                                     unit=unit),
+                                                    params0, nu, data, weights,
+                                                    lower=lower, upper=upper,
+                                                    maxiter=maxiter)
+    else:
+        params = params0
+        model = _batch_sed_model(Te, dust=dust, unit=unit)(params, nu)[0]
+        chi2 = (weights*(data-model)**2).sum(axis=1)
+        perrors = np.full_like(params, np.nan)
+
+    bestEM = 10**params[:,0]
+    result = Table()
+    result['EM'] = bestEM
+    result['eEM'] = bestEM * np.log(10) * perrors[:,0]
+    result['nu_tau'] = (Te**1.35 / bestEM / 8.235e-2)**(-1/2.1)
+    result['normfac'] = params[:,1]
+    result['enormfac'] = perrors[:,1]
+    if dust:
+        result['alpha'] = params[:,2]
+        result['ealpha'] = perrors[:,2]
+        result['normfac2'] = params[:,3]
+        result['enormfac2'] = perrors[:,3]
+    result['chi2'] = chi2
+    result['ndata'] = good.sum(axis=1)
+    return result
+
+def emtau_bootstrap(freq, flux, err, nboot=100, seed=0, **kwargs):
+    """
+    Bootstrap the `emtau_batch` fit of many sources: each source's fluxes are
+    perturbed by their errors ``nboot`` times, and all of the realizations are
+    fitted in one batch.
+
+    Returns
+    -------
+    fits : `~astropy.table.Table`
+        The realizations' fits, with a ``source`` column
+    """
+    freq, flux, err = _pad_seds(freq, flux, err)
+    rng = np.random.RandomState(seed)
+    nsrc = len(flux)
+    noise = rng.randn(nboot, *flux.shape)
+    realizations = (flux[None] + noise*err[None]).reshape(nboot*nsrc, -1)
+    fits = emtau_batch(np.tile(freq, (nboot, 1)), realizations,
+                       np.tile(err, (nboot, 1)), **kwargs)
+    fits['source'] = np.tile(np.arange(nsrc), nboot)
+    return fits
+
+def fit_HII_regions(regions, **kwargs):
+    """
+    Fit the SEDs of many `HIIregion` objects (created with ``fit=False``) in
+    one `emtau_batch` call; all regions must share Te and the flux unit
+    """
+    Te = regions[0].Te
+    unit = regions[0].fluxunit
+    freq = [reg.nu * freqfactor[reg.frequnit] / 1e9 for reg in regions]
+    result = emtau_batch(freq, [reg.flux for reg in regions],
+                         [reg.fluxerr for reg in regions], Te=Te, unit=unit,
+                         **kwargs)
+    for reg, row in zip(regions, result):
+        reg.em, reg.nutau, reg.normfac, reg.chi2 = (row['EM'], row['nu_tau'],
+                                                    row['normfac'], row['chi2'])
+    return result
+
+__all__ = [tnu,Inu,unitfactor,freqfactor,inufit,emtau,mpfitfun,HIIregion,
+           emtau_batch,emtau_bootstrap,fit_HII_regions]
@@ -0,0 +1,157 @@
+"""
+Fit a single Gaussian (plus a constant baseline; pyspeckit's
+``vheightgaussian``) to every (spectrum, catalog line) window at once.
+
+The velocity window of each line in each spectrum is found from the
+spectrum's frequency axis with `np.searchsorted`, the windows are copied into
+fixed-size padded arrays, and all of them are fitted together with
+`batch_lm.batch_levmar`.
+"""
+import numpy as np
+from astropy import constants
+
+from batch_lm import batch_levmar
+
+ckms = constants.c.to('km/s').value
+
+
+def line_windows(frequencies, line_frequencies, vcen, halfwidth=15.):
+    """
+    Channel windows of each line in one spectrum.
+
+    Parameters
+    ----------
+    frequencies : np.ndarray
+        The spectrum's frequency axis (any monotonic order; GHz)
+    line_frequencies : np.ndarray
+        Rest frequencies of the lines (GHz)
+    vcen : float
+        Source velocity (km/s)
+    halfwidth : float
+        Half-width of the window (km/s)
+
+    Returns
+    -------
+    start, stop : np.ndarray
+        Channel ranges (indices into ``frequencies`` sorted in increasing
+        order) of each line; empty ranges are out of the band
+    order : np.ndarray
+        The argsort of ``frequencies``
+    """
+    order = np.argsort(frequencies)
+    sfreq = frequencies[order]
+    # radio convention: v = c (nu0 - nu) / nu0
+    fhi = line_frequencies * (1 - (vcen-halfwidth)/ckms)
+    flo = line_frequencies * (1 - (vcen+halfwidth)/ckms)
+    start = np.searchsorted(sfreq, flo, side='left')
+    stop = np.searchsorted(sfreq, fhi, side='right')
+    return start, stop, order
+
+
+def vheight_gaussian(params, velo):
+    """
+    Model and analytic Jacobian of height + amp * exp(-(v-v0)^2/(2 w^2))
+    """
+    height, amp, center, width = [params[:,ii,None] for ii in range(4)]
+    width = np.where(width == 0, 1e-10, width)
+    dv = velo - center
+    gauss = np.exp(-dv**2/(2*width**2))
+    model = height + amp*gauss
+    jac = np.empty(velo.shape + (4,))
+    jac[:,:,0] = 1
+    jac[:,:,1] = gauss
+    jac[:,:,2] = amp*gauss*dv/width**2
+    jac[:,:,3] = amp*gauss*dv**2/width**3
+    return model, jac
+
+
+def fit_windows(spectra, errors, line_frequencies, vcen, halfwidth=15.,
+                guesses=None, limits=None, maxiter=200):
+    """
+    Fit every line window of every spectrum at once.
+
+    Parameters
+    ----------
+    spectra : list
+        (frequency [GHz], data) array pairs, e.g. the four spws of each core
+    errors : list
+        Per-spectrum scalar error estimates
+    line_frequencies : np.ndarray
+        Rest frequencies of the catalog lines (GHz)
+    vcen : float or list
+        Source velocity for each spectrum (km/s)
+    guesses : list
+        [height, amplitude, center, width] guess; the center guess is the
+        source velocity if None
+    limits : list
+        (lower, upper) for each parameter; the center limit is +/-2.5 km/s
+        around the source velocity if None
+
+    Returns
+    -------
+    result : dict
+        ``spectrum`` and ``line`` indices of each fitted window and the
+        ``params``, ``errors``, ``chi2``, ``velo``, ``data`` and
+        ``weights`` arrays (padded windows) of the fits
+    """
+    line_frequencies = np.asarray(line_frequencies, dtype='float')
+    vcens = np.broadcast_to(vcen, len(spectra))
+
+    windows = []
+    for ii, (frequencies, data) in enumerate(spectra):
+        start, stop, order = line_windows(np.asarray(frequencies),
+                                          line_frequencies, vcens[ii],
+                                          halfwidth=halfwidth)
+        for jj in np.flatnonzero(stop > start):
+            chans = order[start[jj]:stop[jj]]
+            if np.any(np.isfinite(data[chans])):
+                windows.append((ii, jj, chans))
+
+    nfits = len(windows)
+    if nfits == 0:
+        return None
+    npad = max(len(chans) for ii, jj, chans in windows)
+
+    velo = np.zeros([nfits, npad])
+    data = np.zeros([nfits, npad])
+    weights = np.zeros([nfits, npad])
+    centers = np.zeros(nfits)
+    for kk, (ii, jj, chans) in enumerate(windows):
+        frequencies, spdata = spectra[ii]
+        nn = len(chans)
+        vv = ckms*(1-np.asarray(frequencies)[chans]/line_frequencies[jj])
+        dd = np.asarray(spdata)[chans]
+        good = np.isfinite(dd)
+        velo[kk,:nn] = vv
+        # padding repeats the last velocity so the model stays finite
+        velo[kk,nn:] = vv[-1]
+        data[kk,:nn] = np.where(good, dd, 0)
+        weights[kk,:nn] = good / errors[ii]**2
+        centers[kk] = vcens[ii]
+
+    if guesses is None:
+        guesses = [0.0, 0.1, None, 2]
+    if limits is None:
+        limits = [(-0.1,0.1), (-5,5), None, (0,5)]
+
+    params0 = np.array([[gg if gg is not None else cc for gg in guesses]
+                        for cc in centers], dtype='float')
+    lower = np.array([[lim[0] if lim is not None else cc-2.5 for lim in limits]
+                      for cc in centers], dtype='float')
+    upper = np.array([[lim[1] if lim is not None else cc+2.5 for lim in limits]
+                      for cc in centers], dtype='float')
+
+    params, perrors, chi2, niter = batch_levmar(vheight_gaussian, params0,
+                                                velo, data, weights,
+                                                lower=lower, upper=upper,
+                                                maxiter=maxiter)
+
+    return {'spectrum': np.array([ii for ii, jj, chans in windows]),
+            'line': np.array([jj for ii, jj, chans in windows]),
+            'params': params,
+            'errors': perrors,
+            'chi2': chi2,
+            'velo': velo,
+            'data': data,
+            'weights': weights,
+           }
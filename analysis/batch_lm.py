@@ -0,0 +1,156 @@
+"""
+Vectorized Levenberg-Marquardt for many small, independent fits.
+
+All fits share the number of parameters and are laid out as fixed-size
+padded arrays: data points that are padding get zero weight.  Each iteration
+solves every fit's normal equations at once with a batched
+`np.linalg.solve`, so fitting thousands of spectra costs a few hundred array
+operations rather than thousands of separate `mpfit` calls.
+
+`write_fit` stores parameter maps from such fits in the layout of
+``pyspeckit.Cube.write_fit``, so ``pyspeckit.Cube.load_model_fit`` reads
+them.
+"""
+import numpy as np
+from astropy.io import fits
+
+
+def batch_levmar(func, params, xdata, data, weights, lower=None, upper=None,
+                 maxiter=200, lam0=1e-3, ftol=1e-10):
+    """
+    Fit ``nfits`` independent models with bounded Levenberg-Marquardt.
+
+    Parameters
+    ----------
+    func : function
+        ``func(params, xdata) -> (model, jacobian)`` with ``params``
+        [nfits, npars], ``xdata`` [nfits, ...], ``model`` [nfits, ndata] and
+        ``jacobian`` [nfits, ndata, npars].  It is called on subsets of the
+        fits, so ``xdata`` must be indexable along its first axis.
+    params : np.ndarray
+        [nfits, npars] initial guesses
+    xdata : np.ndarray
+        Independent variable(s), first axis nfits
+    data : np.ndarray
+        [nfits, ndata] data (finite everywhere; padding can hold anything
+        finite)
+    weights : np.ndarray
+        [nfits, ndata] inverse variances; 0 for padded or bad data
+    lower, upper : np.ndarray, optional
+        [npars] or [nfits, npars] parameter limits.  Steps are clipped to the
+        limits.
+
+    Returns
+    -------
+    params : np.ndarray
+        [nfits, npars] best-fit parameters
+    errors : np.ndarray
+        [nfits, npars] 1-sigma errors from the diagonal of the covariance
+        matrix (not rescaled by the reduced chi^2, as in mpfit)
+    chi2 : np.ndarray
+        [nfits] chi^2 of the best fit
+    niter : np.ndarray
+        [nfits] number of iterations used
+    """
+    params = np.array(params, dtype='float')
+    nfits, npars = params.shape
+    data = np.asarray(data, dtype='float')
+    weights = np.asarray(weights, dtype='float')
+
+    if lower is None:
+        lower = np.full(npars, -np.inf)
+    if upper is None:
+        upper = np.full(npars, np.inf)
+    lower = np.broadcast_to(lower, params.shape)
+    upper = np.broadcast_to(upper, params.shape)
+    params = np.clip(params, lower, upper)
+
+    eye = np.eye(npars)
+
+    def normal_equations(jac, resid, wts):
+        jtw = jac * wts[:,:,None]
+        alpha = np.einsum('nmp,nmq->npq', jtw, jac)
+        beta = np.einsum('nmp,nm->np', jtw, resid)
+        return alpha, beta
+
+    model, jac = func(params, xdata)
+    resid = data - model
+    chi2 = (weights*resid**2).sum(axis=1)
+    alpha, beta = normal_equations(jac, resid, weights)
+
+    lam = np.full(nfits, lam0)
+    niter = np.zeros(nfits, dtype='int')
+    active = np.ones(nfits, dtype='bool')
+
+    for it in range(maxiter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        niter[idx] += 1
+
+        diag = alpha[idx][:, np.arange(npars), np.arange(npars)]
+        # keep the damped matrix invertible for parameters that do not
+        # affect the model (e.g., padding-only fits)
+        damp = lam[idx,None]*diag + 1e-12*(diag.max(axis=1, keepdims=True)+1e-300)
+        step = np.linalg.solve(alpha[idx] + damp[:,:,None]*eye,
+                               beta[idx][:,:,None])[:,:,0]
+        trial = np.clip(params[idx] + step, lower[idx], upper[idx])
+
+        tmodel, tjac = func(trial, xdata[idx])
+        tresid = data[idx] - tmodel
+        tchi2 = (weights[idx]*tresid**2).sum(axis=1)
+
+        better = tchi2 <= chi2[idx]
+        bidx = idx[better]
+        improvement = chi2[bidx] - tchi2[better]
+
+        params[bidx] = trial[better]
+        resid[bidx] = tresid[better]
+        talpha, tbeta = normal_equations(tjac[better], tresid[better],
+                                         weights[bidx])
+        alpha[bidx] = talpha
+        beta[bidx] = tbeta
+        chi2[bidx] = tchi2[better]
+
+        lam[idx] = np.where(better, lam[idx]/10., lam[idx]*10.)
+
+        converged = np.zeros(nfits, dtype='bool')
+        converged[bidx] = improvement <= ftol*np.maximum(chi2[bidx], 1e-300)
+        converged[lam > 1e12] = True
+        active &= ~converged
+
+    covariance = np.linalg.pinv(alpha)
+    errors = np.abs(covariance[:, np.arange(npars), np.arange(npars)])**0.5
+
+    return params, errors, chi2, niter
+
+
+def write_fit(filename, parcube, errcube, header, parnames, fittype,
+              overwrite=True):
+    """
+    Write parameter and error cubes in ``pyspeckit.Cube.write_fit``'s layout
+
+    Parameters
+    ----------
+    parcube, errcube : np.ndarray
+        [npars, ny, nx] fitted parameters and their errors
+    header : `~astropy.io.fits.Header`
+        Header with the celestial WCS of the maps
+    parnames : list
+        The parameter names (``PLNAMEi`` keywords; errors get an 'e' prefix)
+    fittype : str
+        The pyspeckit model name (``FITTYPE``)
+    """
+    hdu = fits.PrimaryHDU(data=np.concatenate([parcube, errcube]),
+                          header=header.copy())
+    hdu.header['FITTYPE'] = fittype
+    for ii, parname in enumerate(parnames):
+        hdu.header['PLNAME{0}'.format(ii)] = parname
+        hdu.header['PLNAME{0}'.format(ii+len(parnames))] = 'e' + parname
+    if 'WCSAXES' in hdu.header:
+        hdu.header['WCSAXES'] = 3
+    hdu.header['CDELT3'] = 1
+    hdu.header['CTYPE3'] = 'FITPAR'
+    hdu.header['CRVAL3'] = 0
+    hdu.header['CRPIX3'] = 1
+    hdu.writeto(filename, clobber=overwrite)
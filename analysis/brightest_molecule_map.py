@@ -5,37 +5,41 @@ from astropy import units as u
 from astropy import constants
 from line_to_image_list import line_to_image_list
 from radio_beam import Beam
+from astropy.io import fits
+from astropy.table import Table
+from line_index import LineIndex, stream_peaks, topk_species
 
 template = 'merge/fullcube_cutouts/{sourcename}cutout_full_W51_7m12m_spw{0}_{res}lines.fits'
 
+linenames = np.array([x[0] for x in line_to_image_list])
+linefreqs = np.array([float(x[1].strip('GHz')) for x in line_to_image_list])
+lineindex = LineIndex(linenames, linefreqs, vlsr=60)
+
 for res in ('','hires_'):
     for sourcename in ('e2','e8','north'):
+        # per-line peak brightness accumulated over all four spws
+        linemax = None
         for spw in (0,1,2,3):
             cube = SpectralCube.read(paths.dpath(template.format(spw,
                                                                  sourcename=sourcename,
                                                                  res=res)))
-            argmax = cube.argmax(axis=0)
-
-            peakfreqmap = cube.spectral_axis[argmax]
+            if linemax is not None and linemax.shape[1:] != cube.shape[1:]:
+                raise ValueError("spw cutouts of {0} are not on the same grid"
+                                 .format(sourcename))
+            peak, argmax, linemax = stream_peaks(cube, lineindex,
+                                                 linemax=linemax)
 
-            linefreqs = np.array([float(x[1].strip('GHz')) for x in line_to_image_list]) * (1-60*u.km/u.s/constants.c) * u.GHz
-            linenames = np.array([x[0] for x in line_to_image_list])
-            mapping = {x:y for x,y in zip(linenames, linefreqs)}
-            closest = np.argmin(np.abs(peakfreqmap[None,:,:] - linefreqs[:,None,None]), axis=0)
-            vdiff = np.min(np.abs(peakfreqmap[None,:,:] - linefreqs[:,None,None]), axis=0) / (220*u.GHz) * constants.c
-            nomatch = vdiff > 10*u.km/u.s
+            peakfreqmap = cube.with_spectral_unit(u.GHz).spectral_axis.value[argmax]
 
-            names = linenames[closest]
-            freqs = u.Quantity([u.Quantity([mapping[y] for y in n]) for n in names])
+            closest, vdiff = lineindex.nearest(peakfreqmap)
+            nomatch = vdiff > 10
 
-            indices = np.unique(closest)
+            indices, closest_flat = np.unique(closest, return_inverse=True)
             unames = linenames[indices]
             uinds = np.arange(len(unames))
 
-            closest_flat = np.empty_like(closest, dtype='float')
-            for ii,jj in enumerate(indices):
-                closest_flat[closest == jj] = ii
-            closest_flat[nomatch] = np.nan
+            closest_flat = closest_flat.reshape(closest.shape).astype('float')
+            closest_flat[nomatch | ~np.isfinite(peak)] = np.nan
 
             import pylab as pl
             cm = pl.get_cmap('jet', len(unames))
@@ -87,3 +91,16 @@ for res in ('','hires_'):
                                                                                                          spw=spw,
                                                                                                          res=res)),
                           overwrite=True)
+
+        # the k brightest species over all four spws
+        topk_index, topk_value = topk_species(linemax, k=3)
+        header = cube.wcs.celestial.to_header()
+        hdul = fits.HDUList([fits.PrimaryHDU(data=topk_index, header=header),
+                             fits.ImageHDU(data=topk_value, header=header,
+                                           name='PEAK'),
+                             fits.BinTableHDU(Table([linenames], names=['line']),
+                                              name='LINES'),
+                            ])
+        hdul.writeto(paths.dpath('merge/moments/{sourcename}_{res}top3_species.fits'
+                                 .format(sourcename=sourcename, res=res)),
+                     overwrite=True)
@@ -0,0 +1,222 @@
+"""
+Binary columnar store of the core, dendrogram, velocity and photometry
+catalogs.
+
+All catalogs live as named binary table extensions of one FITS file
+(``tables/catalog_store.fits``).  Each table is sorted on its primary key
+(the source ID), which is recorded in the extension header, so lookups and
+joins on the key are `np.searchsorted` calls rather than per-row list
+comprehensions.  Tables are read memory-mapped, so columns that are not
+requested (``columns=...``) are never read from disk.
+
+The upstream scripts still write IPAC tables; `CatalogStore.load` converts
+an IPAC table once and only re-parses it when the file changes (its size and
+mtime are kept in the header).  IPAC is otherwise only an export format for
+publication (`CatalogStore.export_ipac`).
+"""
+import os
+import json
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table, Column
+from astropy import table
+from astropy import log
+
+import paths
+from product_cache import file_signature, normalize
+
+
+def _sorted_lookup(keys, values):
+    """
+    Positions of ``values`` in ``keys`` and whether they were found
+    """
+    keys = np.asarray(keys)
+    values = np.asarray(values)
+    order = np.argsort(keys, kind='stable')
+    pos = np.searchsorted(keys[order], values).clip(0, max(len(keys)-1, 0))
+    found = (keys[order][pos] == values) if len(keys) else np.zeros(values.shape, dtype='bool')
+    return order[pos], found
+
+
+def lookup(tbl, key, values, column, fill_value=np.nan):
+    """
+    ``tbl[column]`` of the row whose ``key`` matches each of ``values``, or
+    ``fill_value`` where there is no match (first match for duplicate keys)
+
+    Replaces ``[tbl[column][tbl[key] == v][0] if any(tbl[key] == v) else
+    fill_value for v in values]``.
+    """
+    rows, found = _sorted_lookup(tbl[key], values)
+    data = np.asarray(tbl[column])
+    if len(data) == 0:
+        return np.full(np.shape(values), fill_value)
+    return np.where(found, data[rows], fill_value)
+
+
+def choose_columns(tbl, names, index, fill_value=None):
+    """
+    Per-row choice between columns: ``tbl[names[index[i]]][i]``, or
+    ``fill_value`` where ``index`` is negative (if given)
+
+    Replaces ``[tbl[names[y]][ii] if y >= 0 else fill_value for ii, y in
+    enumerate(index)]``.
+    """
+    index = np.asarray(index)
+    stacked = np.array([np.asarray(tbl[name]) for name in names])
+    chosen = np.take_along_axis(stacked, index.clip(0, None)[None, :], axis=0)[0]
+    if fill_value is None:
+        return chosen
+    return np.where(index >= 0, chosen, fill_value)
+
+
+class CatalogStore(object):
+    """
+    Parameters
+    ----------
+    filename : str
+        The FITS file holding all of the catalogs
+    """
+    def __init__(self, filename=paths.tpath('catalog_store.fits')):
+        self.filename = filename
+
+    def names(self):
+        """
+        Names of the stored catalogs
+        """
+        if not os.path.exists(self.filename):
+            return []
+        with fits.open(self.filename) as fh:
+            return [hdu.name.lower() for hdu in fh[1:]]
+
+    def header(self, name):
+        with fits.open(self.filename) as fh:
+            return fh[name].header.copy()
+
+    def write(self, name, tbl, key='SourceID', source=None):
+        """
+        Store ``tbl`` as catalog ``name``, sorted on ``key`` (replacing any
+        catalog of the same name)
+
+        Parameters
+        ----------
+        source : str, optional
+            The file the table was read from, recorded so that `load` knows
+            when to re-import it
+        """
+        # index rather than sort: a shallow copy shares (and Table.sort
+        # reorders) the caller's column buffers
+        if key is not None:
+            tbl = tbl[np.argsort(tbl[key], kind='stable')]
+        else:
+            tbl = tbl.copy(copy_data=False)
+        # IPAC keywords ({name: {'value': ...}}) do not fit in FITS cards
+        keywords = tbl.meta.pop('keywords', None)
+        hdu = fits.table_to_hdu(tbl)
+        hdu.name = name.upper()
+        hdu.header['PRIMKEY'] = key if key is not None else ''
+        if keywords is not None:
+            hdu.header['IPACKEYS'] = json.dumps(normalize(dict(keywords)))
+        if source is not None:
+            signature = file_signature(source)
+            hdu.header['SRCPATH'] = signature['path']
+            hdu.header['SRCSIZE'] = signature['size']
+            hdu.header['SRCMTIME'] = signature['mtime']
+
+        if os.path.exists(self.filename):
+            with fits.open(self.filename) as fh:
+                hdus = [h.copy() for h in fh]
+        else:
+            hdus = [fits.PrimaryHDU()]
+        hdus = [h for h in hdus if h.name != hdu.name] + [hdu]
+        tmpfile = self.filename + '.tmp'
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        fits.HDUList(hdus).writeto(tmpfile)
+        os.rename(tmpfile, self.filename)
+
+    def read(self, name, columns=None, index=True):
+        """
+        Read a catalog, optionally only some of its columns
+
+        Parameters
+        ----------
+        columns : list, optional
+            The columns to read (the key is always included)
+        index : bool
+            Add an astropy index on the key, for ``tbl.loc[source_id]``
+        """
+        tbl = Table.read(self.filename, hdu=name.upper(), memmap=True)
+        key = tbl.meta.pop('PRIMKEY', '') or None
+        for kw in ('EXTNAME', 'SRCPATH', 'SRCSIZE', 'SRCMTIME'):
+            tbl.meta.pop(kw, None)
+        if 'IPACKEYS' in tbl.meta:
+            tbl.meta['keywords'] = json.loads(tbl.meta.pop('IPACKEYS'))
+        if columns is not None:
+            columns = list(columns)
+            if key is not None and key not in columns:
+                columns.insert(0, key)
+            tbl = tbl[columns]
+        # copy the selected columns out of the memory map
+        tbl = tbl.copy()
+        tbl.convert_bytestring_to_unicode()
+        if index and key is not None:
+            tbl.add_index(key)
+        return tbl
+
+    def is_current(self, name, source):
+        """
+        True if catalog ``name`` was imported from the current ``source``
+        """
+        if name.lower() not in self.names():
+            return False
+        header = self.header(name)
+        if 'SRCPATH' not in header:
+            return False
+        signature = file_signature(source)
+        return (header['SRCPATH'] == signature['path'] and
+                header['SRCSIZE'] == signature['size'] and
+                header['SRCMTIME'] == signature['mtime'])
+
+    def load(self, name, source, key='SourceID', columns=None,
+             format='ascii.ipac', rename=None):
+        """
+        Read catalog ``name``, (re-)importing it from the table file
+        ``source`` first if that has changed since the last import
+
+        Parameters
+        ----------
+        rename : dict, optional
+            Columns to rename on import (e.g. ``{'name': 'SourceID'}``)
+        """
+        if not self.is_current(name, source):
+            log.info("Importing {0} into the catalog store as {1}"
+                     .format(source, name))
+            tbl = Table.read(source, format=format)
+            for old, new in (rename or {}).items():
+                tbl.rename_column(old, new)
+            self.write(name, tbl, key=key, source=source)
+        return self.read(name, columns=columns)
+
+    def join(self, names, keys='SourceID', columns=None, join_type='inner'):
+        """
+        Join several stored catalogs on their key, reading only ``columns``
+        (a list per catalog, or None for all of them)
+        """
+        if columns is None:
+            columns = [None]*len(names)
+        tables = [self.read(name, columns=cols, index=False)
+                  for name, cols in zip(names, columns)]
+        merged = tables[0]
+        for tbl in tables[1:]:
+            merged = table.join(merged, tbl, keys=keys, join_type=join_type)
+        return merged
+
+    def export_ipac(self, name, filename, columns=None):
+        """
+        Write a stored catalog as an IPAC table (for publication)
+        """
+        tbl = self.read(name, columns=columns, index=False)
+        tbl.write(filename, format='ascii.ipac', overwrite=True)
+
+
+default_store = CatalogStore()
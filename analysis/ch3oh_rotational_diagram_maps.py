@@ -25,6 +25,7 @@ import re
 import glob
 
 from line_to_image_list import line_to_image_list
+from stage_timing import stage, staged
 frequencies = u.Quantity([float(row[1].strip('GHz'))
                           for row in line_to_image_list], u.GHz)
 name_to_freq = {row[0]:frq for frq, row in zip(frequencies, line_to_image_list)}
@@ -55,6 +56,7 @@ einsteinAij = u.Quantity([float(rt[key].TransitionProbabilityA) for key in rt],
 #                                 u.esu*u.cm)
 
 
+@staged(kind='io')
 def cutout_id_chem_map(yslice=slice(367,467), xslice=slice(114,214),
                        vrange=[51,60]*u.km/u.s, sourcename='e2',
                        filelist=glob.glob(paths.dpath('12m/cutouts/*e2e8*fits')),
@@ -201,6 +203,7 @@ def nupper_of_kkms(kkms, freq, Aul, degeneracies, Tex=100*u.K,
 #    return nline.value / degeneracies *u.cm**-2 # because... something wrong.
 #    return nline.value * u.cm**-2
 #
+@staged(kind='fit', aggregate=True)
 def fit_tex(eupper, nupperoverg, verbose=False, plot=False, uplims=None,
             errors=None, min_nupper=1,
             replace_errors_with_uplims=False,
@@ -404,6 +407,7 @@ def test_roundtrip(cubefrequencies=[218.44005, 234.68345, 220.07849, 234.69847,
     print("column = {0} (input was 1e15)".format(np.log10(col.value)))
 
 
+@staged(kind='fit')
 def fit_all_tex(xaxis, cube, cubefrequencies, indices, degeneracies,
                 ecube=None,
                 replace_bad=False):
@@ -505,92 +509,93 @@ if __name__ == "__main__":
                               )
         xaxis,cube,ecube,maps,map_error,energies,cubefrequencies,indices,degeneracies,header = _
 
-        fig2 = pl.figure(2, figsize=(12,12))
-        if not np.all(fig2.get_size_inches() == (12,12)):
-            pl.close(2)
-        pl.figure(2, figsize=(12,12)).clf()
-        sample_pos = np.linspace(0,1,7)[1:-1]
-        nx = len(sample_pos)
-        ny = len(sample_pos)
-        for ii,(spy,spx) in enumerate(itertools.product(sample_pos,sample_pos)):
-            rdx = int(spx*cube.shape[2])
-            rdy = int(spy*cube.shape[1])
-            plotnum = (nx*ny-(2*(ii//ny)*ny)+ii-ny)+1
-            pl.subplot(nx,ny,plotnum)
-
-            #uplims = nupper_of_kkms(replace_bad, cubefrequencies,
-            #                        einsteinAij[indices], degeneracies,)
-            nupper_error = nupper_of_kkms(ecube[:,rdy,rdx], cubefrequencies,
-                                          einsteinAij[indices], degeneracies,)
-            uplims = 3*nupper_error
-            Ntot, tex, slope, intcpt = fit_tex(xaxis,
-                                               nupper_of_kkms(cube[:,rdy,rdx],
-                                                              cubefrequencies,
-                                                              einsteinAij[indices],
-                                                              degeneracies).value,
-                                               errors=nupper_error.value,
-                                               uplims=uplims.value,
-                                               verbose=True,
-                                               plot=True)
-            pl.ylim(11, 15)
-            pl.xlim(0, 850)
-            #pl.annotate("{0:d},{1:d}".format(rdx,rdy), (0.5, 0.85), xycoords='axes fraction',
-            #            horizontalalignment='center')
-            pl.annotate("T={0:d}".format(int(tex.value)),
-                        (0.65, 0.85), xycoords='axes fraction',
-                        horizontalalignment='left', fontsize=6)
-            pl.annotate("N={0:0.1f}".format(np.log10(Ntot.value)),
-                        (0.65, 0.75), xycoords='axes fraction',
-                        horizontalalignment='left', fontsize=6)
-            pl.annotate("{0:0.2f},{1:0.2f}".format(spx,spy),
-                        (0.05, 0.05), xycoords='axes fraction',
-                        horizontalalignment='left', fontsize=6)
-
-            # show upper limits
-            # (this is automatically done now)
-            #pl.plot(xaxis,
-            #        np.log10(nupper_of_kkms(replace_bad,
-            #                                cubefrequencies,
-            #                                einsteinAij[indices],
-            #                                degeneracies).value),
-            #        linestyle='none', marker='_', color='k',
-            #        markeredgewidth=2, alpha=0.5)
-
-            # one title per axis
-            if plotnum == 11:
-                pl.ylabel("log($N_u / g_u$)")
-            else:
-                pl.ylabel("")
-
-            if plotnum == 23:
-                pl.xlabel("$E_u$ [K]")
-            else:
-                pl.xlabel("")
-
+        with stage('rotation_diagrams', kind='plot', source=sourcename):
+            fig2 = pl.figure(2, figsize=(12,12))
+            if not np.all(fig2.get_size_inches() == (12,12)):
+                pl.close(2)
+            pl.figure(2, figsize=(12,12)).clf()
+            sample_pos = np.linspace(0,1,7)[1:-1]
+            nx = len(sample_pos)
+            ny = len(sample_pos)
+            for ii,(spy,spx) in enumerate(itertools.product(sample_pos,sample_pos)):
+                rdx = int(spx*cube.shape[2])
+                rdy = int(spy*cube.shape[1])
+                plotnum = (nx*ny-(2*(ii//ny)*ny)+ii-ny)+1
+                pl.subplot(nx,ny,plotnum)
+
+                #uplims = nupper_of_kkms(replace_bad, cubefrequencies,
+                #                        einsteinAij[indices], degeneracies,)
+                nupper_error = nupper_of_kkms(ecube[:,rdy,rdx], cubefrequencies,
+                                              einsteinAij[indices], degeneracies,)
+                uplims = 3*nupper_error
+                Ntot, tex, slope, intcpt = fit_tex(xaxis,
+                                                   nupper_of_kkms(cube[:,rdy,rdx],
+                                                                  cubefrequencies,
+                                                                  einsteinAij[indices],
+                                                                  degeneracies).value,
+                                                   errors=nupper_error.value,
+                                                   uplims=uplims.value,
+                                                   verbose=True,
+                                                   plot=True)
+                pl.ylim(11, 15)
+                pl.xlim(0, 850)
+                #pl.annotate("{0:d},{1:d}".format(rdx,rdy), (0.5, 0.85), xycoords='axes fraction',
+                #            horizontalalignment='center')
+                pl.annotate("T={0:d}".format(int(tex.value)),
+                            (0.65, 0.85), xycoords='axes fraction',
+                            horizontalalignment='left', fontsize=6)
+                pl.annotate("N={0:0.1f}".format(np.log10(Ntot.value)),
+                            (0.65, 0.75), xycoords='axes fraction',
+                            horizontalalignment='left', fontsize=6)
+                pl.annotate("{0:0.2f},{1:0.2f}".format(spx,spy),
+                            (0.05, 0.05), xycoords='axes fraction',
+                            horizontalalignment='left', fontsize=6)
+
+                # show upper limits
+                # (this is automatically done now)
+                #pl.plot(xaxis,
+                #        np.log10(nupper_of_kkms(replace_bad,
+                #                                cubefrequencies,
+                #                                einsteinAij[indices],
+                #                                degeneracies).value),
+                #        linestyle='none', marker='_', color='k',
+                #        markeredgewidth=2, alpha=0.5)
+
+                # one title per axis
+                if plotnum == 11:
+                    pl.ylabel("log($N_u / g_u$)")
+                else:
+                    pl.ylabel("")
 
-            if (plotnum-1) % ny == 0:
-                if (plotnum-1) != (ny*(nx-1)):
-                    ticks = pl.gca().get_yaxis().get_ticklocs()
-                    pl.gca().get_yaxis().set_ticks(ticks[1:])
-            else:
-                pl.gca().get_yaxis().set_ticklabels([])
-                pl.ylabel("")
+                if plotnum == 23:
+                    pl.xlabel("$E_u$ [K]")
+                else:
+                    pl.xlabel("")
 
 
-            if (plotnum-1) >= (ny*(nx-1)):
-                tl = pl.gca().get_yaxis().get_ticklabels()
-                xax = pl.gca().get_xaxis()
-                if (plotnum-1) == (nx*ny-1):
-                    xax.set_ticks((0,200,400,600,800))
+                if (plotnum-1) % ny == 0:
+                    if (plotnum-1) != (ny*(nx-1)):
+                        ticks = pl.gca().get_yaxis().get_ticklocs()
+                        pl.gca().get_yaxis().set_ticks(ticks[1:])
                 else:
-                    xax.set_ticks((0,200,400,600))
-                #xax.set_tick_params(labelsize=14)
-            else:
-                pl.gca().get_xaxis().set_ticklabels([])
-                pl.xlabel("")
-            #pl.legend(loc='best', fontsize='small')
-        pl.subplots_adjust(hspace=0, wspace=0)
-        pl.savefig(paths.fpath("chemistry/ch3oh_rotation_diagrams_{0}.png".format(sourcename)), bbox_inches='tight')
+                    pl.gca().get_yaxis().set_ticklabels([])
+                    pl.ylabel("")
+
+
+                if (plotnum-1) >= (ny*(nx-1)):
+                    tl = pl.gca().get_yaxis().get_ticklabels()
+                    xax = pl.gca().get_xaxis()
+                    if (plotnum-1) == (nx*ny-1):
+                        xax.set_ticks((0,200,400,600,800))
+                    else:
+                        xax.set_ticks((0,200,400,600))
+                    #xax.set_tick_params(labelsize=14)
+                else:
+                    pl.gca().get_xaxis().set_ticklabels([])
+                    pl.xlabel("")
+                #pl.legend(loc='best', fontsize='small')
+            pl.subplots_adjust(hspace=0, wspace=0)
+            pl.savefig(paths.fpath("chemistry/ch3oh_rotation_diagrams_{0}.png".format(sourcename)), bbox_inches='tight')
 
         # Flip this bit if you just want the rotational diagram plots and not
         # the fitted maps
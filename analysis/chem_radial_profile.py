@@ -11,6 +11,7 @@ import radio_beam
 import numpy as np
 from astropy import units as u
 import pyregion
+import region_masks
 import image_tools
 from astropy import wcs
 from constants import continuum_frequency
@@ -18,6 +19,9 @@ from line_to_image_list import labeldict
 
 import re
 import glob
+from product_cache import ProductCache
+
+chemslab_cache = ProductCache(paths.dpath('chemslices'))
 
 region_names = {'e2': 'e2_exclude_e2w.reg',
                 'north': 'd2_core.reg',
@@ -43,10 +47,10 @@ for regfn,region,fignum,imtype,suffix,outsuffix in (
 
     reg = pyregion.open(paths.rpath(regfn))
 
-    path_template = paths.dpath("chemslices/chemical_{2}_slabs_{0}_*{1}.fits"
-                                .format(region, suffix, imtype))
+    path_template = ("chemical_{2}_slabs_{0}_*{1}.fits"
+                     .format(region, suffix, imtype))
 
-    files = glob.glob(path_template)
+    files = chemslab_cache.products(path_template)
 
     linestyles = {name: itertools.cycle(['-'] + ['--'] + [':'] + ['-.'])
                   for name in region_names}
@@ -102,7 +106,7 @@ for regfn,region,fignum,imtype,suffix,outsuffix in (
             #print("fn  {0} ppbeam={1:0.2f}".format(fn, ppbeam))
 
             data = fh[0].data
-            mask = reg.get_mask(fh[0]) & np.isfinite(data)
+            mask = region_masks.get_mask(reg, hdu=fh[0]) & np.isfinite(data)
 
             # crop to fit
             slices = ndimage.find_objects(mask)[0]
@@ -11,6 +11,7 @@ from astropy.nddata.utils import Cutout2D
 import photutils
 import paths
 import pyregion
+import region_masks
 from astropy.io import fits
 from astropy import wcs
 from astropy.table import Table,Column
@@ -53,7 +54,7 @@ for reg in ProgressBar(regions):
     name = reg.attr[1]['text']
     log.info(name)
 
-    mask = shreg.get_mask(hdu=contfile[0])
+    mask = region_masks.get_mask(shreg, hdu=contfile[0])
 
     data = contfile[0].data
     results[name] = {'peak': data[mask].max(),
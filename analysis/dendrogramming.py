@@ -1,7 +1,5 @@
 import os
 import numpy as np
-from astropy.convolution import convolve_fft, Gaussian2DKernel
-from astropy.utils.console import ProgressBar
 from astropy import units as u
 from astropy import log
 import paths
@@ -11,9 +9,9 @@ import radio_beam
 import astrodendro
 from astropy import wcs
 import masscalc
-import photutils
-from astropy.nddata.utils import Cutout2D
-from astropy import coordinates
+import dust_kernels
+import structure_stats
+import local_noise
 
 
 #contfile = fits.open(paths.dpath('selfcal_spw3_selfcal_4ampphase_mfs_tclean_deeper_10mJy.image.pbcor.fits'))
@@ -27,12 +25,13 @@ radiofilename = os.path.join(paths.vlapath,
 radio_image = fits.open(radiofilename)
 
 # estimate the noise from the local standard deviation of the residuals
-residfile = fits.open(paths.dpath('12m/continuum/W51_te_continuum_best_residual.fits'))
-resid = residfile[0].data
-smresid = convolve_fft(np.nan_to_num(resid), Gaussian2DKernel(30))
-resid[np.isnan(resid)] = 0.01 # make the noise outside very high
-# NOT CORRECT noise = convolve_fft(np.abs(resid-smresid),  Gaussian2DKernel(30))
-noise = convolve_fft((resid-smresid)**2,  Gaussian2DKernel(30))**0.5
+# (cached per residual file; the residual is set to 0.01 outside the map to
+# make the noise outside very high)
+residfilename = paths.dpath('12m/continuum/W51_te_continuum_best_residual.fits')
+residfile = fits.open(residfilename)
+# NOT CORRECT: stat='mean_abs_dev'
+noise = np.array(local_noise.cached_noise_map(residfilename, scale=30,
+                                              stat='std', fill_value=0.01))
 residfile[0].data = noise
 residfile.writeto(paths.dpath('W51_te_continuum_best_noise.fits'), clobber=True)
 # lowest reasonable noise level is 0.2 mJy/beam
@@ -83,19 +82,20 @@ radii = (0.2,0.4,0.6,0.8,1.0,1.5)*u.arcsec
 columns = {k:[] for k in (keys)}
 
 log.info("Doing photometry")
-for ii, row in enumerate(ProgressBar(ppcat)):
-    structure = dend[row['_idx']]
-    assert structure.idx == row['_idx'] == ii
-    dend_inds = structure.indices()
-    columns['noise'].append(noise[dend_inds].mean())
-    columns['is_leaf'].append(structure.is_leaf)
-    peakflux = data[dend_inds].max()
-    columns['peak_cont_flux'].append(peakflux)
-    columns['min_cont_flux'].append(data[dend_inds].min())
-    columns['mean_cont_flux'].append(data[dend_inds].mean())
-    columns['peak_cont_mass'].append((masscalc.mass_conversion_factor()*peakflux).to(u.M_sun).value)
-    columns['peak_cont_col'].append((masscalc.col_conversion_factor(beamomega=beam.sr.value)*peakflux).to(u.cm**-2).value)
-    columns['beam_area'].append(beam.sr.value)
+# all structures at once: reduce over the index map, then up the tree
+stats = structure_stats.structure_statistics(dend, {'noise': noise,
+                                                    'cont': data})
+assert np.all(ppcat['_idx'] == np.arange(len(ppcat)))
+columns['noise'] = stats['noise_mean']
+columns['is_leaf'] = stats['is_leaf']
+columns['peak_cont_flux'] = stats['cont_max']
+columns['min_cont_flux'] = stats['cont_min']
+columns['mean_cont_flux'] = stats['cont_mean']
+columns['beam_area'] = np.repeat(beam.sr.value, len(ppcat))
+# mass & column of all peaks at once
+columns['peak_cont_mass'] = dust_kernels.mass_of_flux(columns['peak_cont_flux'])
+columns['peak_cont_col'] = dust_kernels.column_of_flux(columns['peak_cont_flux'],
+                                                       beamomega=beam.sr)
 for k in columns:
     if k not in ppcat.keys():
         ppcat.add_column(Column(name=k, data=columns[k]))
@@ -106,38 +106,21 @@ cat_mask = (ppcat['is_leaf'] &
             (ppcat['min_cont_flux']>1*ppcat['noise']))
 log.info("Keeping {0} of {1} core candidates ({2}%)".format(cat_mask.sum(), len(cat_mask), cat_mask.sum()/len(cat_mask)*100))
 pruned_ppcat = ppcat[cat_mask]
-mask = dend.index_map.copy()
 log.info("Pruning mask image")
-for ii in ProgressBar(list(range(len(ppcat)))):
-    if ii not in pruned_ppcat['_idx']:
-        mask[mask == ii] = -1
+mask = structure_stats.pruned_index_map(dend.index_map, pruned_ppcat['_idx'])
 outf = fits.PrimaryHDU(data=mask, header=contfile[0].header)
 outf.writeto('dendrograms_min1mJy_diff1mJy_mask_pruned.fits', clobber=True)
 
-for image, name in ((contfile,''), (radio_image,'KUband')):
-    data = image[0].data.squeeze()
-    mywcs = wcs.WCS(image[0].header).celestial
-
-    keys = ['{1}cont_flux{0}arcsec'.format(rr.value, name) for rr in radii]
-    columns = {k:[] for k in (keys)}
-    log.info("Doing aperture photometry on {0}".format(name))
-    for ii, row in enumerate(ProgressBar(pruned_ppcat)):
-        size = max(radii)*2.2
-        xc,yc = row['x_cen'], row['y_cen']
-        position = coordinates.SkyCoord(xc, yc, frame='fk5', unit=(u.deg,u.deg))
-        cutout = Cutout2D(data, position, size, mywcs, mode='partial')
-        for rr in radii:
-            aperture = photutils.SkyCircularAperture(positions=position,
-                                                     r=rr).to_pixel(cutout.wcs)
-            aperture_data = photutils.aperture_photometry(data=cutout.data,
-                                                          apertures=aperture,
-                                                          method='exact')
-            flux_jybeam = aperture_data[0]['aperture_sum']
-            #flux_jybeam_average = flux_jybeam / aperture.area()
-            #flux_jysr_average = flux_jybeam_average / beam.sr.value
-            #flux_jysr = flux_jysr_average * aperture.area()
-            #flux_jy = (flux_jysr * (pixel_scale**2).to(u.sr).value)
-            columns['{1}cont_flux{0}arcsec'.format(rr.value, name)].append(flux_jybeam/ppbeam)
+# every position and radius in one photutils call per image, both images in
+# parallel
+image_names = ('', 'KUband')
+image_fluxes = structure_stats.multi_image_aperture_fluxes(
+    [paths.dpath('W51_te_continuum_best.fits'), radiofilename],
+    pruned_ppcat['x_cen'], pruned_ppcat['y_cen'], radii)
+for name, fluxes in zip(image_names, image_fluxes):
+    log.info("Aperture photometry on {0}".format(name))
+    columns = {'{1}cont_flux{0}arcsec'.format(rr.value, name): flux_jybeam/ppbeam
+               for rr, flux_jybeam in zip(radii, fluxes)}
 
     for k in columns:
         if k not in pruned_ppcat.keys():
@@ -0,0 +1,140 @@
+"""
+Tabulated dust mass / column conversion factors.
+
+`dust_emissivity.dust.massofsnu` and `colofsnu` are evaluated (with full
+Quantity math) once per frequency on a fine temperature grid; afterwards the
+factors are interpolated as plain floats, so converting a whole temperature
+map (and flux map) to mass or column is one array operation.  This is the
+backend of `masscalc.mass_conversion_factor` and
+`masscalc.col_conversion_factor`.
+
+The temperature dependence of both factors is dominated by the Planck
+function, 1/B_nu(T) ~ exp(h nu / k T) - 1, which is steep at low T.  The
+tabulated quantity is therefore the factor times 1/(exp(h nu/kT)-1), which
+varies slowly, and the exact Planck term is applied analytically after the
+interpolation.
+"""
+import numpy as np
+from astropy import units as u
+from astropy import constants
+from dust_emissivity import dust
+
+from constants import distance as default_distance
+from constants import continuum_frequency
+
+temperature_grid = np.logspace(0, 4, 2001)
+
+_kernels = {}
+
+
+def _planck_term(nu_ghz, TK):
+    return 1/np.expm1(constants.h.cgs.value*nu_ghz*1e9 /
+                      (constants.k_B.cgs.value*np.asarray(TK, dtype='float')))
+
+
+class ConversionKernel(object):
+    """
+    A temperature-dependent conversion factor tabulated on
+    `temperature_grid`
+
+    Parameters
+    ----------
+    func : function
+        ``func(TK)`` -> unitless factor, vectorized over a temperature array
+    nu : `~astropy.units.Quantity`
+        The frequency of the Planck term
+    """
+    def __init__(self, func, nu, tgrid=temperature_grid):
+        self.nu_ghz = nu.to(u.GHz).value
+        self.log_tgrid = np.log(tgrid)
+        self.table = (np.asarray(func(tgrid), dtype='float') *
+                      _planck_term(self.nu_ghz, tgrid))
+
+    def __call__(self, TK):
+        TK = np.asarray(TK, dtype='float')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            smooth = np.interp(np.log(TK), self.log_tgrid, self.table)
+            return smooth / _planck_term(self.nu_ghz, TK)
+
+
+def _temperature(TK):
+    if hasattr(TK, 'unit'):
+        return TK.to(u.K).value
+    return TK
+
+
+def _mass_kernel(nu):
+    key = ('mass', nu.to(u.GHz).value)
+    if key not in _kernels:
+        d0 = default_distance.to(u.kpc)
+        def func(TK):
+            return dust.massofsnu(nu=nu, snu=1*u.Jy, distance=d0,
+                                  temperature=TK*u.K).to(u.M_sun).value
+        _kernels[key] = ConversionKernel(func, nu)
+    return _kernels[key]
+
+
+def _column_kernel(nu):
+    key = ('column', nu.to(u.GHz).value)
+    if key not in _kernels:
+        def func(TK):
+            return dust.colofsnu(nu=nu, snu=1*u.Jy, beamomega=1*u.sr,
+                                 temperature=TK*u.K).to(u.cm**-2).value
+        _kernels[key] = ConversionKernel(func, nu)
+    return _kernels[key]
+
+
+def precompute(frequencies=None):
+    """
+    Build the mass and column kernels for ``frequencies`` up front, e.g.
+    before forking workers.  By default, for the frequencies the masscalc
+    conversions use: ``masscalc.centerfreq`` and ``masscalc.centerfreq_lb``.
+    """
+    if frequencies is None:
+        # masscalc imports this module, so it can't be imported at the top
+        import masscalc
+        frequencies = (masscalc.centerfreq, masscalc.centerfreq_lb)
+    for nu in frequencies:
+        _mass_kernel(nu)
+        _column_kernel(nu)
+
+
+def mass_per_jy(TK=20, distance=default_distance, nu=continuum_frequency):
+    """
+    M_sun per Jy at temperature(s) ``TK`` (K; any shape)
+    """
+    scale = (distance.to(u.kpc) / default_distance.to(u.kpc)).decompose().value**2
+    return _mass_kernel(nu)(_temperature(TK)) * scale
+
+
+def column_per_jy(TK=20, beamomega=1*u.sr, nu=continuum_frequency):
+    """
+    cm^-2 per Jy in ``beamomega`` at temperature(s) ``TK`` (K; any shape)
+    """
+    omega_sr = u.Quantity(beamomega, u.sr).value
+    return _column_kernel(nu)(_temperature(TK)) / omega_sr
+
+
+def mass_of_flux(flux, TK=20, distance=default_distance,
+                 nu=continuum_frequency):
+    """
+    Mass (M_sun) of flux densities ``flux`` (Jy) at temperatures ``TK``;
+    both may be arrays (e.g. a flux map and a temperature map)
+    """
+    return np.asarray(flux) * mass_per_jy(TK, distance=distance, nu=nu)
+
+
+def column_of_flux(flux, beamomega, TK=20, nu=continuum_frequency):
+    """
+    Column (cm^-2) of flux densities ``flux`` (Jy per ``beamomega``) at
+    temperatures ``TK``
+    """
+    return np.asarray(flux) * column_per_jy(TK, beamomega=beamomega, nu=nu)
+
+
+def flux_of_mass(mass, TK=20, distance=default_distance,
+                 nu=continuum_frequency):
+    """
+    Flux density (Jy) of masses ``mass`` (M_sun) at temperatures ``TK``
+    """
+    return np.asarray(mass) / mass_per_jy(TK, distance=distance, nu=nu)
@@ -5,30 +5,31 @@ import pyregion
 import radio_beam
 from spectral_cube import SpectralCube
 import paths
+from fits_index import default_index
 
 tmplt = "full_W51{2}_spw{0}{1}_lines.fits"
 
+# which cubes exist, and their (median) beams, from the header index
+default_index.update("full_W51*_spw*_lines.fits")
+
 region_list = pyregion.open(paths.rpath('three_e2_pixels.reg'))
 
 for extra1 in ("","_7m12m"):
     for extra2 in ("","_hires"):
         for spw in (0,1,2,3):
-            try:
-                cube = SpectralCube.read(tmplt.format(spw, extra2, extra1))
-            except IOError:
+            row = default_index.row(tmplt.format(spw, extra2, extra1))
+            if row is None:
                 print("didn't find {0}".format(tmplt.format(spw, extra2, extra1)))
                 continue
+            cube = SpectralCube.read(row['path'])
             print(cube)
-            try:
-                beam = radio_beam.Beam.from_fits_header(cube.header)
-            except TypeError:
-                if hasattr(cube, 'beams'):
-                    beam = radio_beam.Beam(major=np.nanmedian([bm.major.to(u.deg).value for bm in cube.beams]),
-                                           minor=np.nanmedian([bm.minor.to(u.deg).value for bm in cube.beams]),
-                                           pa=np.nanmedian([bm.pa.to(u.deg).value for bm in cube.beams]),
-                                          )
-                else:
-                    beam = None
+            # single beam, or the median of the beam table
+            if np.isfinite(row['bmaj']):
+                beam = radio_beam.Beam(major=row['bmaj']*u.deg,
+                                       minor=row['bmin']*u.deg,
+                                       pa=row['bpa']*u.deg)
+            else:
+                beam = None
 
             for reg in region_list:
                 if 'text' not in reg.attr[1]:
@@ -0,0 +1,340 @@
+"""
+Index of the headers of the FITS data products.
+
+Opening every cube just to learn its grid, beam or spectral coverage is slow
+on network-mounted storage.  `FitsIndex.update` reads the headers (and the
+beam table of multi-beam cubes) of the files matching a set of glob patterns
+once and keeps a summary row per file: path, size, mtime, shape, WCS summary,
+beam or beam-table statistics, spectral extrema, and the line, source cutout,
+array and spw parsed from the file name.  Later updates only stat the files
+and rescan the new or changed ones.  The index is stored as a table in a
+`catalog_store.CatalogStore` file and queried without opening any data file::
+
+    index = FitsIndex()
+    index.update(paths.dpath('12m/cutouts/*.fits'))
+    fns = index.filenames(line='CH3OH808-716', source='e2e8', max_beam=0.5*u.arcsec)
+"""
+import os
+import re
+import warnings
+import glob
+import fnmatch
+import multiprocessing
+import numpy as np
+from astropy.io import fits
+from astropy import wcs
+from astropy import units as u
+from astropy import constants
+from astropy import log
+from astropy.table import Table, vstack
+
+import paths
+from catalog_store import CatalogStore
+
+# (name, dtype) of every index column; angles in deg, frequencies in Hz
+columns = [('path', 'U400'), ('size', 'i8'), ('mtime', 'f8'),
+           ('ndim', 'i4'), ('nx', 'i4'), ('ny', 'i4'), ('nchan', 'i4'),
+           ('bunit', 'U20'), ('ra', 'f8'), ('dec', 'f8'), ('pixscale', 'f8'),
+           ('spec_ctype', 'U12'), ('spec_unit', 'U12'),
+           ('spec_min', 'f8'), ('spec_max', 'f8'), ('restfreq', 'f8'),
+           ('freq_min', 'f8'), ('freq_max', 'f8'),
+           ('bmaj', 'f8'), ('bmin', 'f8'), ('bpa', 'f8'),
+           ('bmaj_min', 'f8'), ('bmaj_max', 'f8'), ('nbeams', 'i4'),
+           ('line', 'U40'), ('source', 'U20'), ('array', 'U8'), ('spw', 'i4'),
+          ]
+
+
+def parse_filename(filename):
+    """
+    Line, source cutout, array and spw encoded in a product file name, e.g.
+    ``W51_b6_7M_12M.CH3OH808-716.image.pbcor_e2e8cutout.fits`` or
+    ``e2cutout_full_W51_7m12m_spw1_hires_lines.fits`` ('' or -1 if absent)
+    """
+    basename = os.path.basename(filename)
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fields = basename.split('.')
+    line = fields[1] if basename.startswith('W51_b6') and len(fields) > 2 else ''
+    source = re.search(r'([A-Za-z0-9]+)cutout', basename)
+    source = source.groups()[0] if source else ''
+    spw = re.search(r'spw([0-9]+)', basename)
+    spw = int(spw.groups()[0]) if spw else -1
+    if re.search('7M_12M|7m12m', basename) or '/merge' in dirname:
+        array = 'merge'
+    elif re.search('12M|12m', basename) or '/12m' in dirname:
+        array = '12m'
+    elif re.search('7M|7m', basename):
+        array = '7m'
+    else:
+        array = ''
+    return {'line': line, 'source': source, 'array': array, 'spw': spw}
+
+
+def match_path(path, pattern):
+    """
+    Whether ``path`` matches the glob ``pattern`` component by component, as
+    in `glob.glob` (``*`` does not match across ``/``, unlike `fnmatch`)
+    """
+    parts = os.path.abspath(path).split(os.sep)
+    patparts = os.path.abspath(pattern).split(os.sep)
+    return (len(parts) == len(patparts) and
+            all(fnmatch.fnmatchcase(part, patpart)
+                for part, patpart in zip(parts, patparts)))
+
+
+def _spectral_summary(header, mywcs):
+    """
+    Spectral axis type, unit and extrema; frequency extrema (Hz) if the axis
+    is frequency or radio velocity with a rest frequency
+    """
+    summary = {'spec_ctype': '', 'spec_unit': '', 'spec_min': np.nan,
+               'spec_max': np.nan, 'restfreq': np.nan, 'freq_min': np.nan,
+               'freq_max': np.nan}
+    if mywcs.wcs.spec < 0:
+        return summary
+    specwcs = mywcs.sub([wcs.WCSSUB_SPECTRAL])
+    nchan = header['NAXIS{0}'.format(mywcs.wcs.spec+1)]
+    ends = specwcs.wcs_pix2world([0, nchan-1], 0)[0]
+    unit = u.Unit(specwcs.wcs.cunit[0])
+    ctype = specwcs.wcs.ctype[0]
+    restfreq = (mywcs.wcs.restfrq if mywcs.wcs.restfrq
+                else header.get('RESTFRQ', header.get('RESTFREQ', np.nan)))
+    summary.update({'spec_ctype': ctype, 'spec_unit': unit.to_string(),
+                    'spec_min': ends.min(), 'spec_max': ends.max(),
+                    'restfreq': restfreq})
+    if ctype.startswith('FREQ'):
+        freqs = (ends*unit).to(u.Hz).value
+    elif ctype.startswith('VRAD') and np.isfinite(restfreq) and restfreq > 0:
+        velo = (ends*unit).to(u.km/u.s)
+        freqs = restfreq*(1-(velo/constants.c).decompose().value)
+    else:
+        return summary
+    summary['freq_min'], summary['freq_max'] = freqs.min(), freqs.max()
+    return summary
+
+
+def scan_file(filename):
+    """
+    The index row of one FITS file (headers and beam table only)
+    """
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    row = {'path': filename, 'size': st.st_size, 'mtime': st.st_mtime}
+    with fits.open(filename, memmap=True) as fh:
+        header = fh[0].header
+        if header.get('NAXIS', 0) == 0 and len(fh) > 1:
+            header = fh[1].header
+        ndim = header.get('NAXIS', 0)
+        row['ndim'] = ndim
+        row['bunit'] = header.get('BUNIT', '')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', wcs.FITSFixedWarning)
+            mywcs = wcs.WCS(header)
+        if mywcs.has_celestial:
+            celestial = mywcs.celestial
+            nx = header['NAXIS{0}'.format(mywcs.wcs.lng+1)]
+            ny = header['NAXIS{0}'.format(mywcs.wcs.lat+1)]
+            center = celestial.wcs_pix2world([[(nx-1)/2., (ny-1)/2.]], 0)[0]
+            row['ra'], row['dec'] = center
+            row['pixscale'] = np.abs(wcs.utils.proj_plane_pixel_scales(celestial)).mean()
+        else:
+            nx = ny = 0
+            row['ra'] = row['dec'] = row['pixscale'] = np.nan
+        row['nx'], row['ny'] = nx, ny
+        row.update(_spectral_summary(header, mywcs))
+        row['nchan'] = (header['NAXIS{0}'.format(mywcs.wcs.spec+1)]
+                        if mywcs.wcs.spec >= 0 else 0)
+
+        if 'BEAMS' in fh:
+            beams = fh['BEAMS'].data
+            bmaj = u.Quantity(beams['BMAJ'], fh['BEAMS'].columns['BMAJ'].unit or u.arcsec).to(u.deg).value
+            bmin = u.Quantity(beams['BMIN'], fh['BEAMS'].columns['BMIN'].unit or u.arcsec).to(u.deg).value
+            good = np.isfinite(bmaj) & (bmaj > 0)
+            row['nbeams'] = len(bmaj)
+            if good.any():
+                row['bmaj'] = np.median(bmaj[good])
+                row['bmin'] = np.median(bmin[good])
+                row['bpa'] = np.median(beams['BPA'][good])
+                row['bmaj_min'] = bmaj[good].min()
+                row['bmaj_max'] = bmaj[good].max()
+        elif 'BMAJ' in header:
+            row['nbeams'] = 1
+            row['bmaj'] = row['bmaj_min'] = row['bmaj_max'] = header['BMAJ']
+            row['bmin'] = header['BMIN']
+            row['bpa'] = header.get('BPA', 0)
+    row.update(parse_filename(filename))
+    return row
+
+
+def _scan_job(filename):
+    try:
+        return scan_file(filename)
+    except Exception as ex:
+        log.warning("Could not index {0}: {1}".format(filename, ex))
+        return None
+
+
+def _empty_table():
+    return Table(names=[name for name, dtype in columns],
+                 dtype=[dtype for name, dtype in columns])
+
+
+def _rows_to_table(rows):
+    tbl = _empty_table()
+    # values of the entries a file has no information for
+    defaults = {'f': np.nan, 'i': 0, 'U': ''}
+    for row in rows:
+        tbl.add_row([row.get(name, defaults[np.dtype(dtype).kind])
+                     for name, dtype in columns])
+    return tbl
+
+
+class FitsIndex(object):
+    """
+    Parameters
+    ----------
+    filename : str
+        The catalog store file holding the index
+    name : str
+        Name of the index table in the store
+    """
+    def __init__(self, filename=paths.dpath('fits_index.fits'),
+                 name='fits_index'):
+        self.store = CatalogStore(filename)
+        self.name = name
+        self._table = None
+        # patterns brought up to date by this instance (i.e., in this run)
+        self._refreshed = set()
+
+    @property
+    def table(self):
+        if self._table is None:
+            if self.name in self.store.names():
+                self._table = self.store.read(self.name, index=False)
+            else:
+                self._table = _empty_table()
+        return self._table
+
+    def update(self, patterns, nprocs=1):
+        """
+        Index the files matching the glob ``patterns`` (a pattern or a list):
+        new and changed files are scanned, and rows of files that match a
+        pattern's directory but no longer exist are dropped
+
+        Returns
+        -------
+        nscanned : int
+            Number of files (re)scanned
+        """
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        tbl = self.table
+        known = {path: (size, mtime) for path, size, mtime in
+                 zip(tbl['path'], tbl['size'], tbl['mtime'])}
+
+        found = set()
+        todo = []
+        for pattern in patterns:
+            for fn in glob.glob(pattern):
+                fn = os.path.abspath(fn)
+                if fn in found:
+                    continue
+                found.add(fn)
+                st = os.stat(fn)
+                if known.get(fn) != (st.st_size, st.st_mtime):
+                    todo.append(fn)
+
+        self._refreshed.update(os.path.abspath(pattern) for pattern in patterns)
+
+        # files that matched a pattern before but have disappeared
+        stale = np.array([(fn not in found) and
+                          any(match_path(fn, pattern) for pattern in patterns)
+                          for fn in tbl['path']], dtype='bool')
+        if not todo and not stale.any():
+            return 0
+
+        log.info("Indexing {0} FITS files".format(len(todo)))
+        if nprocs > 1 and len(todo) > 1:
+            pool = multiprocessing.Pool(nprocs)
+            try:
+                rows = pool.map(_scan_job, todo)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            rows = [_scan_job(fn) for fn in todo]
+        rows = [row for row in rows if row is not None]
+
+        keep = ~stale & ~np.isin(tbl['path'], todo)
+        self._table = vstack([tbl[keep], _rows_to_table(rows)])
+        self.store.write(self.name, self._table, key='path')
+        return len(rows)
+
+    def query(self, pattern=None, line=None, source=None, array=None, spw=None,
+              frequency=None, min_beam=None, max_beam=None, ndim=None):
+        """
+        Rows of the index matching all of the given criteria
+
+        Parameters
+        ----------
+        pattern : str
+            glob pattern on the (absolute) path (see `match_path`)
+        line, source, array : str
+            As parsed from the file names (see `parse_filename`)
+        spw : int
+        frequency : `~astropy.units.Quantity`
+            A frequency covered by the spectral axis
+        min_beam, max_beam : `~astropy.units.Quantity`
+            Range of the (median) beam major axis
+        ndim : int
+        """
+        tbl = self.table
+        sel = np.ones(len(tbl), dtype='bool')
+        if pattern is not None:
+            sel &= np.array([match_path(fn, pattern) for fn in tbl['path']],
+                            dtype='bool')
+        for name, value in (('line', line), ('source', source),
+                            ('array', array), ('spw', spw), ('ndim', ndim)):
+            if value is not None:
+                sel &= np.asarray(tbl[name]) == value
+        if frequency is not None:
+            freq = frequency.to(u.Hz, u.spectral()).value
+            sel &= (tbl['freq_min'] <= freq) & (tbl['freq_max'] >= freq)
+        if min_beam is not None:
+            sel &= tbl['bmaj'] >= min_beam.to(u.deg).value
+        if max_beam is not None:
+            sel &= tbl['bmaj'] <= max_beam.to(u.deg).value
+        return tbl[sel]
+
+    def filenames(self, **kwargs):
+        """
+        Sorted paths of the files matching `query`
+        """
+        return sorted(str(fn) for fn in self.query(**kwargs)['path'])
+
+    def glob(self, pattern, refresh=False, **kwargs):
+        """
+        Drop-in for ``glob.glob(pattern)`` that applies the other `query`
+        criteria.  The index is brought up to date for ``pattern`` the first
+        time it is used (files are only stat'ed once per run); pass
+        ``refresh=True`` to pick up files written since.  As with
+        `glob.glob`, the paths are relative if ``pattern`` is.
+        """
+        if refresh or os.path.abspath(pattern) not in self._refreshed:
+            self.update(pattern)
+        fns = self.filenames(pattern=pattern, **kwargs)
+        if os.path.isabs(pattern):
+            return fns
+        dirname = os.path.dirname(pattern)
+        if not glob.has_magic(dirname):
+            return [os.path.join(dirname, os.path.basename(fn)) for fn in fns]
+        return [os.path.relpath(fn) for fn in fns]
+
+    def row(self, filename):
+        """
+        The index row of ``filename``, or None if it is not indexed
+        """
+        match = self.table[np.asarray(self.table['path']) == os.path.abspath(filename)]
+        return match[0] if len(match) else None
+
+
+default_index = FitsIndex()
@@ -6,10 +6,10 @@ from astropy import constants
 from astropy import units as u
 from astropy.table import Table
 from astropy import table
-from astropy.utils.console import ProgressBar
 import pylab as pl
 import pyregion
 import velo_guesses
+import batch_linefit
 import radio_beam
 
 import warnings
@@ -34,6 +34,13 @@ for region in regions:
     assert len(spectral_files) == 4#len(background_spectral_files) == 4
     vcen = velo_guesses.guesses[name]
 
+# load every core's spectra once
+core_names = []
+spectrum_arrays = []
+spectrum_errors = []
+spectrum_vcens = []
+spectrum_beams = []
+spectrum_cores = []
 for region in regions:
     name = region.attr[1]['text']
     if region.name == 'point':
@@ -55,96 +62,81 @@ for region in regions:
     #if med < 0:
     #    med = 0
 
-    line_table.add_column(table.Column(name='{0}FittedAmplitude'.format(name), data=np.zeros(len(line_table))))
-    line_table.add_column(table.Column(name='{0}FittedCenter'.format(name), data=np.zeros(len(line_table))))
-    line_table.add_column(table.Column(name='{0}FittedWidth'.format(name), data=np.zeros(len(line_table))))
-    line_table.add_column(table.Column(name='{0}FittedAmplitudeError'.format(name), data=np.zeros(len(line_table))))
-    line_table.add_column(table.Column(name='{0}FittedCenterError'.format(name), data=np.zeros(len(line_table))))
-    line_table.add_column(table.Column(name='{0}FittedWidthError'.format(name), data=np.zeros(len(line_table))))
-    line_table.add_column(table.Column(name='{0}JtoK'.format(name), data=np.zeros(len(line_table))))
-
     vcen = velo_guesses.guesses[name]
 
+    for sp in spectra:
+        spectrum_arrays.append((sp.xarr.as_unit(u.GHz).value,
+                                np.ma.filled(sp.data.astype('float'), np.nan)))
+        spectrum_errors.append(err)
+        spectrum_vcens.append(vcen)
+        spectrum_beams.append(radio_beam.Beam.from_fits_header(sp.header))
+        spectrum_cores.append(len(core_names))
+    core_names.append(name)
+
+line_frequencies = np.array(line_table['Freq-GHz'], dtype='float')
+
+# fit all windows of all cores at once:
+# vheightgaussian, guesses=[0.0, 0.1, vcen, 2],
+# limits=[(-0.1,0.1), (-5,5), (vcen-2.5, vcen+2.5), (0,5)]
+linefits = batch_linefit.fit_windows(spectrum_arrays, spectrum_errors,
+                                     line_frequencies, spectrum_vcens,
+                                     halfwidth=15.)
+
+amp, cen, wid = linefits['params'][:,1], linefits['params'][:,2], linefits['params'][:,3]
+eamp, ecen, ewid = linefits['errors'][:,1], linefits['errors'][:,2], linefits['errors'][:,3]
+accepted = ((amp > eamp*3) & (wid > ewid*3) &
+            (amp > -5) & (amp < 5) &
+            (wid > 0) & (wid < 5))
+fit_core = np.array(spectrum_cores)[linefits['spectrum']]
+
+# preallocate the whole result table
+ncores = len(core_names)
+results = {key: np.zeros([ncores, len(line_table)])
+           for key in ('FittedAmplitude', 'FittedCenter', 'FittedWidth',
+                       'FittedAmplitudeError', 'FittedCenterError',
+                       'FittedWidthError', 'JtoK')}
+for kk in np.flatnonzero(accepted):
+    cc, jj = fit_core[kk], linefits['line'][kk]
+    results['FittedAmplitude'][cc,jj] = amp[kk]
+    results['FittedCenter'][cc,jj] = cen[kk]
+    results['FittedWidth'][cc,jj] = wid[kk]
+    results['FittedAmplitudeError'][cc,jj] = eamp[kk]
+    results['FittedCenterError'][cc,jj] = ecen[kk]
+    results['FittedWidthError'][cc,jj] = ewid[kk]
+    window_freq = line_frequencies[jj] * (1-np.median(linefits['velo'][kk][linefits['weights'][kk] > 0])/batch_linefit.ckms)
+    results['JtoK'][cc,jj] = spectrum_beams[linefits['spectrum'][kk]].jtok(window_freq*u.GHz).value
+
+line_table.add_columns([table.Column(name='{0}{1}'.format(name, key),
+                                     data=results[key][cc])
+                        for cc, name in enumerate(core_names)
+                        for key in ('FittedAmplitude', 'FittedCenter',
+                                    'FittedWidth', 'FittedAmplitudeError',
+                                    'FittedCenterError', 'FittedWidthError',
+                                    'JtoK')])
+
+for cc, name in enumerate(core_names):
+
     plotnum = 1
 
     pl.figure(1).clf()
 
-    debug_fitted_lines = []
-
-    for ii,line_row in enumerate(ProgressBar(line_table)):
-
-        frq = line_row['Freq-GHz'] * u.GHz
-
+    core_fits = np.flatnonzero(accepted & (fit_core == cc))
+    for kk in core_fits[np.argsort(linefits['line'][core_fits], kind='mergesort')]:
+        line_row = line_table[linefits['line'][kk]]
         linename = line_row['Species'] + line_row['Resolved QNs']
-
-        # check if line in range
-        for sp in spectra:
-            sp.xarr.convert_to_unit(u.GHz)
-            beam = radio_beam.Beam.from_fits_header(sp.header)
-            if sp.xarr.in_range(frq):
-
-
-                # not needed!
-                #sp.xarr.convert_to_unit(u.km/u.s, refX=frq)
-                assert sp.xarr.unit == u.GHz
-                sp.xarr.refX = frq
-
-                # crop
-                sp_sl = sp.slice((vcen-15)*u.km/u.s, (vcen+15)*u.km/u.s, unit=u.km/u.s)
-
-                if not np.any(np.isfinite(sp_sl.data)):
-                    continue
-                print(name, linename, plotnum)
-
-                # convert original back
-                # not needed! sp.xarr.convert_to_unit(u.GHz)
-
-                # make sure we're in km/s
-                sp_sl.xarr.convert_to_unit(u.km/u.s, refX=frq)
-                # guess at the errors
-                sp_sl.error[:] = err
-
-                # perform fit
-                sp_sl.specfit(fittype='vheightgaussian',
-                              guesses=[0.0, 0.1, vcen, 2],
-                              fixed=[False,False,False,False], # use a fixed baseline
-                              limited=[(True,True)]*4,
-                              limits=[(-0.1,0.1), (-5,5), (vcen-2.5, vcen+2.5), (0,5)],
-                             )
-
-                if (((sp_sl.specfit.parinfo['AMPLITUDE0'].value) >
-                     (sp_sl.specfit.parinfo['AMPLITUDE0'].error*3)) and
-                    (sp_sl.specfit.parinfo['WIDTH0'].value >
-                     (sp_sl.specfit.parinfo['WIDTH0'].error*3)) and
-                    ((sp_sl.specfit.parinfo['AMPLITUDE0'].value) > -5
-                     and
-                     (sp_sl.specfit.parinfo['AMPLITUDE0'].value) < 5
-                    ) and
-                    ((sp_sl.specfit.parinfo['WIDTH0'].value) > 0
-                     and
-                     (sp_sl.specfit.parinfo['WIDTH0'].value) < 5
-                    )
-                   ):
-
-                    if plotnum <= 49:
-                        sp_sl.plotter(axis=pl.subplot(7,7,plotnum))
-                        plotnum += 1
-                        sp_sl.specfit.plot_fit(annotate=False)
-                        sp_sl.plotter.axis.set_ylabel('')
-                        sp_sl.plotter.axis.set_xlabel('')
-                        sp_sl.plotter.axis.annotate(linename, (0.05, 0.85), xycoords='axes fraction')
-                    else:
-                        print("Skipping line because too many plots")
-
-                    # write fit to table
-                    line_row['{0}FittedAmplitude'.format(name)] = sp_sl.specfit.parinfo['AMPLITUDE0'].value
-                    line_row['{0}FittedCenter'.format(name)] = sp_sl.specfit.parinfo['SHIFT0'].value
-                    line_row['{0}FittedWidth'.format(name)] = sp_sl.specfit.parinfo['WIDTH0'].value
-                    line_row['{0}FittedAmplitudeError'.format(name)] = sp_sl.specfit.parinfo['AMPLITUDE0'].error
-                    line_row['{0}FittedCenterError'.format(name)] = sp_sl.specfit.parinfo['SHIFT0'].error
-                    line_row['{0}FittedWidthError'.format(name)] = sp_sl.specfit.parinfo['WIDTH0'].error
-                    jtok = beam.jtok(np.median(sp_sl.xarr.as_unit(u.GHz)))
-                    line_row['{0}JtoK'.format(name)] = jtok.value
+        if plotnum <= 49:
+            print(name, linename, plotnum)
+            ax = pl.subplot(7,7,plotnum)
+            plotnum += 1
+            good = linefits['weights'][kk] > 0
+            velo = linefits['velo'][kk][good]
+            ax.plot(velo, linefits['data'][kk][good], 'k', drawstyle='steps-mid')
+            model, jac = batch_linefit.vheight_gaussian(linefits['params'][kk:kk+1],
+                                                        velo[None,:])
+            ax.plot(velo, model[0], 'r')
+            ax.annotate(linename, (0.05, 0.85), xycoords='axes fraction')
+        else:
+            print("Skipping line because too many plots")
 
     ymin = 0
     ymax = 0
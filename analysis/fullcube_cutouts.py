@@ -5,7 +5,7 @@ from astropy import units as u
 from astropy import coordinates
 from spectral_cube import SpectralCube
 import pyregion
-import glob
+from fits_index import default_index
 
 try:
     import paths
@@ -22,7 +22,7 @@ corners = {reg.attr[1]['text']:
           }
 
 for source in ('e2','e8','north','northoutflow'):
-    for cubefn in glob.glob("full*fits"):
+    for cubefn in default_index.glob("full*fits"):
         if 'cutout' in cubefn:
             print("Skipping {0}".format(cubefn))
             continue
@@ -5,11 +5,6 @@ from astropy import units as u
 from astropy import constants
 from astroquery.splatalogue import Splatalogue
 
-try:
-    from .ch3oh_rotational_diagram_maps import nupper_of_kkms
-except (SystemError,ImportError):
-    from ch3oh_rotational_diagram_maps import nupper_of_kkms
-
 
 class LTEModel(object):
     def __init__(self, chemical_name, energy_max=2500,
@@ -37,6 +32,37 @@ class LTEModel(object):
                                           line_strengths=['ls1','ls2','ls3','ls4','ls5'],
                                           line_lists=line_lists,
                                           show_upper_degeneracy=True)
+        slaim_query = Splatalogue.query_lines(1*u.Hz, 10000*u.GHz,
+                                              chemical_name=chemical_name,
+                                              energy_max=energy_max,
+                                              energy_type='eu_k',
+                                              line_lists=['SLAIM'],
+                                              show_upper_degeneracy=True)
+        self._set_catalogs(linecat, slaim_query, freq_type=freq_type)
+
+    @classmethod
+    def from_catalogs(cls, linecat, slaim, molwt, freq_type='Freq-GHz'):
+        """
+        Build a model from already-queried Splatalogue tables (e.g. cached
+        ones, or synthetic ones for the benchmarks) without going online
+
+        Parameters
+        ----------
+        linecat : `~astropy.table.Table`
+            The lines to model, with the columns of
+            ``Splatalogue.query_lines(..., show_upper_degeneracy=True)``
+        slaim : `~astropy.table.Table`
+            The full SLAIM line list of the molecule, used for the partition
+            function
+        molwt : int
+            The molecular weight in Da
+        """
+        self = cls.__new__(cls)
+        self.molwt = molwt
+        self._set_catalogs(linecat, slaim, freq_type=freq_type)
+        return self
+
+    def _set_catalogs(self, linecat, slaim_query, freq_type='Freq-GHz'):
         self.linecat = linecat
         self.freqs = np.array(linecat[freq_type])*u.GHz
         self.aij = linecat['Log<sub>10</sub> (A<sub>ij</sub>)']
@@ -48,12 +74,6 @@ class LTEModel(object):
         #if 'OSU' in line_lists:
         #    self.EU = (np.array(linecat['E_L (K)'])*u.K*constants.k_B).to(u.erg).value
 
-        slaim_query = Splatalogue.query_lines(1*u.Hz, 10000*u.GHz,
-                                              chemical_name=chemical_name,
-                                              energy_max=energy_max,
-                                              energy_type='eu_k',
-                                              line_lists=['SLAIM'],
-                                              show_upper_degeneracy=True)
         self.slaim = slaim_query
         self.all_EU = (slaim_query['E_U (K)']*u.K*constants.k_B).to(u.erg).value
         self.all_freq = slaim_query['Freq-GHz']
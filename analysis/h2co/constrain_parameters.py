@@ -16,6 +16,7 @@ import pylab as pl
 import matplotlib
 
 from h2co_modeling import grid_fitter
+from stage_timing import stage, staged
 from .paraH2COmodel import generic_paraH2COmodel
 
 short_mapping = {'dens': 'density',
@@ -33,10 +34,28 @@ chi2_mapping = {'X': 'Abundance',
 
 class paraH2COmodel(generic_paraH2COmodel):
 
-    def __init__(self, tbackground=2.73, gridsize=[250.,101.,100.]):
+    @staged('paraH2COmodel', kind='compute')
+    def __init__(self, tbackground=2.73, gridsize=[250.,101.,100.],
+                 grids=None):
+        """
+        Parameters
+        ----------
+        grids : dict, optional
+            ``texgrid303, taugrid303, texgrid321, taugrid321, texgrid322,
+            taugrid322`` and their ``hdr``, in place of the RADEX grids loaded
+            by `pyspeckit_fitting` (e.g. synthetic grids for benchmarking)
+        """
         t0 = time.time()
-        from .pyspeckit_fitting import (texgrid303, taugrid303, texgrid321, taugrid321,
-                                        texgrid322, taugrid322, hdr)
+        if grids is None:
+            with stage('load_grids', kind='io'):
+                from .pyspeckit_fitting import (texgrid303, taugrid303,
+                                                texgrid321, taugrid321,
+                                                texgrid322, taugrid322, hdr)
+        else:
+            texgrid303, taugrid303 = grids['texgrid303'], grids['taugrid303']
+            texgrid321, taugrid321 = grids['texgrid321'], grids['taugrid321']
+            texgrid322, taugrid322 = grids['texgrid322'], grids['taugrid322']
+            hdr = grids['hdr']
         # The grid was computed with a linewidth (or gradient) 5 km/s/pc
         self.grid_linewidth = 5.0
         t1 = time.time()
@@ -145,6 +164,7 @@ class paraH2COmodel(generic_paraH2COmodel):
 
         self.set_constraints(**pars)
 
+    @staged(kind='fit', aggregate=True)
     def set_constraints(self,
                         taline303=None, etaline303=None,
                         taline321=None, etaline321=None,
@@ -239,6 +259,7 @@ class paraH2COmodel(generic_paraH2COmodel):
                      self.chi2_intensity)
 
 
+    @staged(kind='plot')
     def parplot(self, par1='col', par2='dens', nlevs=5, levels=None,
                 colors=[(0.5,0,0), (0.75,0,0), (1.0,0,0), (1.0,0.25,0), (0.75,0.5,0)],
                 colorsf=[0.0, 0.33, 0.66, 1.0, 'w']):
@@ -368,6 +389,7 @@ class paraH2COmodel(generic_paraH2COmodel):
 
         pl.subplots_adjust(wspace=0.25, hspace=0.45)
 
+    @staged(kind='plot')
     def parplot1d(self, par='col', levels=None, clf=True,
                   legend=True, legendfontsize=14):
 
@@ -437,6 +459,7 @@ class paraH2COmodel(generic_paraH2COmodel):
         ax.set_xlabel(xlabel)
         ax.set_ylabel('$P(${0}$)$'.format(xlabel))
 
+    @staged(kind='plot')
     def parplot1d_all(self, legendfontsize=14, **kwargs):
 
         fig = pl.gcf()
@@ -9,6 +9,7 @@ from astropy import log
 from scipy import stats
 
 from h2co_modeling import grid_fitter
+from stage_timing import staged
 
 class generic_paraH2COmodel(object):
     def grid_getmatch_321to303(self, ratio, eratio, chi2_thresh=1):
@@ -112,6 +113,7 @@ class generic_paraH2COmodel(object):
         return chi2X
 
 
+    @staged(kind='fit', aggregate=True)
     def get_parconstraints(self,
                            nsigma=1):
         """
@@ -0,0 +1 @@
+../stage_timing.py
\ No newline at end of file
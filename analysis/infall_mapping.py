@@ -0,0 +1,406 @@
+"""
+Hill5 infall fits of every spaxel of a cube or of many extracted spectra.
+
+The de Vries & Myers (2005) ``hill5`` model of pyspeckit
+(``pyspeckit.spectrum.models.hill5infall``) is evaluated for all spectra at
+once with an analytic Jacobian and fitted with `batch_lm.batch_levmar`.
+The continuum of each spectrum is a linear baseline fitted to line-free
+velocity ranges; the velocity and width guesses come from the first and
+second moments of the continuum-subtracted spectrum in the fit window.
+The infall velocity and the core optical depth are nearly degenerate with
+the width and peak temperature, so every spectrum is fitted from a few
+(tau, v_infall) starting points and the best fit is kept.  Spectra are
+fitted in blocks distributed over a process pool, and the results are
+written as parameter / error cubes in pyspeckit's ``write_fit``
+layout (readable with ``pyspeckit.Cube.load_model_fit``) or as a table.
+"""
+import multiprocessing
+import numpy as np
+from astropy import units as u
+from astropy import constants
+from astropy.table import Table, Column
+
+import batch_lm
+from batch_lm import batch_levmar
+
+parnames = ['tau', 'v_lsr', 'v_infall', 'sigma', 'tpeak']
+# the guesses used for the hand-fitted CH3OH radial-bin spectra
+default_guesses = [0.3, 56.5, 3.63, 2.048, 100]
+# (tau, v_infall) starting points of every fit
+default_starts = [(0.3, 0.5), (0.3, 1.5), (0.3, 3.63), (2, 0.5), (2, 1.5)]
+
+hplanck = constants.h.cgs.value
+kboltz = constants.k_B.cgs.value
+
+
+def jfunc(temperature, frequency):
+    """
+    Radiation temperature J_nu(T) (K) at ``frequency`` (Hz), and dJ/dT
+    """
+    t0 = hplanck*frequency/kboltz
+    ex = np.exp(t0/temperature)
+    jnu = t0/(ex-1)
+    return jnu, t0**2*ex/(temperature*(ex-1))**2
+
+
+def _escape(tau):
+    """
+    (1-exp(-tau))/tau and its derivative (series expansions at small tau)
+    """
+    small = tau < 1e-4
+    safe = np.where(small, 1, tau)
+    esc = np.where(small, 1 - tau/2. + tau**2/6., -np.expm1(-safe)/safe)
+    desc = np.where(small, -0.5 + tau/3., (np.exp(-safe)*(safe+1) - 1)/safe**2)
+    return esc, desc
+
+
+def hill5(params, xdata, tbg=2.73):
+    """
+    Batched ``hill5_model`` and its Jacobian
+
+    Parameters
+    ----------
+    params : np.ndarray
+        [nfits, 5] tau, v_lsr, v_infall, sigma, tpeak
+    xdata : np.ndarray
+        [nfits, 2, nchan] velocity (km/s) and frequency (Hz) of each channel
+
+    Returns
+    -------
+    model : np.ndarray
+        [nfits, nchan]
+    jac : np.ndarray
+        [nfits, nchan, 5]
+    """
+    velo, frequency = xdata[:, 0], xdata[:, 1]
+    tau, vlsr, vin, sigma, tpeak = [params[:, ii, None] for ii in range(5)]
+
+    dvf = velo - (vlsr + vin)
+    dvr = velo - (vlsr - vin)
+    gaussf = np.exp(-(dvf/sigma)**2/2.)
+    gaussr = np.exp(-(dvr/sigma)**2/2.)
+    tauf, taur = tau*gaussf, tau*gaussr
+    escf, descf = _escape(tauf)
+    escr, descr = _escape(taur)
+    extf = np.exp(-tauf)
+
+    jpeak, djpeak = jfunc(tpeak, frequency)
+    jbg = jfunc(tbg, frequency)[0]
+    amp = jpeak - jbg
+    shape = escf - extf*escr
+    model = amp*shape
+
+    # derivatives of the profile with respect to the front and rear depths
+    dshape_f = descf + extf*escr
+    dshape_r = -extf*descr
+    jac = np.empty(model.shape + (5,))
+    jac[:, :, 0] = amp*(dshape_f*gaussf + dshape_r*gaussr)
+    dtf_dv = tauf*dvf/sigma**2
+    dtr_dv = taur*dvr/sigma**2
+    jac[:, :, 1] = amp*(dshape_f*dtf_dv + dshape_r*dtr_dv)
+    jac[:, :, 2] = amp*(dshape_f*dtf_dv - dshape_r*dtr_dv)
+    jac[:, :, 3] = amp*(dshape_f*tauf*dvf**2 + dshape_r*taur*dvr**2)/sigma**3
+    jac[:, :, 4] = djpeak*shape
+    return model, jac
+
+
+def _in_ranges(velo, ranges):
+    include = np.zeros(velo.shape, dtype='bool')
+    for vlo, vhi in ranges:
+        include |= (velo >= vlo) & (velo <= vhi)
+    return include
+
+
+def linear_baselines(velo, spectra, line_free):
+    """
+    Least-squares linear baselines of many spectra over line-free ranges
+
+    Parameters
+    ----------
+    velo : np.ndarray
+        [nspec, nchan] velocities
+    spectra : np.ndarray
+        [nspec, nchan]
+    line_free : list
+        (vmin, vmax) velocity ranges used for the baseline
+
+    Returns
+    -------
+    baseline : np.ndarray
+        [nspec, nchan]
+    rms : np.ndarray
+        [nspec] rms of the baseline residuals
+    """
+    include = _in_ranges(velo, line_free) & np.isfinite(spectra)
+    ww = include.astype('float')
+    yy = np.where(include, spectra, 0)
+    n = ww.sum(axis=1)
+    sx, sy = (ww*velo).sum(axis=1), yy.sum(axis=1)
+    sxx, sxy = (ww*velo**2).sum(axis=1), (yy*velo).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        det = n*sxx - sx**2
+        slope = np.where(det > 0, (n*sxy - sx*sy)/det, 0)
+        offset = (sy - slope*sx)/n
+        baseline = offset[:, None] + slope[:, None]*velo
+        rms = (((yy - baseline)*ww)**2).sum(axis=1)**0.5 / np.maximum(n-2, 1)**0.5
+    return baseline, rms
+
+
+def moment_guesses(velo, spectra, vrange, guesses=default_guesses):
+    """
+    [nspec, 5] guesses: v_lsr and sigma from the moments of the positive
+    emission in ``vrange``, tpeak from the peak, the rest from ``guesses``
+    """
+    inwindow = (velo >= vrange[0]) & (velo <= vrange[1]) & np.isfinite(spectra)
+    weight = np.where(inwindow, np.clip(spectra, 0, None), 0)
+    total = weight.sum(axis=1)
+    params = np.tile(np.array(guesses, dtype='float'), (spectra.shape[0], 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mom1 = (weight*velo).sum(axis=1)/total
+        mom2 = ((weight*(velo-mom1[:, None])**2).sum(axis=1)/total)**0.5
+    peak = np.where(inwindow, spectra, -np.inf).max(axis=1)
+    ok = (total > 0) & np.isfinite(mom1) & np.isfinite(mom2)
+    params[ok, 1] = mom1[ok]
+    params[ok, 3] = np.clip(mom2[ok], 0.5, 10)
+    params[ok, 4] = np.clip(peak[ok]/(-np.expm1(-guesses[0])), 10, None)
+    return params
+
+
+def _fit_block(args):
+    return batch_levmar(hill5, *args)
+
+
+def fit_hill5(velo, frequency, spectra, errors, line_free, vrange=(48, 63.5),
+              guesses=default_guesses, starts=default_starts,
+              lower=(0, -np.inf, 0, 0.05, 3), upper=(np.inf,)*5, maxiter=200,
+              blocksize=256, nprocs=None):
+    """
+    Fit the Hill5 model to many spectra
+
+    Parameters
+    ----------
+    velo, frequency : np.ndarray
+        [nspec, nchan] (or [nchan]) velocity (km/s) and frequency (Hz) axes
+    spectra : np.ndarray
+        [nspec, nchan] brightness temperature (K), continuum included
+    errors : np.ndarray or None
+        [nspec] noise per spectrum; the baseline rms if None
+    line_free : list
+        Velocity ranges of the continuum baseline
+    vrange : tuple
+        Velocity range fitted (as ``specfit.selectregion``)
+    starts : list
+        (tau, v_infall) starting points; the lowest chi^2 fit is kept
+    blocksize : int
+        Number of spectra per worker job
+
+    Returns
+    -------
+    params, perrors : np.ndarray
+        [nspec, 5] parameters and errors (NaN for unfittable spectra)
+    chi2 : np.ndarray
+        [nspec]
+    """
+    spectra = np.asarray(spectra, dtype='float')
+    nspec, nchan = spectra.shape
+    velo = np.broadcast_to(velo, spectra.shape)
+    frequency = np.broadcast_to(frequency, spectra.shape)
+
+    baseline, rms = linear_baselines(velo, spectra, line_free)
+    spectra = spectra - baseline
+    if errors is None:
+        errors = rms
+    errors = np.broadcast_to(errors, (nspec,))
+    guess = moment_guesses(velo, spectra, vrange, guesses=guesses)
+
+    fitme = (vrange[0] <= velo) & (velo <= vrange[1]) & np.isfinite(spectra)
+    good = fitme.any(axis=1) & np.isfinite(errors) & (errors > 0)
+    weights = np.where(fitme, 1, 0) / np.where(good, errors, 1)[:, None]**2
+    xdata = np.array([velo, frequency]).transpose(1, 0, 2)
+    data = np.where(fitme, spectra, 0)
+
+    # one fit per (spectrum, starting point)
+    nstarts = len(starts)
+    guess = np.repeat(guess, nstarts, axis=0)
+    guess[:, [0, 2]] = np.tile(starts, (nspec, 1))
+    guess = np.clip(guess, lower, upper)
+
+    index = np.flatnonzero(np.repeat(good, nstarts))
+    blocks = [index[start:start+blocksize*nstarts]
+              for start in range(0, index.size, blocksize*nstarts)]
+    jobs = [(guess[bb], xdata[bb//nstarts], data[bb//nstarts],
+             weights[bb//nstarts], np.array(lower), np.array(upper), maxiter)
+            for bb in blocks]
+    nprocs = multiprocessing.cpu_count() if nprocs is None else nprocs
+    if nprocs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nprocs, len(jobs)))
+        try:
+            results = pool.map(_fit_block, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_fit_block(job) for job in jobs]
+
+    params = np.full([nspec*nstarts, 5], np.nan)
+    perrors = np.full([nspec*nstarts, 5], np.nan)
+    chi2 = np.full(nspec*nstarts, np.inf)
+    for bb, (pars, errs, chisq, niter) in zip(blocks, results):
+        params[bb], perrors[bb], chi2[bb] = pars, errs, chisq
+
+    best = chi2.reshape(nspec, nstarts).argmin(axis=1) + np.arange(nspec)*nstarts
+    chi2 = chi2[best]
+    chi2[~good] = np.nan
+    return params[best], perrors[best], chi2
+
+
+def fit_hill5_cube(cube, restfreq, line_free, vrange=(48, 63.5), mask=None,
+                   **kwargs):
+    """
+    Hill5 fits of every spaxel of a cube
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+        Cutout cube (Jy/beam or K)
+    restfreq : `~astropy.units.Quantity`
+        Rest frequency of the line
+    mask : np.ndarray, optional
+        [ny, nx] spaxels to fit
+
+    Returns
+    -------
+    parcube, errcube : np.ndarray
+        [5, ny, nx]
+    chi2 : np.ndarray
+        [ny, nx]
+    """
+    vcube = cube.with_spectral_unit(u.km/u.s, velocity_convention='radio',
+                                    rest_value=restfreq)
+    if vcube.unit != u.K:
+        vcube = vcube.to(u.K, u.brightness_temperature(vcube.beam, restfreq))
+    velo = vcube.spectral_axis.to(u.km/u.s).value
+    frequency = (restfreq*(1-velo/constants.c.to(u.km/u.s).value)).to(u.Hz).value
+
+    data = vcube.filled_data[:].value
+    nchan, ny, nx = data.shape
+    if mask is None:
+        mask = np.any(np.isfinite(data), axis=0)
+    params, perrors, chi2 = fit_hill5(velo, frequency, data[:, mask].T, None,
+                                      line_free, vrange=vrange, **kwargs)
+
+    parcube = np.full([5, ny, nx], np.nan)
+    errcube = np.full([5, ny, nx], np.nan)
+    chi2map = np.full([ny, nx], np.nan)
+    parcube[:, mask] = params.T
+    errcube[:, mask] = perrors.T
+    chi2map[mask] = chi2
+    return parcube, errcube, chi2map
+
+
+def fit_hill5_spectra(spectra, line_free, vrange=(48, 63.5), names=None,
+                      **kwargs):
+    """
+    Hill5 fits of a list of extracted spectra
+
+    Parameters
+    ----------
+    spectra : list
+        (velocity [km/s], frequency [Hz], brightness temperature [K]) array
+        triples; axes may differ in length (shorter spectra are padded)
+
+    Returns
+    -------
+    table : `~astropy.table.Table`
+        Parameters, errors and chi^2 of each spectrum
+    """
+    nchan = max(len(sp[0]) for sp in spectra)
+    velo = np.zeros([len(spectra), nchan])
+    frequency = np.ones([len(spectra), nchan])
+    data = np.full([len(spectra), nchan], np.nan)
+    for ii, (vv, ff, dd) in enumerate(spectra):
+        velo[ii, :len(vv)], frequency[ii, :len(ff)], data[ii, :len(dd)] = vv, ff, dd
+        # padding: far outside the fit window, blank
+        velo[ii, len(vv):] = -1e5
+        frequency[ii, len(ff):] = ff[-1]
+
+    params, perrors, chi2 = fit_hill5(velo, frequency, data, None, line_free,
+                                      vrange=vrange, **kwargs)
+    columns = [Column(name='name', data=(names if names is not None
+                                         else np.arange(len(spectra))))]
+    units = [None, u.km/u.s, u.km/u.s, u.km/u.s, u.K]
+    for ii, (parname, unit) in enumerate(zip(parnames, units)):
+        columns.append(Column(name=parname, data=params[:, ii], unit=unit))
+        columns.append(Column(name='e'+parname, data=perrors[:, ii], unit=unit))
+    columns.append(Column(name='chi2', data=chi2))
+    return Table(columns)
+
+
+def load_spectrum(filename, restfreq):
+    """
+    A radial-bin spectrum as a `pyspeckit.Spectrum` in K vs. radio velocity
+    """
+    import pyspeckit
+    import radio_beam
+    sp = pyspeckit.Spectrum(filename)
+    sp.xarr.refX = restfreq
+    sp.xarr.convert_to_unit(u.km/u.s)
+    sp.data = sp.data_quantity.to(u.K,
+                                  u.brightness_temperature(radio_beam.Beam.from_fits_header(sp.header),
+                                                           sp.xarr.to(u.GHz))).value
+    # hack =(
+    sp.data = np.ma.masked_where(np.isnan(sp.data), sp.data)
+    sp.unit = u.K
+    return sp
+
+
+def spectrum_arrays(sp, restfreq):
+    """
+    (velocity, frequency, data) arrays of a `load_spectrum` spectrum, as
+    used by `fit_hill5_spectra`
+    """
+    velo = sp.xarr.value
+    frequency = (restfreq*(1-velo/constants.c.to(u.km/u.s).value)).to(u.Hz).value
+    return velo, frequency, np.ma.filled(sp.data.astype('float'), np.nan)
+
+
+def fit_spectrum(filename, restfreq, baseline, vrange=(48, 63.5),
+                 guesses=default_guesses):
+    """
+    Interactive pyspeckit Hill5 fit of one spectrum
+
+    Parameters
+    ----------
+    baseline : float or list
+        A constant continuum level, or the line-free velocity ranges of a
+        first-order baseline
+    """
+    import pyspeckit
+    sp = load_spectrum(filename, restfreq)
+    sp.plotter(xmin=20, xmax=110, reset_ylimits=True)
+    if np.isscalar(baseline):
+        sp.baseline.basespec[:] = baseline
+        sp.baseline.baselinepars = [0, baseline]
+    else:
+        exclude = [-100000] + [v for vr in baseline for v in vr] + [100000]
+        # Hack - xarr is backwards
+        sp.baseline.selectregion(exclude=exclude[::-1])
+        sp.baseline.highlight_fitregion()
+        sp.baseline(order=1, subtract=False, plot=True, reset_selection=False,
+                    selectregion=False, fit_plotted_area=False,
+                    highlight_fitregion=True)
+
+    sp.specfit.selectregion(xmin=vrange[0], xmax=vrange[1])
+    sp.specfit.register_fitter('hill5', pyspeckit.spectrum.models.hill5infall.hill5_fitter, 5)
+    sp.specfit(fittype='hill5', guesses=guesses, fixed=[False]*5,
+               reset_selection=False)
+    return sp
+
+
+def write_fit(filename, parcube, errcube, header, fittype='hill5',
+              overwrite=True):
+    """
+    `batch_lm.write_fit` with the Hill5 parameter names
+    """
+    batch_lm.write_fit(filename, parcube, errcube, header, parnames, fittype,
+                       overwrite=overwrite)
@@ -1,102 +1,64 @@
 import numpy as np
 from astropy import units as u
-import pyspeckit
-import radio_beam
+from astropy.table import vstack, Column
+from spectral_cube import SpectralCube
 import paths
 
-F = False
-T = True
-
-
-sp = pyspeckit.Spectrum(paths.spath('north_radial_bin_0.00to0.38_spw1.fits'))
-# CH3OH 8-7
-sp.xarr.refX=220.07849*u.GHz
-sp.xarr.convert_to_unit(u.km/u.s)
-sp.data = sp.data_quantity.to(u.K,
-                              u.brightness_temperature(radio_beam.Beam.from_fits_header(sp.header),
-                                                       sp.xarr.to(u.GHz))).value
-# hack =(
-sp.data = np.ma.masked_where(np.isnan(sp.data), sp.data)
-sp.unit = u.K
-
-sp.plotter(xmin=20,xmax=110, reset_ylimits=True)
-# Hack - xarr is backwards
-sp.baseline.selectregion(exclude=[-100000,37,43,96,103,100000][::-1])
-sp.baseline.highlight_fitregion()
-sp.baseline(order=1, subtract=False, plot=True, reset_selection=False,
-            selectregion=False, fit_plotted_area=False,
-            highlight_fitregion=True)
-
-sp.specfit.selectregion(xmin=48, xmax=63.5)
-sp.specfit.register_fitter('hill5', pyspeckit.spectrum.models.hill5infall.hill5_fitter, 5)
-sp.specfit(fittype='hill5', guesses=[0.3, 56.5, 3.63, 2.048, 100],
-           fixed=[F,F,F,F,F], reset_selection=False)
-
-
-
-sp = pyspeckit.Spectrum(paths.spath('north_radial_bin_0.00to0.38_spw0.fits'))
-# CH3OH 4-3
-sp.xarr.refX= 218.44005 * u.GHz
-sp.xarr.convert_to_unit(u.km/u.s)
-sp.data = sp.data_quantity.to(u.K,
-                              u.brightness_temperature(radio_beam.Beam.from_fits_header(sp.header),
-                                                       sp.xarr.to(u.GHz))).value
-# hack =(
-sp.data = np.ma.masked_where(np.isnan(sp.data), sp.data)
-sp.unit = u.K
-
-sp.plotter(xmin=20,xmax=110, reset_ylimits=True)
-sp.baseline.basespec[:]=78
-sp.baseline.baselinepars=[0,78]
-#sp.baseline.plot_baseline()
-
-sp.specfit.selectregion(xmin=48, xmax=63.5)
-sp.specfit.register_fitter('hill5', pyspeckit.spectrum.models.hill5infall.hill5_fitter, 5)
-sp.specfit(fittype='hill5', guesses=[0.3, 56.5, 3.63, 2.048, 100],
-           fixed=[F,F,F,F,F], reset_selection=False)
-
-
-sp = pyspeckit.Spectrum(paths.spath('north_radial_bin_0.00to0.38_spw2.fits'))
-# CH3OH 10-9
-sp.xarr.refX= 231.28115 * u.GHz
-sp.xarr.convert_to_unit(u.km/u.s)
-sp.data = sp.data_quantity.to(u.K,
-                              u.brightness_temperature(radio_beam.Beam.from_fits_header(sp.header),
-                                                       sp.xarr.to(u.GHz))).value
-# hack =(
-sp.data = np.ma.masked_where(np.isnan(sp.data), sp.data)
-sp.unit = u.K
-
-sp.plotter(xmin=20,xmax=110, reset_ylimits=True)
-sp.baseline.basespec[:]=82
-sp.baseline.baselinepars=[0,82]
-#sp.baseline.plot_baseline()
-
-sp.specfit.selectregion(xmin=48, xmax=63.5)
-sp.specfit.register_fitter('hill5', pyspeckit.spectrum.models.hill5infall.hill5_fitter, 5)
-sp.specfit(fittype='hill5', guesses=[0.3, 56.5, 3.63, 2.048, 100],
-           fixed=[F,F,F,F,F], reset_selection=False)
-
-
-
-sp = pyspeckit.Spectrum(paths.spath('north_radial_bin_0.00to0.38_spw3.fits'))
-# CH3OH 18-17
-sp.xarr.refX= 233.79580 * u.GHz
-sp.xarr.convert_to_unit(u.km/u.s)
-sp.data = sp.data_quantity.to(u.K,
-                              u.brightness_temperature(radio_beam.Beam.from_fits_header(sp.header),
-                                                       sp.xarr.to(u.GHz))).value
-# hack =(
-sp.data = np.ma.masked_where(np.isnan(sp.data), sp.data)
-sp.unit = u.K
-
-sp.plotter(xmin=20,xmax=110, reset_ylimits=True)
-sp.baseline.basespec[:]=91
-sp.baseline.baselinepars=[0,91]
-#sp.baseline.plot_baseline()
-
-sp.specfit.selectregion(xmin=48, xmax=63.5)
-sp.specfit.register_fitter('hill5', pyspeckit.spectrum.models.hill5infall.hill5_fitter, 5)
-sp.specfit(fittype='hill5', guesses=[0.3, 56.5, 3.63, 2.048, 100],
-           fixed=[F,F,F,F,F], reset_selection=False)
-
+import infall_mapping
+from infall_mapping import fit_spectrum, load_spectrum, spectrum_arrays
+
+sourcename, pfx = 'north', 'north'
+
+# CH3OH line of each spw and the continuum of its hand fit: a constant level
+# or the line-free ranges of a first-order baseline
+line_free = [(37, 43), (96, 103)]
+tracers = {1: ('8-7', 220.07849*u.GHz, line_free),
+           0: ('4-3', 218.44005*u.GHz, 78),
+           2: ('10-9', 231.28115*u.GHz, 82),
+           3: ('18-17', 233.79580*u.GHz, 91),
+          }
+vrange = (48, 63.5)
+
+# single-spectrum fits of the innermost radial bin
+for spw, (transition, restfreq, baseline) in tracers.items():
+    sp = fit_spectrum(paths.spath('{0}_radial_bin_0.00to0.38_spw{1}.fits'
+                                  .format(pfx, spw)),
+                      restfreq, baseline, vrange=vrange)
+
+
+mapping = True
+if mapping:
+    # batched fits of all radial bins and of every spaxel of the cutout cubes
+    # (per-spectrum linear baselines over the line-free ranges)
+    bins_ends_arcsec = np.linspace(0,2.25,7)
+    bins_arcsec = list(zip(bins_ends_arcsec[:-1], bins_ends_arcsec[1:]))
+
+    tables = []
+    for spw, (transition, restfreq, baseline) in tracers.items():
+        spectra = [spectrum_arrays(load_spectrum(paths.spath('{0}_radial_bin_{1:0.2f}to{2:0.2f}_spw{3}.fits'
+                                                            .format(pfx, inner, outer, spw)),
+                                                 restfreq),
+                                   restfreq)
+                   for inner, outer in bins_arcsec]
+        tbl = infall_mapping.fit_hill5_spectra(spectra, line_free, vrange=vrange,
+                                               names=['{0:0.2f}to{1:0.2f}'.format(*bins)
+                                                      for bins in bins_arcsec])
+        tbl.add_column(Column(name='transition',
+                                  data=['CH3OH {0}'.format(transition)]*len(tbl)),
+                       index=0)
+        tables.append(tbl)
+    vstack(tables).write(paths.tpath('{0}_radial_bin_hill5_fits.ipac'.format(pfx)),
+                         format='ascii.ipac', overwrite=True)
+
+    for spw, (transition, restfreq, baseline) in tracers.items():
+        cube = SpectralCube.read(paths.dpath('12m/fullcube_cutouts/{0}cutout_full_W51_spw{1}_lines.fits'
+                                             .format(sourcename, spw)))
+        cube = cube.with_spectral_unit(u.km/u.s, velocity_convention='radio',
+                                       rest_value=restfreq).spectral_slab(20*u.km/u.s,
+                                                                          110*u.km/u.s)
+        parcube, errcube, chi2map = infall_mapping.fit_hill5_cube(cube, restfreq,
+                                                                  line_free,
+                                                                  vrange=vrange)
+        infall_mapping.write_fit(paths.dpath('12m/fullcube_cutouts/{0}cutout_hill5_spw{1}_parcube.fits'
+                                             .format(sourcename, spw)),
+                                 parcube, errcube, cube.wcs.celestial.to_header())
@@ -13,8 +13,8 @@ from astropy.convolution import convolve, Gaussian2DKernel
 import pylab as pl
 import itertools
 import masscalc
-import dust_emissivity
-import reproject
+import dust_kernels
+import reprojection_cache
 
 # ratio of the radius of a sphere over the FWHM of a gaussian with the same area
 gaussian_fwhm_to_sphere_r = ( (2*np.pi / (8 * np.log(2)))**1.5 /
@@ -22,6 +22,75 @@ gaussian_fwhm_to_sphere_r = ( (2*np.pi / (8 * np.log(2)))**1.5 /
                             )**(1/3.)
 # R_sph ~ 0.66 FWHM
 
+# cgs constants for the map-level (unitless) calculations
+G_cgs = constants.G.cgs.value
+kB_cgs = constants.k_B.cgs.value
+Da_g = u.Da.to(u.g)
+msun_g = u.M_sun.to(u.g)
+au_cm = u.au.to(u.cm)
+
+
+def jeans_quantities(mass, temperature, beam_sigma_cm):
+    """
+    Density, sound speed, Jeans length and Jeans mass maps from dust mass and
+    temperature maps, in one vectorized pass
+
+    Parameters
+    ----------
+    mass : np.ndarray
+        Mass per beam (M_sun)
+    temperature : np.ndarray
+        Temperature (K)
+    beam_sigma_cm : float
+        Gaussian sigma of the (smoothed) beam in cm
+
+    Returns
+    -------
+    maps : dict
+        ``density`` (cm^-3), ``c_s`` (km/s), ``LJ`` (au) and ``MJ`` (M_sun)
+    """
+    # volume of a gaussian: sqrt(2 pi)^N r^N
+    volume = (2*np.pi)**(1.5) * beam_sigma_cm**3
+    density = mass * msun_g / volume / (2.8*Da_g)
+    rho = 2.8*Da_g*density
+    with np.errstate(invalid='ignore', divide='ignore'):
+        c_s = (kB_cgs * temperature / (2.4*Da_g))**0.5
+        LJ = c_s / (G_cgs * rho)**0.5
+        MJ = 4/3. * np.pi * (LJ/2.)**3 * rho
+    return {'density': density,
+            'c_s': c_s/1e5,
+            'LJ': LJ/au_cm,
+            'MJ': MJ/msun_g,
+           }
+
+
+_field = {}
+
+def load_field(sources=('e2', 'e8', 'north')):
+    """
+    The continuum image and the CH3OH temperature maps of ``sources``
+    reprojected (cached) onto its grid, loaded once per session.  Outside the
+    temperature maps the temperature is NaN.
+    """
+    if 'continuum' not in _field:
+        fn = paths.dpath("W51_te_continuum_best.fits")
+        fh = fits.open(fn)
+        continuum = np.squeeze(fh[0].data)
+        mywcs = wcs.WCS(fh[0].header).celestial
+        temperature = np.full(continuum.shape, np.nan)
+        for source in sources:
+            temperature_map_fn = paths.dpath('12m/moments/CH3OH_{0}_cutout_temperaturemap.fits'.format(source))
+            tem, footprint = reprojection_cache.reproject_interp(temperature_map_fn,
+                                                                 mywcs,
+                                                                 shape_out=continuum.shape)
+            ok = (footprint > 0) & np.isfinite(tem)
+            temperature[ok] = tem[ok]
+        _field.update({'continuum': continuum, 'temperature': temperature,
+                       'wcs': mywcs,
+                       'beam': radio_beam.Beam.from_fits_header(fh[0].header)})
+    return _field
+
+
 def jeans_maps(regions, size=u.Quantity([2.25,2.25], u.arcsec), smooth=0):
     names = [r.attr[1]['text'] for r in regions]
     center_positions = coordinates.SkyCoord([r.coord_list
@@ -29,93 +98,67 @@ def jeans_maps(regions, size=u.Quantity([2.25,2.25], u.arcsec), smooth=0):
                                             unit=(u.deg, u.deg),
                                             frame='fk5')
 
-    fn = "W51_te_continuum_best.fits"
-    fh = fits.open(paths.dpath(fn))
-    mywcs = wcs.WCS(fh[0].header)
-    bm = radio_beam.Beam.from_fits_header(fh[0].header)
+    field = load_field()
+    mywcs = field['wcs']
+    bm = field['beam']
     pixscale = (mywcs.pixel_scale_matrix.diagonal()**2).sum()**0.5 * u.deg
     pixscale_cm = (pixscale * masscalc.distance).to(u.cm, u.dimensionless_angles())
     ppbeam = (bm.sr/(pixscale**2)).decompose().value / u.beam
 
+    # geometric average FWHM
+    bm_cm_fwhm = ((bm.major * bm.minor)**0.5 * masscalc.distance).to(u.cm, u.dimensionless_angles())
+    bm_cm = bm_cm_fwhm / (8*np.log(2))**0.5
+
+    # the whole-field mass map: one array operation with the tabulated
+    # conversion factor
+    if 'mass' not in field:
+        field['mass'] = field['continuum'] * dust_kernels.mass_per_jy(field['temperature'])
+
     mass_maps = {}
 
     for ii,(name,position) in enumerate(zip(names, center_positions)):
-        cutout = Cutout2D(fh[0].data, position, size, wcs=mywcs)
-
-        source = 'e2' if name == 'e2e' else name
-
-        temperature_map_fn = paths.dpath('12m/moments/CH3OH_{0}_cutout_temperaturemap.fits'.format(source))
-        temperature_map_fh = fits.open(temperature_map_fn)
-
-        # this whole section is copied from overlay_contours_on_ch3oh
-        #ch3ohN_hdul = fits.open(paths.dpath('12m/moments/CH3OH_{0}_cutout_columnmap.fits'.format(source)))
-        #ch3ohT_hdul = fits.open(paths.dpath('12m/moments/CH3OH_{0}_cutout_temperaturemap.fits'.format(source)))
-        #bigwcs = wcs.WCS(ch3ohT_hdul[0].header)
-        #bigpixscale = (bigwcs.pixel_scale_matrix.diagonal()**2).sum()**0.5 * u.deg
-        #ch3ohN = ch3ohN_hdul[0].data
-        #ch3ohT = ch3ohT_hdul[0].data
-        #dust_brightness,wts = reproject.reproject_interp(fits.open(paths.dpath('W51_te_continuum_best.fits')),
-        #                                                 ch3ohN_hdul[0].header)
-
-        temwcs = wcs.WCS(temperature_map_fh[0].header)
-        temcutout = Cutout2D(temperature_map_fh[0].data, position, size, wcs=temwcs)
-        #maskcutout = Cutout2D(mask.astype('float'), position, size, wcs=bigwcs)
-        tem_pixscale = (temwcs.pixel_scale_matrix.diagonal()**2).sum()**0.5 * u.deg
-        ppbeam_tem = ppbeam * (pixscale/tem_pixscale)**2
-        print("ppbeam, ppbeam_tem: ",ppbeam,ppbeam_tem)
-
-        # geometric average FWHM
-        bm_cm_fwhm = ((bm.major * bm.minor)**0.5 * masscalc.distance).to(u.cm, u.dimensionless_angles())
-        bm_cm = bm_cm_fwhm / (8*np.log(2))**0.5
+        # the regions are only index views into the field maps
+        view = Cutout2D(field['continuum'], position, size, wcs=mywcs,
+                        mode='partial').slices_original
 
         if smooth != 0:
             stddev_pix = ((smooth**2/(8*np.log(2)) - bm_cm**2)**0.5 / pixscale_cm).decompose()
             print('stddev_pix: {0}'.format(stddev_pix.decompose()))
-            kernel = Gaussian2DKernel(stddev_pix)
+            kernel = Gaussian2DKernel(stddev_pix.value)
 
             kernel.normalize('peak')
-            #smdata = convolve(cutout.data / ppbeam, kernel)
-            mass_map = (cutout.data * masscalc.mass_conversion_factor(TK=temcutout.data)).to(u.M_sun)
             # mass_map is the sum over a gaussian 'aperture', but it has to account for the
             # beam to avoid double-counting
             # (this is better than using smooth temperature, since that leads to a huge overestimate)
             new_ppbeam = (2*np.pi*smooth**2/(8*np.log(2)) / pixscale_cm**2).decompose() / u.beam
-            print('new_ppbeam: {0}, ppbeam: {1}, old_ppbeam: {2}'.format(new_ppbeam, ppbeam_tem, 2*np.pi*(bm_cm/pixscale_cm).decompose()**2))
-            mass_map = convolve(mass_map, kernel)*u.M_sun * (ppbeam/new_ppbeam).decompose()
+            print('new_ppbeam: {0}, ppbeam: {1}, old_ppbeam: {2}'.format(new_ppbeam, ppbeam, 2*np.pi*(bm_cm/pixscale_cm).decompose()**2))
+            mass_map = convolve(field['mass'][view], kernel) * (ppbeam/new_ppbeam).decompose().value
 
             # temperature should be the average temperature
             kernel.normalize('integral')
-            temmap = convolve(temcutout.data, kernel)
-            #mass_map = (smdata * masscalc.mass_conversion_factor(TK=temcutout.data)).to(u.M_sun)
+            temmap = convolve(field['temperature'][view], kernel)
 
-            bm_cm = smooth/(8*np.log(2))**0.5
+            beam_sigma = smooth/(8*np.log(2))**0.5
         else:
-            mass_map = (cutout.data * masscalc.mass_conversion_factor(TK=temcutout.data)).to(u.M_sun)
-            temmap = temcutout.data
+            mass_map = field['mass'][view]
+            temmap = field['temperature'][view]
+            beam_sigma = bm_cm
 
-        # volume of a gaussian: sqrt(2 pi)^N r^N
-        volume = (2*np.pi)**(1.5) * bm_cm**3
-        density_map = (mass_map / volume / (2.8*u.Da)).to(u.cm**-3)
-        print("Scale: {0}".format(bm_cm.to(u.au)))
-
-        c_s_map = ((constants.k_B * temmap*u.K / (2.4*u.Da))**0.5).to(u.km/u.s)
-        MJ_map_ = (np.pi/6. * c_s_map**3 / (constants.G**1.5 *
-                                           (2.8*u.Da*density_map)**0.5)).to(u.M_sun)
-
-        LJ_map = (c_s_map / (constants.G**0.5 *
-                             (2.8*u.Da*density_map)**0.5)).to(u.au)
-        MJ_map = (4/3. * np.pi * (LJ_map/2.)**3 * (2.8*u.Da*density_map)).to(u.M_sun)
-        np.testing.assert_almost_equal(MJ_map.value, MJ_map_.value)
+        maps = jeans_quantities(mass_map, temmap, beam_sigma.to(u.cm).value)
+        density_map = maps['density']
+        MJ_map = maps['MJ']
+        LJ_map = maps['LJ']
+        print("Scale: {0}".format(beam_sigma.to(u.au)))
 
         fig = pl.figure(ii)
         fig.clf()
         ax1=pl.subplot(2,3,1)
-        im1 = ax1.imshow(mass_map.value, cmap='gray', vmin=0, vmax=10)
+        im1 = ax1.imshow(mass_map, cmap='gray', vmin=0, vmax=10)
         ax1.set_title("Measured mass")
         fig.colorbar(im1)
 
         ax2=pl.subplot(2,3,2)
-        im2 = ax2.imshow(MJ_map.value, cmap='gray', vmin=0, vmax=10)
+        im2 = ax2.imshow(MJ_map, cmap='gray', vmin=0, vmax=10)
         ax2.set_title("Jeans mass")
         fig.colorbar(im2)
         ax3=pl.subplot(2,3,3)
@@ -128,7 +171,7 @@ def jeans_maps(regions, size=u.Quantity([2.25,2.25], u.arcsec), smooth=0):
 
         ax4=pl.subplot(2,3,4)
         ax4.set_title("log Density")
-        im4 = ax4.imshow(np.log10(density_map.value), cmap='gray', vmin=7, vmax=9.5)
+        im4 = ax4.imshow(np.log10(density_map), cmap='gray', vmin=7, vmax=9.5)
         fig.colorbar(im4)
 
         ax5=pl.subplot(2,3,5)
@@ -137,8 +180,8 @@ def jeans_maps(regions, size=u.Quantity([2.25,2.25], u.arcsec), smooth=0):
         fig.colorbar(im5)
 
         ax6=pl.subplot(2,3,6)
-        im6 = ax6.imshow(LJ_map.value, cmap='gray', vmin=0, vmax=1e4)
-        ax6.contourf(LJ_map.value, levels=[0, 2*(bm_cm_fwhm.to(u.au)).value * gaussian_fwhm_to_sphere_r], colors=['r', 'r'])
+        im6 = ax6.imshow(LJ_map, cmap='gray', vmin=0, vmax=1e4)
+        ax6.contourf(LJ_map, levels=[0, 2*(bm_cm_fwhm.to(u.au)).value * gaussian_fwhm_to_sphere_r], colors=['r', 'r'])
         ax6.set_title("Jeans Length (AU)")
         fig.colorbar(im6)
 
@@ -152,8 +195,8 @@ def jeans_maps(regions, size=u.Quantity([2.25,2.25], u.arcsec), smooth=0):
         else:
             fig.savefig(paths.fpath("jeans_maps_{0}_smooth{1}.png".format(name, smooth)))
 
-                
-        mass_maps[name] = (mass_map, MJ_map)
+
+        mass_maps[name] = (mass_map*u.M_sun, MJ_map*u.M_sun)
 
     return mass_maps
 
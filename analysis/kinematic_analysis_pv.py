@@ -1,7 +1,6 @@
 import numpy as np
 import pvextractor
 import os
-import glob
 import paths
 from astropy import units as u
 from astropy import constants
@@ -14,6 +13,8 @@ import pyregion
 # use outflow_meta b/c higher precision than ds9 reg
 from outflow_meta import e2e, e8, north, lacy
 from line_point_offset import offset_to_point
+from pv_batch import PVExtractor
+from fits_index import default_index
 
 import pylab as pl
 
@@ -38,7 +39,10 @@ import pylab as pl
 #e8diskycoords = "19:23:43.928,+14:30:29.17,19:23:43.882,+14:30:27.18".split(",")
 pl.close(1)
 
-for ii,direction in enumerate(('perpco', 'perpsio')):
+directions = ('perpco', 'perpsio')
+
+diskycoorddicts = {}
+for ii,direction in enumerate(directions):
     diskycoorddict = {}
     for source in ('e2e','e8','north','lacy'):
         diskycoord_list = pyregion.open(paths.rpath("{0}_disk_pvextract.reg"
@@ -53,6 +57,21 @@ for ii,direction in enumerate(('perpco', 'perpsio')):
         diskycoorddict[source] = diskycoords
 
     diskycoorddict['e2'] = diskycoorddict['e2e']
+    diskycoorddicts[direction] = diskycoorddict
+
+
+def percentile_medsub(cube):
+    cube.allow_huge_operations=True
+    cube.beam_threshold = 5
+    med = cube.percentile(25,axis=0)
+    return cube - med
+
+# both directions are extracted from each cube in one read; the second
+# direction is served from the extractor's cache
+pvservice = PVExtractor(preprocess=percentile_medsub)
+
+for direction in directions:
+    diskycoorddict = diskycoorddicts[direction]
 
     for name, cutoutname, source, vrange, vcen in (
         ('e2', 'e2', e2e, (45,70), 56.0),
@@ -63,7 +82,7 @@ for ii,direction in enumerate(('perpco', 'perpsio')):
 
         diskycoords = diskycoorddict[name]
 
-        for fn in glob.glob(paths.dpath("12m/cutouts/W51_b6_12M*{0}*fits".format(cutoutname))):
+        for fn in default_index.glob(paths.dpath("12m/cutouts/W51_b6_12M*{0}*fits".format(cutoutname))):
 
             namesplit = fn.split(".")
             if cutoutname not in namesplit[3]:
@@ -79,14 +98,11 @@ for ii,direction in enumerate(('perpco', 'perpsio')):
 
             print("Extracting {0} {2}: {1}".format(fn, direction, name))
 
-            cube = SpectralCube.read(fn)
-            cube.allow_huge_operations=True
-            cube.beam_threshold = 5
-            med = cube.percentile(25,axis=0)
-            medsub = cube - med
-
             extraction_path = pvextractor.Path(diskycoords, 0.2*u.arcsec)
-            extracted = pvextractor.extract_pv_slice(medsub, extraction_path)
+            pvpaths = {(name, dd): pvextractor.Path(diskycoorddicts[dd][name],
+                                                    0.2*u.arcsec)
+                       for dd in directions}
+            extracted = pvservice.extract(fn, pvpaths)[(name, direction)]
             if direction=='perpco' and ('CH3OH' in basename or 'CH3OCHO' in basename):
                 extracted.writeto(outfn, clobber=True)
 
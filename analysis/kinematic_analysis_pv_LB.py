@@ -15,6 +15,7 @@ from line_to_image_list import line_to_image_list
 # use outflow_meta b/c higher precision than ds9 reg
 from outflow_meta import e2e, e8, north, lacy
 from line_point_offset import offset_to_point
+from pv_batch import PVExtractor, spectral_slab
 
 import pylab as pl
 
@@ -23,7 +24,10 @@ import pylab as pl
 # w51e2e = coordinates.SkyCoord(e2ereg.coord_list[0]*u.deg,
 #                               e2ereg.coord_list[1]*u.deg, frame='fk5')
 
-for ii,direction in enumerate(('perpco', 'perpsio')):
+directions = ('perpco', 'perpsio')
+
+diskycoorddicts = {}
+for ii,direction in enumerate(directions):
     diskycoorddict = {}
     for source in ('e2e','e8','north','lacy'):
         diskycoord_list = pyregion.open(paths.rpath("{0}_disk_pvextract.reg"
@@ -38,7 +42,15 @@ for ii,direction in enumerate(('perpco', 'perpsio')):
         diskycoorddict[source] = diskycoords
 
     diskycoorddict['e2'] = diskycoorddict['e2e']
+    diskycoorddicts[direction] = diskycoorddict
+
+# both directions are extracted from each full cube in one read; the line
+# slabs are then channel ranges of those slices, and the second direction is
+# served from the extractor's cache
+pvservice = PVExtractor()
 
+for direction in directions:
+    diskycoorddict = diskycoorddicts[direction]
 
     for name, cutoutname, source, vrange in (
         ('lacy', 'northwest', lacy, (50,75)),
@@ -59,6 +71,10 @@ for ii,direction in enumerate(('perpco', 'perpsio')):
                 continue
 
             extraction_path = pvextractor.Path(diskycoords, 0.05*u.arcsec)
+            pvpaths = {(name, dd): pvextractor.Path(diskycoorddicts[dd][name],
+                                                    0.05*u.arcsec)
+                       for dd in directions}
+            fullpv = pvservice.extract(fn, pvpaths, cube=cube)[(name, direction)]
 
             for line, restfreq, velocity_res, spw in line_to_image_list:
 
@@ -76,7 +92,9 @@ for ii,direction in enumerate(('perpco', 'perpsio')):
 
                 print("Extracting {3} {0} {2}: {1}".format(line, restfreq, direction, name))
 
-                extracted = pvextractor.extract_pv_slice(svcube, extraction_path)
+                extracted = spectral_slab(fullpv, vcube,
+                                          (vrange[0]-1)*u.km/u.s,
+                                          (vrange[1]+1)*u.km/u.s)
                 #extracted.writeto(outfn, clobber=True)
 
                 ww = wcs.WCS(extracted.header)
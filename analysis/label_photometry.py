@@ -0,0 +1,114 @@
+"""
+Grouped (label-image) photometry of many regions in one pass over a cube.
+
+Region masks are rasterized into a stack of integer label images (a "label
+cube", [nlayers, ny, nx]).  Overlapping regions are placed in different
+layers, so every pixel can belong to any number of regions while each layer
+is still a plain label image.  The cube is then read once, in channel chunks,
+and the per-region, per-channel sum, count, and max are computed with
+`np.bincount` / `np.maximum.at` grouped reductions.  Any statistic over a
+region and a range of channels is then a reduction over those small
+[nregions, nchannels] arrays.
+"""
+import numpy as np
+
+
+def label_layers(masks):
+    """
+    Rasterize boolean masks into a stack of non-overlapping label images.
+
+    Each mask is placed in the first layer in which it does not overlap any
+    previously placed mask; label ``ii+1`` in a layer is ``masks[ii]`` and 0
+    is background.
+
+    Parameters
+    ----------
+    masks : list
+        Boolean [ny, nx] region masks
+
+    Returns
+    -------
+    layers : np.ndarray
+        [nlayers, ny, nx] integer label cube
+    """
+    layers = []
+    for ii, mask in enumerate(masks):
+        for layer in layers:
+            if not (layer[mask] > 0).any():
+                layer[mask] = ii+1
+                break
+        else:
+            layer = np.zeros(mask.shape, dtype='int')
+            layer[mask] = ii+1
+            layers.append(layer)
+    if not layers:
+        raise ValueError("No region masks were given")
+    return np.array(layers)
+
+
+def grouped_channel_stats(cube, layers, chunksize=32):
+    """
+    Per-label, per-channel sum, number of finite pixels, and max of a cube.
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+        The cube; it is read ``chunksize`` channels at a time
+    layers : np.ndarray
+        [nlayers, ny, nx] label cube from `label_layers`
+
+    Returns
+    -------
+    stats : dict
+        ``sum``, ``count`` and ``max``, each [nlabels, nchan] where row ``ii``
+        corresponds to ``masks[ii]`` (label ``ii+1``), plus ``npix``, the
+        number of pixels in each label
+    """
+    nlabels = layers.max()
+    nchan = cube.shape[0]
+    nbins = nlabels+1
+
+    # only the labeled pixels of each layer are ever touched
+    layer_pix = []
+    for layer in layers:
+        flat = layer.ravel()
+        pix = np.flatnonzero(flat)
+        layer_pix.append((pix, flat[pix]))
+
+    npix = np.zeros(nbins, dtype='int')
+    for pix, labs in layer_pix:
+        npix += np.bincount(labs, minlength=nbins)
+
+    sums = np.zeros([nbins, nchan])
+    counts = np.zeros([nbins, nchan])
+    maxes = np.full([nbins, nchan], -np.inf)
+
+    for start in range(0, nchan, chunksize):
+        chunk = cube.filled_data[start:start+chunksize].value
+        nc = chunk.shape[0]
+        chunk = chunk.reshape(nc, -1)
+        offsets = (np.arange(nc)*nbins)[:,None]
+        for pix, labs in layer_pix:
+            vals = chunk[:, pix]
+            finite = np.isfinite(vals)
+            labels = (labs[None,:] + offsets)
+            sums[:, start:start+nc] += np.bincount(labels[finite],
+                                                   weights=vals[finite],
+                                                   minlength=nc*nbins).reshape(nc, nbins).T
+            counts[:, start:start+nc] += np.bincount(labels[finite],
+                                                     minlength=nc*nbins).reshape(nc, nbins).T
+            # only the labels with finite pixels in this layer take part:
+            # the others stay at -inf rather than clamping the max to 0
+            mx = np.full(nc*nbins, -np.inf)
+            np.maximum.at(mx, labels[finite], vals[finite])
+            maxes[:, start:start+nc] = np.maximum(maxes[:, start:start+nc],
+                                                  mx.reshape(nc, nbins).T)
+
+    maxes[~np.isfinite(maxes)] = np.nan
+
+    # drop the background label
+    return {'sum': sums[1:],
+            'count': counts[1:],
+            'max': maxes[1:],
+            'npix': npix[1:],
+           }
@@ -0,0 +1,134 @@
+"""
+Nearest-line identification with a sorted frequency index.
+
+The (redshifted) line list is sorted once; any number of observed frequencies
+is then mapped to the nearest catalog line with `np.searchsorted`, i.e.
+O(npix log nlines), with plain floats (GHz, km/s) in the hot path.
+"""
+import numpy as np
+from astropy import units as u
+from astropy import constants
+
+ckms = constants.c.to(u.km/u.s).value
+
+
+class LineIndex(object):
+    """
+    Parameters
+    ----------
+    linenames : list
+        Line names
+    restfreqs : `~astropy.units.Quantity` or np.ndarray
+        Rest frequencies (GHz if unitless)
+    vlsr : float
+        Velocity (km/s) by which to redshift the line list
+    """
+    def __init__(self, linenames, restfreqs, vlsr=0.0):
+        self.linenames = np.asarray(linenames)
+        restfreqs = u.Quantity(restfreqs, u.GHz).value
+        self.freqs = restfreqs * (1 - vlsr/ckms)
+        self.order = np.argsort(self.freqs)
+        self.sorted_freqs = self.freqs[self.order]
+
+    def __len__(self):
+        return len(self.freqs)
+
+    def nearest(self, frequencies):
+        """
+        Map frequencies (GHz, any shape) to the nearest line.
+
+        Returns
+        -------
+        index : np.ndarray
+            Index into ``linenames`` of the closest line
+        vdiff : np.ndarray
+            Absolute offset from that line in km/s
+        """
+        frequencies = np.asarray(frequencies, dtype='float')
+        sf = self.sorted_freqs
+        right = np.clip(np.searchsorted(sf, frequencies), 1, len(sf)-1)
+        left = right - 1
+        if len(sf) == 1:
+            right = left = np.zeros_like(right)
+        use_left = (np.abs(frequencies - sf[left]) <=
+                    np.abs(frequencies - sf[right]))
+        nearest_sorted = np.where(use_left, left, right)
+        index = self.order[nearest_sorted]
+        vdiff = np.abs(frequencies - self.freqs[index]) / self.freqs[index] * ckms
+        return index, vdiff
+
+
+def stream_peaks(cube, lineindex, linemax=None, max_vdiff=10.0,
+                 chunksize=32):
+    """
+    One streaming pass over a cube computing the per-pixel peak, the channel
+    of the peak, and the peak brightness of every catalog line.
+
+    Each channel is assigned to its nearest line (if within ``max_vdiff``
+    km/s); the per-line maximum map is the running maximum over the channels
+    assigned to that line.
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+    lineindex : `LineIndex`
+    linemax : np.ndarray, optional
+        [nlines, ny, nx] running per-line maxima to update (e.g., from the
+        other spws of the same field); created if None
+
+    Returns
+    -------
+    peak, argmax : np.ndarray
+        [ny, nx] peak value and channel of the peak
+    linemax : np.ndarray
+        [nlines, ny, nx] per-line peak values (-inf where not covered)
+    """
+    nchan = cube.shape[0]
+    ny, nx = cube.shape[1:]
+    specaxis = cube.with_spectral_unit(u.GHz).spectral_axis.value
+    chanline, chanvdiff = lineindex.nearest(specaxis)
+    chanline[chanvdiff > max_vdiff] = -1
+
+    if linemax is None:
+        linemax = np.full([len(lineindex), ny, nx], -np.inf)
+    peak = np.full([ny, nx], -np.inf)
+    argmax = np.zeros([ny, nx], dtype='int')
+
+    for start in range(0, nchan, chunksize):
+        chunk = cube.filled_data[start:start+chunksize].value
+        chunk = np.where(np.isfinite(chunk), chunk, -np.inf)
+        chunkmax = chunk.max(axis=0)
+        better = chunkmax > peak
+        argmax[better] = start + chunk.argmax(axis=0)[better]
+        peak[better] = chunkmax[better]
+
+        labels = chanline[start:start+chunksize]
+        for line in np.unique(labels[labels >= 0]):
+            np.fmax(linemax[line], chunk[labels == line].max(axis=0),
+                    out=linemax[line])
+
+    peak[~np.isfinite(peak)] = np.nan
+    return peak, argmax, linemax
+
+
+def topk_species(linemax, k=3):
+    """
+    The ``k`` brightest lines at each pixel.
+
+    Returns
+    -------
+    index : np.ndarray
+        [k, ny, nx] line indices, brightest first (-1 where fewer than ``k``
+        lines are detected)
+    value : np.ndarray
+        [k, ny, nx] their peak values
+    """
+    k = min(k, linemax.shape[0])
+    part = np.argpartition(-linemax, k-1, axis=0)[:k]
+    vals = np.take_along_axis(linemax, part, axis=0)
+    order = np.argsort(-vals, axis=0)
+    index = np.take_along_axis(part, order, axis=0)
+    value = np.take_along_axis(vals, order, axis=0)
+    index[~np.isfinite(value)] = -1
+    value[~np.isfinite(value)] = np.nan
+    return index, value
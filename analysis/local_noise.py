@@ -0,0 +1,260 @@
+"""
+Local noise maps of residual images.
+
+The noise is the scatter of the residual around its local mean within a
+sliding window.  Windows are applied with summed-area tables (integral
+images): every box sum costs four lookups regardless of its size, and blank
+pixels are handled by dividing by the box sum of the valid-pixel mask.  A
+Gaussian window of width ``sigma`` (as in the ``convolve_fft(...,
+Gaussian2DKernel(30))`` noise estimates) is approximated by three successive
+boxes of the same variance.
+
+Available statistics, all computed in one pass that shares the local mean:
+
+* ``rms``: sqrt(<x^2>)
+* ``std``: sqrt(<(x - <x>)^2>)
+* ``mean_abs_dev``: <|x - <x>|>
+* ``mad_std``: 1.4826 x the median absolute deviation in boxes of the window
+  size, evaluated on a grid of half-window spacing and interpolated back
+  (medians have no integral image)
+
+Maps are cached as ``.npy`` files keyed by the residual file's signature and
+the window, so rebuilding the noise-aware thresholds costs one file read.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+from scipy import ndimage
+from astropy.io import fits
+from astropy import log
+
+import paths
+from product_cache import file_signature
+
+statistics = ('rms', 'std', 'mean_abs_dev', 'mad_std')
+
+# mad_std = MAD * 1/Phi^-1(3/4), as in astropy.stats.mad_std
+mad_to_std = 1.482602218505602
+
+
+def summed_area_table(image):
+    """
+    Integral image with a leading row and column of zeros, so that the sum
+    over ``image[y0:y1, x0:x1]`` is ``S[y1,x1] - S[y0,x1] - S[y1,x0] +
+    S[y0,x0]``
+    """
+    sat = np.zeros((image.shape[0]+1, image.shape[1]+1))
+    np.cumsum(np.cumsum(image, axis=0), axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def box_sum(image, halfwidth):
+    """
+    Sum over the (2 halfwidth + 1)^2 box centered on every pixel, truncated
+    at the image edges
+    """
+    ny, nx = image.shape
+    sat = summed_area_table(image)
+    y0 = np.clip(np.arange(ny) - halfwidth, 0, ny)
+    y1 = np.clip(np.arange(ny) + halfwidth + 1, 0, ny)
+    x0 = np.clip(np.arange(nx) - halfwidth, 0, nx)
+    x1 = np.clip(np.arange(nx) + halfwidth + 1, 0, nx)
+    return (sat[y1[:, None], x1[None, :]] - sat[y0[:, None], x1[None, :]] -
+            sat[y1[:, None], x0[None, :]] + sat[y0[:, None], x0[None, :]])
+
+
+def box_halfwidths(scale, kernel='gaussian'):
+    """
+    Box half-widths of the passes making up a window of ``scale`` pixels:
+    one box of width 2 scale + 1 for ``kernel='box'``, or three boxes with
+    the variance of a Gaussian of sigma ``scale`` for ``kernel='gaussian'``
+    """
+    if kernel == 'box':
+        return (int(scale),)
+    elif kernel == 'gaussian':
+        # a box of width w has variance (w^2-1)/12; three of them add up
+        width = (4*scale**2 + 1)**0.5
+        return (int(np.round((width-1)/2)),)*3
+    raise ValueError("kernel must be 'gaussian' or 'box'")
+
+
+class LocalMean(object):
+    """
+    NaN-ignoring windowed mean; the normalization (window sums of the valid
+    mask) is computed once and reused for every smoothed quantity
+    """
+    def __init__(self, valid, halfwidths):
+        self.halfwidths = halfwidths
+        self.valid = valid.astype('float')
+        weights = [self.valid]
+        for hw in halfwidths:
+            weights.append(box_sum(weights[-1], hw))
+        self.weights = weights
+
+    def __call__(self, image):
+        smooth = np.where(self.valid > 0, image, 0)
+        for ii, hw in enumerate(self.halfwidths):
+            weights = self.weights[ii]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                smooth = box_sum(np.where(weights > 0, smooth*weights, 0), hw)
+                smooth = smooth / self.weights[ii+1]
+        return smooth
+
+
+def _mad_std_map(image, halfwidth, valid):
+    ny, nx = image.shape
+    step = max(halfwidth, 1)
+    yc = np.arange(0, ny + step, step).clip(0, ny-1)
+    xc = np.arange(0, nx + step, step).clip(0, nx-1)
+    grid = np.full((yc.size, xc.size), np.nan)
+    for jj, y in enumerate(yc):
+        rows = slice(max(y-halfwidth, 0), y+halfwidth+1)
+        for ii, x in enumerate(xc):
+            cols = slice(max(x-halfwidth, 0), x+halfwidth+1)
+            box = image[rows, cols][valid[rows, cols]]
+            if box.size:
+                grid[jj, ii] = mad_to_std * np.median(np.abs(box - np.median(box)))
+    yy = np.interp(np.arange(ny), yc, np.arange(yc.size))
+    xx = np.interp(np.arange(nx), xc, np.arange(xc.size))
+    coords = np.array(np.meshgrid(yy, xx, indexing='ij'))
+    return ndimage.map_coordinates(grid, coords, order=1, mode='nearest')
+
+
+def noise_maps(image, scale=30, stats=('std',), kernel='gaussian',
+               fill_value=None):
+    """
+    Local noise maps of a residual image
+
+    Parameters
+    ----------
+    image : np.ndarray
+        2D residual image
+    scale : int
+        Gaussian sigma (``kernel='gaussian'``) or box half-width
+        (``kernel='box'``) of the window in pixels
+    stats : sequence
+        Any of `statistics`
+    fill_value : float or None
+        If given, blank pixels enter the deviations with this value (to make
+        the noise high off the edge of the map); the local mean always
+        ignores them
+
+    Returns
+    -------
+    maps : dict
+        statistic -> noise map
+    """
+    image = np.asarray(image, dtype='float')
+    valid = np.isfinite(image)
+    halfwidths = box_halfwidths(scale, kernel)
+    smooth = LocalMean(valid, halfwidths)
+
+    if fill_value is None:
+        deviation_smooth = smooth
+        values = image
+    else:
+        deviation_smooth = LocalMean(np.ones_like(valid), halfwidths)
+        values = np.where(valid, image, fill_value)
+
+    maps = {}
+    if 'std' in stats or 'mean_abs_dev' in stats:
+        # no valid pixel within the window: the local mean is taken as 0
+        deviation = values - np.nan_to_num(smooth(image))
+        if 'std' in stats:
+            maps['std'] = deviation_smooth(deviation**2)**0.5
+        if 'mean_abs_dev' in stats:
+            maps['mean_abs_dev'] = deviation_smooth(np.abs(deviation))
+    if 'rms' in stats:
+        maps['rms'] = deviation_smooth(values**2)**0.5
+    if 'mad_std' in stats:
+        # the window containing ~all of the weight of the smoothing kernel
+        maps['mad_std'] = _mad_std_map(values, sum(halfwidths),
+                                       np.isfinite(values))
+    return maps
+
+
+class NoiseMapCache(object):
+    """
+    Parameters
+    ----------
+    directory : str
+        Where the noise maps are stored
+    """
+    def __init__(self, directory=paths.dpath('noise_map_cache')):
+        self.directory = directory
+
+    def _filename(self, filename, hdu, stat, scale, kernel, fill_value):
+        signature = file_signature(filename)
+        key = hashlib.md5(json.dumps([signature['path'], signature['size'],
+                                      signature['mtime'], hdu, stat, scale,
+                                      kernel, fill_value]).encode()).hexdigest()
+        return os.path.join(self.directory, key + '.npy')
+
+    def noise_maps(self, filename, scales=(30,), stats=('std',),
+                   kernel='gaussian', fill_value=None, hdu=0):
+        """
+        `noise_maps` of the residual image in ``filename`` at every scale in
+        ``scales``, read from the cache where available
+
+        Returns
+        -------
+        maps : dict
+            (statistic, scale) -> read-only (memory-mapped) noise map
+        """
+        maps = {}
+        for scale in scales:
+            fns = {stat: self._filename(filename, hdu, stat, scale, kernel,
+                                        fill_value)
+                   for stat in stats}
+            todo = [stat for stat in stats if not os.path.exists(fns[stat])]
+            if todo:
+                log.debug("Computing {0} noise maps of {1} at scale {2}"
+                          .format(todo, filename, scale))
+                image = np.squeeze(fits.getdata(filename, hdu))
+                new = noise_maps(image, scale=scale, stats=todo, kernel=kernel,
+                                 fill_value=fill_value)
+                if not os.path.exists(self.directory):
+                    os.makedirs(self.directory)
+                # write to a temporary file first: the cache is valid as soon
+                # as the file exists, so it must never be partly written
+                for stat in todo:
+                    tmpfn = "{0}.{1}.tmp".format(fns[stat], os.getpid())
+                    with open(tmpfn, 'wb') as fh:
+                        np.save(fh, new[stat])
+                    os.replace(tmpfn, fns[stat])
+            for stat in stats:
+                maps[(stat, scale)] = np.load(fns[stat], mmap_mode='r')
+        return maps
+
+    def noise_map(self, filename, scale=30, stat='std', kernel='gaussian',
+                  fill_value=None, hdu=0):
+        """
+        A single cached noise map
+        """
+        return self.noise_maps(filename, scales=(scale,), stats=(stat,),
+                               kernel=kernel, fill_value=fill_value,
+                               hdu=hdu)[(stat, scale)]
+
+
+default_cache = NoiseMapCache()
+
+
+def cached_noise_maps(filename, scales=(30,), stats=('std',),
+                      kernel='gaussian', fill_value=None, hdu=0):
+    """
+    `NoiseMapCache.noise_maps` with the default cache
+    """
+    return default_cache.noise_maps(filename, scales=scales, stats=stats,
+                                    kernel=kernel, fill_value=fill_value,
+                                    hdu=hdu)
+
+
+def cached_noise_map(filename, scale=30, stat='std', kernel='gaussian',
+                     fill_value=None, hdu=0):
+    """
+    `NoiseMapCache.noise_map` with the default cache
+    """
+    return default_cache.noise_map(filename, scale=scale, stat=stat,
+                                   kernel=kernel, fill_value=fill_value,
+                                   hdu=hdu)
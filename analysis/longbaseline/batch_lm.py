@@ -0,0 +1 @@
+../batch_lm.py
\ No newline at end of file
@@ -3,6 +3,7 @@ import pylab as pl
 from spectral_cube import SpectralCube
 from astropy import units as u
 from astropy import coordinates
+import cube_stats
 
 checkregions = ['19:23:43.961 +14:30:34.693',
                 '19:23:43.975 +14:30:34.655',
@@ -45,7 +46,7 @@ def getmoments(cubefilename, vmin=40*u.km/u.s, vmax=75*u.km/u.s,
     vmask = ((ccube.spectral_axis < signal_range[0]) |
              (ccube.spectral_axis > signal_range[1]))[:,None,None]
 
-    cont = ccube.with_mask(vmask).spectral_slab(vmin,vmax).percentile(50, axis=0)
+    cont = cube_stats.median_map(ccube.with_mask(vmask).spectral_slab(vmin,vmax))
 
     cscube = ccube - cont
 
@@ -6,9 +6,13 @@ from astropy import constants
 import scipy.stats
 import os
 import paths
+import multigauss_varpro
 T=True
 F=False
 
+# fit with the variable-projection fitter rather than pyspeckit's fiteach
+varpro = True
+
 cubefn = paths.dpath('longbaseline/W51e2e_CH3CN_cutout.fits')
 cube = SpectralCube.read(cubefn).minimal_subcube()
 contcubeK = cube.to(u.K, u.brightness_temperature(cube.beam,
@@ -33,8 +37,32 @@ absorption_mask = (skew < -0.1)
 
 pcube = pyspeckit.Cube(cube=cubeK)
 
+parnames = ['shift', 'width'] + line_names + ['background']
+
 if os.path.exists('e2e_multigauss_fits.fits'):
-    pcube.load_model_fit('e2e_multigauss_fits.fits', npars=4)
+    pcube.load_model_fit('e2e_multigauss_fits.fits', npars=17,
+                         fittype='ch3cn_spw')
+elif varpro:
+    # the amplitudes and background are linear given (shift, width): solve
+    # them in closed form and search only (shift, width), for all spaxels
+    # at once
+    mask = ((peak>(200*u.K+med)) & (skew > 0.1)) | ((nadir < (med-200*u.K)) & (skew < -0.1))
+    print("Fitting {0} points".format(mask.sum()))
+    frqaxis = cubeK.with_spectral_unit(u.GHz).spectral_axis.value
+    parcube, errcube, chi2map = multigauss_varpro.fit_cube(frqaxis,
+                                                           cubeK.filled_data[:].value,
+                                                           err.value,
+                                                           frequencies,
+                                                           mask=mask,
+                                                           vcen_limits=(50, 70),
+                                                           width_limits=(0.1, 6),
+                                                           amplitude_limits=(-600, 600),
+                                                           background_limits=(0, 600))
+    multigauss_varpro.write_fit('e2e_multigauss_fits.fits', parcube, errcube,
+                                cubeK.wcs.celestial.to_header(), parnames,
+                                'ch3cn_spw')
+    pcube.load_model_fit('e2e_multigauss_fits.fits', npars=17,
+                         fittype='ch3cn_spw')
 else:
     #vguesses = 62*u.km/u.s
     #widths = np.ones_like(mask)*2.0
@@ -0,0 +1,334 @@
+"""
+Joint Gaussian fits of source catalogs in crowded fields.
+
+``gaussfit_catalog`` fits every source on its own, so in W51 North and e2
+neighbouring sources are refitted inside each other's windows and pull on
+each other's fits.  Here sources whose fit windows overlap are grouped into
+clusters, and each cluster is fitted with one model (a sum of elliptical
+Gaussians with an analytic Jacobian) over the union of its windows.
+
+Clusters with the same number of members are fitted together with
+`batch_lm.batch_levmar` (windows padded with zero-weight pixels), and these
+batches are distributed over a process pool.  When one catalog is fitted on
+several images, passing the previous image's results as ``initial`` warm
+starts the fits from that solution.
+
+The output has the same layout as ``gaussfit_catalog``'s, so
+``gaussfit_sources.data_to_table`` applies unchanged.
+"""
+import os
+import multiprocessing
+import numpy as np
+import radio_beam
+from scipy.sparse import csgraph, coo_matrix
+from astropy import units as u
+from astropy import coordinates
+from astropy import wcs
+from astropy.io import fits
+from astropy import log
+
+from batch_lm import batch_levmar
+
+# parameters per source: amplitude, x, y, sigma_x, sigma_y, theta
+npars_per_source = 6
+sigma_to_fwhm = np.sqrt(8*np.log(2))
+
+
+def gaussians(params, xdata):
+    """
+    Sum of elliptical Gaussians and its Jacobian
+
+    Parameters
+    ----------
+    params : np.ndarray
+        [nfits, 6 nsources] (amplitude, x0, y0, sigma_x, sigma_y, theta) of
+        every source
+    xdata : np.ndarray
+        [nfits, 2, ndata] y and x pixel coordinates
+
+    Returns
+    -------
+    model : np.ndarray
+        [nfits, ndata]
+    jac : np.ndarray
+        [nfits, ndata, 6 nsources]
+    """
+    nfits, npars = params.shape
+    yy, xx = xdata[:, 0, :], xdata[:, 1, :]
+    model = np.zeros(yy.shape)
+    jac = np.empty(yy.shape + (npars,))
+    for start in range(0, npars, npars_per_source):
+        amp, x0, y0, sx, sy, theta = [params[:, start+ii, None]
+                                      for ii in range(npars_per_source)]
+        cost, sint = np.cos(theta), np.sin(theta)
+        dx, dy = xx - x0, yy - y0
+        uu = dx*cost + dy*sint
+        vv = -dx*sint + dy*cost
+        expo = np.exp(-0.5*(uu**2/sx**2 + vv**2/sy**2))
+        gg = amp*expo
+        model += gg
+        jac[:, :, start] = expo
+        jac[:, :, start+1] = gg*(uu*cost/sx**2 - vv*sint/sy**2)
+        jac[:, :, start+2] = gg*(uu*sint/sx**2 + vv*cost/sy**2)
+        jac[:, :, start+3] = gg*uu**2/sx**3
+        jac[:, :, start+4] = gg*vv**2/sy**3
+        jac[:, :, start+5] = gg*uu*vv*(1/sy**2 - 1/sx**2)
+    return model, jac
+
+
+def position_angle_to_theta(pa, mywcs, xpix, ypix):
+    """
+    The model's ``theta`` (radians counterclockwise from the +x pixel axis)
+    of a position angle ``pa`` (east of north, e.g. ``beam.pa``) at pixel
+    positions ``xpix, ypix``.  With north up and east to the left this is
+    ``pa + 90 deg``.
+    """
+    xpix, ypix = np.asarray(xpix, dtype='float'), np.asarray(ypix, dtype='float')
+    step = wcs.utils.proj_plane_pixel_scales(mywcs).mean()
+    ra, dec = mywcs.wcs_pix2world(xpix, ypix, 0)
+    xn, yn = mywcs.wcs_world2pix(ra, dec+step, 0)
+    xe, ye = mywcs.wcs_world2pix(ra+step/np.cos(np.radians(dec)), dec, 0)
+    pa = u.Quantity(pa, u.deg).to(u.rad).value
+    dx = np.cos(pa)*(xn-xpix) + np.sin(pa)*(xe-xpix)
+    dy = np.cos(pa)*(yn-ypix) + np.sin(pa)*(ye-ypix)
+    return np.arctan2(dy, dx)
+
+
+def cluster_sources(xpix, ypix, link_radius):
+    """
+    Group sources that lie within ``link_radius`` pixels of each other
+    (transitively: friends of friends)
+
+    Returns
+    -------
+    labels : np.ndarray
+        Cluster number of each source
+    """
+    xpix, ypix = np.asarray(xpix), np.asarray(ypix)
+    dist = np.hypot(xpix[:, None] - xpix[None, :], ypix[:, None] - ypix[None, :])
+    ii, jj = np.nonzero(dist < link_radius)
+    graph = coo_matrix((np.ones(ii.size), (ii, jj)), shape=(xpix.size,)*2)
+    return csgraph.connected_components(graph, directed=False)[1]
+
+
+def _fit_batch(args):
+    return batch_levmar(gaussians, *args)
+
+
+def _source_names(regs):
+    names = []
+    for ii, reg in enumerate(regs):
+        name = reg.meta.get('text', str(ii)) if hasattr(reg, 'meta') else str(ii)
+        names.append(name.strip('{}'))
+    return names
+
+
+def gaussfit_clusters(filename, regs, radius=0.1*u.arcsec,
+                      max_radius_in_beams=5, max_offset_in_beams=2,
+                      initial=None, prefix="", savepath=None, nprocs=None):
+    """
+    Fit all sources in ``regs`` on the image ``filename``, jointly within
+    clusters of overlapping fit windows
+
+    Parameters
+    ----------
+    filename : str
+        FITS image
+    regs : list
+        Sky regions (``.center`` and a ``text`` name in ``.meta``)
+    radius : `~astropy.units.Quantity`
+        Radius of the fit window around each source; sources closer than
+        twice this are fitted together
+    max_radius_in_beams : float
+        Largest allowed FWHM in units of the beam major axis
+    max_offset_in_beams : float
+        Largest allowed offset from the catalog position in beam major axes
+    initial : dict, optional
+        A previous result of this function (e.g. on another image of the same
+        field) to start the fits from
+    savepath : str, optional
+        Directory for per-cluster diagnostic figures
+    nprocs : int, optional
+        Number of worker processes (default: one per CPU)
+
+    Returns
+    -------
+    fit_data : dict
+        name -> dict of fitted quantities, as returned by ``gaussfit_catalog``
+    """
+    fh = fits.open(filename)
+    data = np.squeeze(fh[0].data).astype('float')
+    header = fh[0].header
+    mywcs = wcs.WCS(header).celestial
+    bunit = u.Unit(header.get('BUNIT', 'Jy/beam'))
+    beam = radio_beam.Beam.from_fits_header(header)
+    pixscale = wcs.utils.proj_plane_pixel_scales(mywcs).mean()*u.deg
+    beam_major_pix = (beam.major/pixscale).decompose().value
+    beam_minor_pix = (beam.minor/pixscale).decompose().value
+    radius_pix = (radius/pixscale).decompose().value
+
+    finite = np.isfinite(data)
+    noise = 1.482602218505602*np.median(np.abs(data[finite] -
+                                               np.median(data[finite])))
+
+    names = _source_names(regs)
+    centers = coordinates.SkyCoord([reg.center for reg in regs])
+    xcat, ycat = mywcs.wcs_world2pix(centers.ra.deg, centers.dec.deg, 0)
+
+    # initial guesses: catalog positions and the beam, or the previous fits
+    guess = np.empty((len(names), npars_per_source))
+    beam_theta = position_angle_to_theta(beam.pa, mywcs, xcat, ycat)
+    for ii, name in enumerate(names):
+        if initial is not None and name in initial and initial[name]['success']:
+            prev = initial[name]
+            xx, yy = mywcs.wcs_world2pix(prev['center_x'].to(u.deg).value,
+                                         prev['center_y'].to(u.deg).value, 0)
+            guess[ii] = [0, xx, yy,
+                         (prev['fwhm_x']/pixscale).decompose().value/sigma_to_fwhm,
+                         (prev['fwhm_y']/pixscale).decompose().value/sigma_to_fwhm,
+                         prev['pa'].to(u.rad).value]
+        else:
+            guess[ii] = [0, xcat[ii], ycat[ii], beam_major_pix/sigma_to_fwhm,
+                         beam_minor_pix/sigma_to_fwhm, beam_theta[ii]]
+        yi = int(np.clip(np.round(guess[ii, 2]), 0, data.shape[0]-1))
+        xi = int(np.clip(np.round(guess[ii, 1]), 0, data.shape[1]-1))
+        guess[ii, 0] = data[yi, xi] if finite[yi, xi] else noise
+
+    max_offset = max_offset_in_beams*beam_major_pix
+    lower = np.array([[0, xc-max_offset, yc-max_offset,
+                       beam_minor_pix/sigma_to_fwhm/2,
+                       beam_minor_pix/sigma_to_fwhm/2, -np.inf]
+                      for xc, yc in zip(xcat, ycat)])
+    upper = np.array([[np.inf, xc+max_offset, yc+max_offset,
+                       max_radius_in_beams*beam_major_pix/sigma_to_fwhm,
+                       max_radius_in_beams*beam_major_pix/sigma_to_fwhm, np.inf]
+                      for xc, yc in zip(xcat, ycat)])
+    guess = np.clip(guess, lower, upper)
+
+    labels = cluster_sources(xcat, ycat, 2*radius_pix)
+    clusters = [np.flatnonzero(labels == lab) for lab in np.unique(labels)]
+    log.info("{0}: {1} sources in {2} clusters".format(filename, len(names),
+                                                       len(clusters)))
+
+    # the union of the member windows of each cluster
+    windows = []
+    yy, xx = np.indices(data.shape)
+    for members in clusters:
+        y0 = int(max(np.floor(ycat[members].min()-radius_pix), 0))
+        y1 = int(min(np.ceil(ycat[members].max()+radius_pix)+1, data.shape[0]))
+        x0 = int(max(np.floor(xcat[members].min()-radius_pix), 0))
+        x1 = int(min(np.ceil(xcat[members].max()+radius_pix)+1, data.shape[1]))
+        sub_y, sub_x = yy[y0:y1, x0:x1], xx[y0:y1, x0:x1]
+        inwindow = np.zeros(sub_y.shape, dtype='bool')
+        for mm in members:
+            inwindow |= np.hypot(sub_x-xcat[mm], sub_y-ycat[mm]) <= radius_pix
+        inwindow &= finite[y0:y1, x0:x1]
+        windows.append((sub_y[inwindow], sub_x[inwindow]))
+
+    # one padded batch per cluster size
+    sizes = np.array([len(members) for members in clusters])
+    batches, batch_clusters = [], []
+    for size in np.unique(sizes):
+        which = np.flatnonzero(sizes == size)
+        npix = max(max(windows[cc][0].size for cc in which), 1)
+        xdata = np.zeros((which.size, 2, npix))
+        fitdata = np.zeros((which.size, npix))
+        weights = np.zeros((which.size, npix))
+        for jj, cc in enumerate(which):
+            wy, wx = windows[cc]
+            xdata[jj, 0, :wy.size] = wy
+            xdata[jj, 1, :wx.size] = wx
+            fitdata[jj, :wy.size] = data[wy, wx]
+            weights[jj, :wy.size] = noise**-2
+        members = [clusters[cc] for cc in which]
+        batches.append((np.array([guess[mm].ravel() for mm in members]),
+                        xdata, fitdata, weights,
+                        np.array([lower[mm].ravel() for mm in members]),
+                        np.array([upper[mm].ravel() for mm in members])))
+        batch_clusters.append(which)
+
+    nprocs = multiprocessing.cpu_count() if nprocs is None else nprocs
+    if nprocs > 1 and len(batches) > 1:
+        pool = multiprocessing.Pool(min(nprocs, len(batches)))
+        try:
+            results = pool.map(_fit_batch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_fit_batch(batch) for batch in batches]
+
+    fit_data = {}
+    for which, batch, (params, errors, chi2, niter) in zip(batch_clusters,
+                                                           batches, results):
+        for jj, cc in enumerate(which):
+            members = clusters[cc]
+            npix = windows[cc][0].size
+            dof = max(npix - params.shape[1], 1)
+            success = bool(npix > params.shape[1] and
+                           np.all(np.isfinite(params[jj])) and
+                           np.all(np.isfinite(errors[jj])))
+            pars = params[jj].reshape(-1, npars_per_source)
+            errs = errors[jj].reshape(-1, npars_per_source)
+            ra, dec = mywcs.wcs_pix2world(pars[:, 1], pars[:, 2], 0)
+            for kk, mm in enumerate(members):
+                amp, _, _, sx, sy, theta = pars[kk]
+                e_amp, e_x, e_y, e_sx, e_sy, e_theta = errs[kk]
+                # theta is unbounded and the sigmas enter squared: report the
+                # major axis as fwhm_x and theta in [0, 180) deg
+                sx, sy = np.abs(sx), np.abs(sy)
+                if sx < sy:
+                    sx, sy, e_sx, e_sy = sy, sx, e_sy, e_sx
+                    theta = theta + np.pi/2
+                theta = np.mod(theta, np.pi)
+                fit_data[names[mm]] = {'amplitude': amp*bunit,
+                                       'center_x': ra[kk]*u.deg,
+                                       'center_y': dec[kk]*u.deg,
+                                       'fwhm_x': (sx*sigma_to_fwhm*pixscale).to(u.arcsec),
+                                       'fwhm_y': (sy*sigma_to_fwhm*pixscale).to(u.arcsec),
+                                       'pa': (theta*u.rad).to(u.deg),
+                                       'chi2': chi2[jj],
+                                       'chi2/n': chi2[jj]/dof,
+                                       'e_amplitude': e_amp*bunit,
+                                       'e_center_x': (e_x*pixscale).to(u.deg),
+                                       'e_center_y': (e_y*pixscale).to(u.deg),
+                                       'e_fwhm_x': (e_sx*sigma_to_fwhm*pixscale).to(u.arcsec),
+                                       'e_fwhm_y': (e_sy*sigma_to_fwhm*pixscale).to(u.arcsec),
+                                       'e_pa': (e_theta*u.rad).to(u.deg),
+                                       'success': success,
+                                      }
+
+            if savepath is not None:
+                plot_cluster(data, windows[cc], params[jj],
+                             os.path.join(savepath, "{0}{1}.png"
+                                          .format(prefix,
+                                                  "_".join(names[mm] for mm in members))))
+
+    return fit_data
+
+
+def plot_cluster(data, window, params, filename):
+    """
+    Data, model and residual of one cluster's fit window
+    """
+    import pylab as pl
+    wy, wx = window
+    if wy.size == 0:
+        return
+    y0, y1, x0, x1 = wy.min(), wy.max()+1, wx.min(), wx.max()+1
+    yy, xx = np.indices((y1-y0, x1-x0))
+    xdata = np.array([[(yy+y0).ravel(), (xx+x0).ravel()]], dtype='float')
+    model = gaussians(params[None, :], xdata)[0][0].reshape(yy.shape)
+    cutout = data[y0:y1, x0:x1]
+
+    fig = pl.figure(1)
+    fig.clf()
+    for ii, (image, title) in enumerate(((cutout, 'Data'), (model, 'Model'),
+                                         (cutout-model, 'Residual'))):
+        ax = fig.add_subplot(1, 3, ii+1)
+        ax.imshow(image, origin='lower', interpolation='nearest', cmap='gray_r',
+                  vmin=np.nanmin(cutout), vmax=np.nanmax(cutout))
+        ax.plot(params[1::npars_per_source]-x0, params[2::npars_per_source]-y0,
+                'r+')
+        ax.set_title(title)
+    fig.savefig(filename, bbox_inches='tight')
@@ -0,0 +1 @@
+../cube_stats.py
\ No newline at end of file
@@ -1,7 +1,7 @@
 import regions
 from astropy import units as u
 import paths
-from gaussfit_catalog import gaussfit_catalog, gaussfit_image
+from cluster_gaussfit import gaussfit_clusters
 from astropy.table import Table,Column
 
 def tryint(x):
@@ -35,6 +35,10 @@ def data_to_table(fit_data):
 
 if __name__ == "__main__":
 
+    # the robust images are fitted starting from the uniform-weighted
+    # solutions of the same catalog
+    previous = {}
+
     for regfn, contfn, name in (
         ('w51north_protostars.reg', 'W51n_cont_uniform.image.tt0.pbcor.fits', 'NorthUniform'),
         ('w51north_protostars.reg', 'W51n.cont.image.allEB.fits', 'NorthRobust'),
@@ -46,11 +50,14 @@ if __name__ == "__main__":
 
         contfn = paths.dpath('longbaseline/'+contfn)
 
-        fit_data = gaussfit_catalog(contfn, regs, radius=0.1*u.arcsec,
-                                    prefix=name+"_",
-                                    max_radius_in_beams=5,
-                                    max_offset_in_beams=2,
-                                    savepath=paths.fpath('longbaseline/gaussfits'))
+        # overlapping sources are fitted jointly
+        fit_data = gaussfit_clusters(contfn, regs, radius=0.1*u.arcsec,
+                                     prefix=name+"_",
+                                     max_radius_in_beams=5,
+                                     max_offset_in_beams=2,
+                                     initial=previous.get(regfn),
+                                     savepath=paths.fpath('longbaseline/gaussfits'))
+        previous[regfn] = fit_data
 
         tbl = data_to_table(fit_data)
 
@@ -0,0 +1,267 @@
+"""
+Variable-projection fits of fixed-frequency multi-Gaussian spectra.
+
+The ``ch3cn_spw`` model (`ch3cn_fits.multigaussian_model`) is a shared
+velocity and width plus one amplitude per line and a constant background.
+Given (vcen, width) the amplitudes and background are linear, so they are
+solved in closed form and only the two nonlinear parameters are searched:
+
+1. a coarse (vcen, width) grid, where each grid point costs one linear
+   least-squares solve shared by all spaxels;
+2. a bounded Levenberg-Marquardt refinement of (vcen, width) for all spaxels
+   at once (`batch_lm.batch_levmar`) on the projected model, with Kaufman's
+   approximation of the projected Jacobian.
+
+Amplitude and background limits are applied by clipping the linear
+solution.  Errors of all parameters come from the covariance of the full
+model at the solution, unscaled (as pyspeckit / mpfit report them), and the
+results are written in pyspeckit's parameter-cube layout so that
+``pyspeckit.Cube.load_model_fit`` reads them.
+"""
+import numpy as np
+from astropy import constants
+
+# write_fit is shared with the other batched fitters
+from batch_lm import batch_levmar, write_fit
+
+ckms = constants.c.to('km/s').value
+
+
+def gaussian_basis(frequencies, line_frequencies, vcen, width,
+                   derivatives=False):
+    """
+    Unit-amplitude Gaussians of every line (plus a constant column for the
+    background), as in `ch3cn_fits.multigaussian_model`
+
+    Parameters
+    ----------
+    frequencies : np.ndarray
+        [..., nchan] observed frequencies (GHz)
+    line_frequencies : np.ndarray
+        [nlines] rest frequencies (GHz)
+    vcen, width : np.ndarray
+        [...] velocity and width (km/s)
+
+    Returns
+    -------
+    basis : np.ndarray
+        [..., nchan, nlines+1]
+    dbasis_dv, dbasis_dw : np.ndarray
+        [..., nchan, nlines+1] derivatives, if ``derivatives`` is set
+    """
+    vcen = np.asarray(vcen, dtype='float')[..., None, None]
+    width = np.asarray(width, dtype='float')[..., None, None]
+    nu = np.asarray(frequencies, dtype='float')[..., :, None]
+    rest = np.asarray(line_frequencies, dtype='float')
+
+    fcen = rest*(1-vcen/ckms)
+    fwidth = width/ckms*fcen
+    dnu = nu - fcen
+    gauss = np.exp(-dnu**2/(2*fwidth**2))
+    ones = np.ones(gauss.shape[:-1] + (1,))
+    basis = np.concatenate([gauss, ones], axis=-1)
+    if not derivatives:
+        return basis
+
+    dg_df = gauss*dnu/fwidth**2
+    dg_ds = gauss*dnu**2/fwidth**3
+    dg_dv = dg_df*(-rest/ckms) + dg_ds*(-width/ckms*rest/ckms)
+    dg_dw = dg_ds*fcen/ckms
+    zeros = np.zeros_like(ones)
+    return (basis, np.concatenate([dg_dv, zeros], axis=-1),
+            np.concatenate([dg_dw, zeros], axis=-1))
+
+
+def _normal_solve(basis, weights, rhs, ridge=1e-10):
+    """
+    Solve the weighted normal equations (B^T W B) x = rhs for every fit,
+    with a tiny ridge so that lines outside the band get zero amplitude
+    """
+    btw = np.swapaxes(basis*weights[..., None], -1, -2)
+    btwb = np.matmul(btw, basis)
+    nlin = btwb.shape[-1]
+    scale = np.trace(btwb, axis1=-2, axis2=-1)/nlin
+    btwb = btwb + (ridge*scale)[:, None, None]*np.eye(nlin)
+    if rhs.ndim == btwb.ndim - 1:
+        return np.linalg.solve(btwb, rhs[..., None])[..., 0]
+    return np.linalg.solve(btwb, rhs)
+
+
+class MultiGaussVarPro(object):
+    """
+    The projected multi-Gaussian model as a `batch_lm.batch_levmar` function
+    of (vcen, width).  ``xdata`` is [nfits, 3, nchan]: frequency, data and
+    weights of each spectrum.
+
+    Parameters
+    ----------
+    line_frequencies : np.ndarray
+        Rest frequencies (GHz)
+    linear_lower, linear_upper : np.ndarray
+        [nlines+1] limits of the amplitudes and background
+    """
+    def __init__(self, line_frequencies, linear_lower=None, linear_upper=None):
+        self.line_frequencies = np.asarray(line_frequencies, dtype='float')
+        nlin = self.line_frequencies.size + 1
+        self.linear_lower = (np.full(nlin, -np.inf) if linear_lower is None
+                             else np.asarray(linear_lower, dtype='float'))
+        self.linear_upper = (np.full(nlin, np.inf) if linear_upper is None
+                             else np.asarray(linear_upper, dtype='float'))
+
+    def linear_parameters(self, params, xdata, derivatives=False):
+        frequencies, data, weights = xdata[:, 0], xdata[:, 1], xdata[:, 2]
+        bases = gaussian_basis(frequencies, self.line_frequencies,
+                               params[:, 0], params[:, 1],
+                               derivatives=derivatives)
+        basis = bases[0] if derivatives else bases
+        amps = _normal_solve(basis, weights,
+                             np.matmul((weights*data)[:, None, :], basis)[:, 0])
+        amps = np.clip(amps, self.linear_lower, self.linear_upper)
+        return amps, bases
+
+    def __call__(self, params, xdata):
+        weights = xdata[:, 2]
+        amps, (basis, dbv, dbw) = self.linear_parameters(params, xdata,
+                                                         derivatives=True)
+        model = np.matmul(basis, amps[..., None])[..., 0]
+        # Kaufman: project the fixed-amplitude Jacobian off the linear space
+        jac = np.concatenate([np.matmul(dbv, amps[..., None]),
+                              np.matmul(dbw, amps[..., None])], axis=-1)
+        btw = np.swapaxes(basis*weights[..., None], -1, -2)
+        coeffs = _normal_solve(basis, weights, np.matmul(btw, jac))
+        jac = jac - np.matmul(basis, coeffs)
+        return model, jac
+
+
+def grid_search(frequencies, spectra, line_frequencies, vcen_grid, width_grid):
+    """
+    Best (vcen, width) of every spectrum on a grid.  Only channels that are
+    finite in every spectrum are used, so one orthogonalization of the basis
+    per grid point serves all spectra: chi^2 = |y|^2 - |Q^T y|^2.  (The
+    linear parameter limits are not applied here; this is only the starting
+    point of the refinement.)
+
+    Parameters
+    ----------
+    frequencies : np.ndarray
+        [nchan] (GHz)
+    spectra : np.ndarray
+        [nchan, nspec]
+
+    Returns
+    -------
+    vcen, width : np.ndarray
+        [nspec]
+    """
+    good = np.all(np.isfinite(spectra), axis=1)
+    frequencies = np.asarray(frequencies)[good]
+    spectra = spectra[good]
+    best_proj = np.full(spectra.shape[1], -np.inf)
+    best_v = np.full(spectra.shape[1], np.nan)
+    best_w = np.full(spectra.shape[1], np.nan)
+    for vv in vcen_grid:
+        for ww in width_grid:
+            basis = gaussian_basis(frequencies, line_frequencies, vv, ww)
+            # lines outside the band have all-zero columns
+            norm = (basis**2).sum(axis=0)
+            qq = np.linalg.qr(basis[:, norm > 1e-12*norm.max()])[0]
+            proj = (qq.T.dot(spectra)**2).sum(axis=0)
+            better = proj > best_proj
+            best_proj[better] = proj[better]
+            best_v[better] = vv
+            best_w[better] = ww
+    return best_v, best_w
+
+
+def fit_cube(frequencies, cube, errmap, line_frequencies, mask=None,
+             vcen_limits=(50, 70), width_limits=(0.1, 6),
+             amplitude_limits=(-600, 600), background_limits=(0, 600),
+             vcen_step=0.5, nwidths=16, maxiter=100, chunksize=500):
+    """
+    Fit the multi-Gaussian model to every spaxel of a cube
+
+    Parameters
+    ----------
+    frequencies : np.ndarray
+        [nchan] (GHz)
+    cube : np.ndarray
+        [nchan, ny, nx] data
+    errmap : np.ndarray
+        [ny, nx] per-spaxel error
+    mask : np.ndarray, optional
+        [ny, nx] spaxels to fit (default: all with any finite data)
+    vcen_limits, width_limits, amplitude_limits, background_limits : tuple
+        Parameter limits, as ``minpars`` / ``maxpars`` of ``fiteach``
+    vcen_step, nwidths : float, int
+        Spacing of the velocity grid and number of (logarithmic) widths of
+        the grid search
+    chunksize : int
+        Number of spectra refined together
+
+    Returns
+    -------
+    parcube, errcube : np.ndarray
+        [2 + nlines + 1, ny, nx] in the ``ch3cn_spw`` parameter order
+        (shift, width, amplitudes..., background); NaN where not fitted
+    chi2 : np.ndarray
+        [ny, nx]
+    """
+    line_frequencies = np.asarray(line_frequencies, dtype='float')
+    nlines = line_frequencies.size
+    npars = nlines + 3
+    cube = np.asarray(cube, dtype='float')
+    nchan, ny, nx = cube.shape
+    if mask is None:
+        mask = np.any(np.isfinite(cube), axis=0)
+    mask = mask & np.isfinite(errmap) & (errmap > 0)
+
+    spectra = cube[:, mask]
+    nspec = spectra.shape[1]
+    linear_lower = np.array([amplitude_limits[0]]*nlines + [background_limits[0]])
+    linear_upper = np.array([amplitude_limits[1]]*nlines + [background_limits[1]])
+
+    vcen_grid = np.arange(vcen_limits[0], vcen_limits[1]+vcen_step/2., vcen_step)
+    width_grid = np.geomspace(width_limits[0], width_limits[1], nwidths)
+    vcen, width = grid_search(frequencies, spectra, line_frequencies,
+                              vcen_grid, width_grid)
+
+    varpro = MultiGaussVarPro(line_frequencies, linear_lower, linear_upper)
+    params = np.empty([nspec, 2])
+    amps = np.empty([nspec, nlines+1])
+    errors = np.empty([nspec, npars])
+    chi2 = np.empty(nspec)
+    # the bases are [nspec, nchan, nlines+1]: refine in chunks of spectra
+    for start in range(0, nspec, chunksize):
+        chunk = slice(start, min(start+chunksize, nspec))
+        finite = np.isfinite(spectra[:, chunk]).T
+        weights = finite / errmap[mask][chunk, None]**2
+        xdata = np.empty([finite.shape[0], 3, nchan])
+        xdata[:, 0] = frequencies
+        xdata[:, 1] = np.where(finite, spectra[:, chunk].T, 0)
+        xdata[:, 2] = weights
+
+        params[chunk], _, chi2[chunk], niter = batch_levmar(
+            varpro, np.array([vcen[chunk], width[chunk]]).T, xdata,
+            xdata[:, 1], weights,
+            lower=np.array([vcen_limits[0], width_limits[0]]),
+            upper=np.array([vcen_limits[1], width_limits[1]]),
+            maxiter=maxiter)
+
+        amps[chunk], (basis, dbv, dbw) = varpro.linear_parameters(params[chunk],
+                                                                  xdata,
+                                                                  derivatives=True)
+        # covariance of all parameters from the full (unprojected) Jacobian
+        jac = np.concatenate([np.matmul(dbv, amps[chunk, :, None]),
+                              np.matmul(dbw, amps[chunk, :, None]),
+                              basis], axis=-1)
+        jtwj = np.matmul(np.swapaxes(jac*weights[..., None], -1, -2), jac)
+        cov = np.linalg.pinv(jtwj)
+        errors[chunk] = np.sqrt(np.abs(np.diagonal(cov, axis1=-2, axis2=-1)))
+
+    parcube = np.full([npars, ny, nx], np.nan)
+    errcube = np.full([npars, ny, nx], np.nan)
+    chi2map = np.full([ny, nx], np.nan)
+    parcube[:, mask] = np.concatenate([params, amps], axis=1).T
+    errcube[:, mask] = errors.T
+    chi2map[mask] = chi2
+    return parcube, errcube, chi2map
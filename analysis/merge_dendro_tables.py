@@ -5,11 +5,15 @@ from astropy import table
 from astropy import units as u
 from astropy import coordinates
 import masscalc
+from catalog_store import default_store as store, choose_columns
 
-dendro_velo_tbl = Table.read(paths.tpath("dendro_core_velocities.ipac"), format="ascii.ipac")
-dendro_phot_tbl = Table.read(paths.tpath("dendrogram_continuum_catalog.ipac"), format='ascii.ipac')
+# the IPAC tables are only parsed when they have changed
+dendro_velo_tbl = store.load('dendro_core_velocities',
+                             paths.tpath("dendro_core_velocities.ipac"))
+dendro_phot_tbl = store.load('dendrogram_continuum_catalog',
+                             paths.tpath("dendrogram_continuum_catalog.ipac"),
+                             rename={'_idx': 'SourceID'})
 
-dendro_phot_tbl.rename_column('_idx','SourceID')
 dendro_merge = table.join(dendro_velo_tbl, dendro_phot_tbl,)
 
 brightest_line_flux = np.array([dendro_merge[y].data for y in
@@ -17,26 +21,24 @@ brightest_line_flux = np.array([dendro_merge[y].data for y in
 peak_line_flux = np.nanmax(brightest_line_flux, axis=0)
 peak_line_id = np.nanargmax(np.nan_to_num(brightest_line_flux), axis=0)
 peak_line_id[np.isnan(peak_line_flux)] = -999
-brightest_line_name = np.array([dendro_merge[('peak0species', 'peak1species',
-                                              'peak2species',
-                                              'peak3species')[y]][ii]
-                                if y >= 0 else 'NONE'
-                                for ii,y in enumerate(peak_line_id)])
+brightest_line_name = choose_columns(dendro_merge, ('peak0species', 'peak1species',
+                                                   'peak2species', 'peak3species'),
+                                     peak_line_id, fill_value='NONE')
 dendro_merge.add_column(Column(peak_line_flux, name='PeakLineFlux',
                                unit=dendro_merge['peak0'].unit))
 dendro_merge.add_column(Column(brightest_line_name, name='PeakLineSpecies'))
 
-peak_line_beam_area = u.Quantity([dendro_merge['beam{0}area'.format(pid)][ii]
-                                  if pid >= 0 else 1.0
-                                  for ii,pid in enumerate(peak_line_id)],
+peak_line_beam_area = u.Quantity(choose_columns(dendro_merge,
+                                                ['beam{0}area'.format(pid) for pid in range(4)],
+                                                peak_line_id, fill_value=1.0),
                                  u.sr)
-peak_line_freq = u.Quantity([dendro_merge['peak{0}freq'.format(pid)][ii]
-                             if pid >= 0 else 1.0
-                             for ii,pid in enumerate(peak_line_id)],
+peak_line_freq = u.Quantity(choose_columns(dendro_merge,
+                                           ['peak{0}freq'.format(pid) for pid in range(4)],
+                                           peak_line_id, fill_value=1.0),
                             u.GHz)
-peak_line_cont = u.Quantity([dendro_merge['continuum20pct{0}'.format(pid)][ii]
-                             if pid >= 0 else 0.0
-                             for ii,pid in enumerate(peak_line_id)],
+peak_line_cont = u.Quantity(choose_columns(dendro_merge,
+                                           ['continuum20pct{0}'.format(pid) for pid in range(4)],
+                                           peak_line_id, fill_value=0.0),
                             u.Jy)
 tbequiv = u.brightness_temperature(peak_line_beam_area, peak_line_freq)
 peak_line_brightness = (peak_line_flux*u.Jy).to(u.K, tbequiv)
@@ -44,10 +46,10 @@ dendro_merge.add_column(Column(peak_line_brightness, name='PeakLineBrightness'))
 continuum20pct_K = (peak_line_cont.to(u.K, tbequiv))
 dendro_merge.add_column(Column(continuum20pct_K, name='PeakLineContinuumBG'))
 
-tcm = Column([(masscalc.mass_conversion_factor(20).to(u.M_sun).value if
-               np.isnan(row['PeakLineBrightness']) else
-               masscalc.mass_conversion_factor(TK=row['PeakLineBrightness']).to(u.M_sun).value)
-              * row['peak_cont_flux'] for row in dendro_merge],
+peak_line_temperature = np.where(np.isnan(dendro_merge['PeakLineBrightness']), 20,
+                                 dendro_merge['PeakLineBrightness'])
+tcm = Column(masscalc.mass_conversion_factor(TK=peak_line_temperature).to(u.M_sun).value
+             * dendro_merge['peak_cont_flux'],
              name='T_corrected_mass', unit=u.M_sun)
 temperature_corrected_mass = tcm
 dendro_merge.add_column(temperature_corrected_mass)
@@ -78,4 +80,6 @@ dendro_merge.add_column(Column(nearest[1], name='nndist'))
 #hot = (dendro_merge
 
 
-dendro_merge.write(paths.tpath('dendro_merge_continuum_and_line.ipac'), format='ascii.ipac')
+store.write('dendro_merge_continuum_and_line', dendro_merge)
+store.export_ipac('dendro_merge_continuum_and_line',
+                  paths.tpath('dendro_merge_continuum_and_line.ipac'))
@@ -4,21 +4,26 @@ from astropy.table import Table, Column
 from astropy import table
 from astropy import units as u
 import masscalc
-
-outflow_tbl = Table.read(paths.tpath("outflow_co_photometry.ipac"), format='ascii.ipac')
-core_velo_tbl = Table.read(paths.tpath("core_velocities.ipac"), format="ascii.ipac")
-core_phot_tbl = Table.read(paths.tpath("continuum_photometry.ipac"), format='ascii.ipac')
+from catalog_store import default_store as store, lookup, choose_columns
+
+# the IPAC tables are only parsed when they have changed
+outflow_tbl = store.load('outflow_co_photometry',
+                         paths.tpath("outflow_co_photometry.ipac"), key='name')
+core_velo_tbl = store.load('core_velocities', paths.tpath("core_velocities.ipac"))
+core_phot_tbl = store.load('continuum_photometry',
+                           paths.tpath("continuum_photometry.ipac"),
+                           rename={'name': 'SourceID'})
 outflow_tbl.meta.update(core_phot_tbl.meta)
 ppbeam = core_phot_tbl.meta['keywords']['ppbeam_mm']['value']
 
 
-core_phot_tbl.rename_column('name','SourceID')
 cores_merge = table.join(core_velo_tbl, core_phot_tbl,)
 
 brightest_line_flux = np.array([cores_merge[y].data for y in ('peak0','peak1','peak2','peak3')])
 peak_line_flux = np.nanmax(brightest_line_flux, axis=0)
 peak_line_id = np.nanargmax(brightest_line_flux, axis=0)
-brightest_line_name = np.array([cores_merge[('peak0species','peak1species','peak2species','peak3species')[y]][ii] for ii,y in enumerate(peak_line_id)])
+brightest_line_name = choose_columns(cores_merge, ('peak0species','peak1species','peak2species','peak3species'),
+                                     peak_line_id)
 cores_merge.add_column(Column(peak_line_flux, name='PeakLineFlux', unit=cores_merge['peak0'].unit))
 cores_merge.add_column(Column(brightest_line_name, name='PeakLineSpecies'))
 
@@ -33,10 +38,10 @@ cores_merge.add_column(cont_brightness)
 aperturemass20k = cores_merge['sum'] / ppbeam * masscalc.mass_conversion_factor(20)
 cores_merge.add_column(Column(aperturemass20k.value, name='ApertureMass20K', unit=u.M_sun))
 
-temperature_corrected_mass = Column([(masscalc.mass_conversion_factor(20).value
-                                      if np.isnan(row['PeakLineBrightness'])
-                                      else masscalc.mass_conversion_factor(row['PeakLineBrightness'])).value
-                                     * row['peak'] for row in cores_merge],
+peak_line_temperature = np.where(np.isnan(cores_merge['PeakLineBrightness']), 20,
+                                 cores_merge['PeakLineBrightness'])
+temperature_corrected_mass = Column(masscalc.mass_conversion_factor(peak_line_temperature).value
+                                    * cores_merge['peak'],
                                     name='T_corrected_peakmass',
                                     unit=u.M_sun)
 cores_merge.add_column(temperature_corrected_mass)
@@ -92,20 +97,17 @@ cores_merge = cores_merge['SourceID',
                          ]
                          
 
-cores_merge.write(paths.tpath('core_continuum_and_line.ipac'),
-                  format='ascii.ipac', overwrite=True)
+store.write('core_continuum_and_line', cores_merge)
 
 
 ### Add columns to the outflow table from the core table ###
-newcol = Column([core_phot_tbl['peak_mass'][core_phot_tbl['SourceID'] == name][0]
-                 if any(core_phot_tbl['SourceID'] == name) else np.nan
-                 for name in outflow_tbl['SourceID']],
+newcol = Column(lookup(core_phot_tbl, 'SourceID', outflow_tbl['SourceID'],
+                       'peak_mass'),
                 name='CoreMass')
 outflow_tbl.add_column(newcol)
 
-newcol = Column([cores_merge['T_corrected_peakmass'][cores_merge['SourceID'] == name][0]
-                 if any(cores_merge['SourceID'] == name) else np.nan
-                 for name in outflow_tbl['SourceID']],
+newcol = Column(lookup(cores_merge, 'SourceID', outflow_tbl['SourceID'],
+                       'T_corrected_peakmass'),
                 name='TCorrectedCoreMass')
 outflow_tbl.add_column(newcol)
 
@@ -118,8 +120,8 @@ outflow_tbl.add_column(newcol)
 
 
 
-outflow_tbl.write(paths.tpath('outflows_with_cores.ipac'), format='ascii.ipac',
-                  overwrite=True)
+store.write('outflows_with_cores', outflow_tbl, key='name')
+store.export_ipac('outflows_with_cores', paths.tpath('outflows_with_cores.ipac'))
 
 # exec other merge now
 with open(paths.apath('merge_spectral_fits_with_photometry.py')) as source_file:
@@ -8,39 +8,39 @@ from astropy import table
 from astropy import units as u
 import masscalc
 import scipy.special
+from catalog_store import default_store as store
 
 spectral_line_fit_tbl = Table.read(paths.tpath('spectral_lines_and_fits.csv'))
 
-cores_merge = Table.read(paths.tpath('core_continuum_and_line.ipac'), format='ascii.ipac')
+cores_merge = store.read('core_continuum_and_line')
 ppbeam = cores_merge.meta['keywords']['ppbeam_mm']['value']
 
 molcld_exclude_names = ['13COv=0', 'C18O', 'H2CO', 'COv=0']
 molcld_exclude = np.array([any(nm in row['Species'] for nm in molcld_exclude_names)
                            for row in spectral_line_fit_tbl])
 
-brightest_noncld_lines = []
-brightest_noncld_qns = []
-brightest_noncld_fluxes = []
-brightest_fitted_brightness = []
-
-for row in cores_merge:
-    src = row['SourceID']
-
-    amplitudes = spectral_line_fit_tbl['{0}FittedAmplitude'.format(src)]
-    noncld_amplitudes = amplitudes * ~molcld_exclude
-
-    brightest_ind = np.argmax(amplitudes)
-    brightest_noncloud_ind = np.argmax(noncld_amplitudes)
-    if noncld_amplitudes.max() > 0:
-        brightest_noncld_lines.append(spectral_line_fit_tbl['Species'][brightest_noncloud_ind])
-        brightest_noncld_qns.append(spectral_line_fit_tbl['Resolved QNs'][brightest_noncloud_ind])
-        brightest_noncld_fluxes.append(amplitudes[brightest_noncloud_ind])
-        brightest_fitted_brightness.append(amplitudes[brightest_noncloud_ind]*spectral_line_fit_tbl['{0}JtoK'.format(src)][brightest_noncloud_ind])
-    else:
-        brightest_noncld_lines.append('-')
-        brightest_noncld_qns.append('-')
-        brightest_noncld_fluxes.append(np.nan)
-        brightest_fitted_brightness.append(np.nan)
+# [nlines, ncores] fitted amplitudes and J->K factors
+amplitudes = np.array([spectral_line_fit_tbl['{0}FittedAmplitude'.format(src)]
+                       for src in cores_merge['SourceID']]).T
+jtok = np.array([spectral_line_fit_tbl['{0}JtoK'.format(src)]
+                 for src in cores_merge['SourceID']]).T
+noncld_amplitudes = amplitudes * ~molcld_exclude[:, None]
+
+brightest_noncloud_ind = np.argmax(noncld_amplitudes, axis=0)
+cores = np.arange(len(cores_merge))
+has_line = noncld_amplitudes.max(axis=0) > 0
+brightest_noncld_lines = np.where(has_line,
+                                  np.asarray(spectral_line_fit_tbl['Species'])[brightest_noncloud_ind],
+                                  '-')
+brightest_noncld_qns = np.where(has_line,
+                                np.asarray(spectral_line_fit_tbl['Resolved QNs'])[brightest_noncloud_ind],
+                                '-')
+brightest_noncld_fluxes = np.where(has_line,
+                                   amplitudes[brightest_noncloud_ind, cores],
+                                   np.nan)
+brightest_fitted_brightness = np.where(has_line,
+                                       (amplitudes*jtok)[brightest_noncloud_ind, cores],
+                                       np.nan)
 
 
 cores_merge.add_column(Column(brightest_noncld_lines, 'BrightestFittedLine'))
@@ -56,25 +56,21 @@ cont_brightness = cores_merge['MeanContinuumBrightness']
 contincluded_line_brightness = cores_merge['BrightestFittedPeakPixBrightness'] + cont_brightness
 cores_merge.add_column(Column(contincluded_line_brightness, 'BrightestFittedPeakPixBrightnessWithcont', unit=u.K))
 
-temperature_corrected_aperturemass = Column([(masscalc.mass_conversion_factor(20).value
-                                          if np.isnan(row['BrightestFittedPeakPixBrightnessWithcont'])
-                                          or (row['BrightestFittedPeakPixBrightnessWithcont'] < 20)
-                                          else masscalc.mass_conversion_factor(row['BrightestFittedPeakPixBrightnessWithcont']).value)
-                                         * row['sum']/ppbeam for row in cores_merge],
-                                        name='T_corrected_aperturemass',
-                                        unit=u.M_sun)
+# 20 K where there is no (or a colder) line brightness
+line_temperature = np.asarray(cores_merge['BrightestFittedPeakPixBrightnessWithcont'])
+line_temperature = np.where(np.isnan(line_temperature) | (line_temperature < 20),
+                            20, line_temperature)
+mass_per_jy = masscalc.mass_conversion_factor(line_temperature).value
+
+temperature_corrected_aperturemass = Column(mass_per_jy * cores_merge['sum']/ppbeam,
+                                            name='T_corrected_aperturemass',
+                                            unit=u.M_sun)
 cores_merge.add_column(temperature_corrected_aperturemass)
 
 apertures = ('0p2', '0p4', '0p6', '0p8', '1p0', '1p5')
 for ap in apertures:
-    tcm = Column([(masscalc.mass_conversion_factor(20).value
-                   if np.isnan(row['BrightestFittedPeakPixBrightnessWithcont'])
-                   or row['BrightestFittedPeakPixBrightnessWithcont'] < 20
-                   else
-                   masscalc.mass_conversion_factor(row['BrightestFittedPeakPixBrightnessWithcont']).value)
-                  # already ppbeam corrected
-                  * row['cont_flux{0}arcsec'.format(ap)] for row in
-                  cores_merge],
+    # already ppbeam corrected
+    tcm = Column(mass_per_jy * cores_merge['cont_flux{0}arcsec'.format(ap)],
                  name='T_corrected_{0}aperturemass'.format(ap), unit=u.M_sun)
     cores_merge.add_column(tcm)
 
@@ -152,5 +148,6 @@ for category in np.unique(classification):
                                                        == category)))
 
 
-cores_merge.write(paths.tpath('core_continuum_and_line.ipac'),
-                  format='ascii.ipac', overwrite=True)
+store.write('core_continuum_and_line', cores_merge)
+store.export_ipac('core_continuum_and_line',
+                  paths.tpath('core_continuum_and_line.ipac'))
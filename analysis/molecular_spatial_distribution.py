@@ -8,13 +8,15 @@ from astropy.io import fits
 from astropy import log
 from line_to_image_list import line_to_image_list
 import pyregion
+import region_masks
 
 log.warning("Seems that the fraction is too low; some lines should be 100% threecore"
             " but are not")
 
-threecore_reg = pyregion.open(paths.rpath("three1ascores.reg"))
-twelvem_ptgs = pyregion.open(paths.rpath('12m_pointings.reg'))
-not_too_noisy = pyregion.open(paths.rpath('not_too_noisy_box.reg'))
+# region files; the masks are rasterized once per grid by region_masks
+threecore_reg = paths.rpath("three1ascores.reg")
+twelvem_ptgs = paths.rpath('12m_pointings.reg')
+not_too_noisy = paths.rpath('not_too_noisy_box.reg')
 
 for line, restfreq, velocity_res, spw in line_to_image_list:
     fn = paths.dpath('merge/moments/W51_b6_7M_12M.{0}.image.pbcor_medsub_moment0.fits'.format(line))
@@ -23,9 +25,10 @@ for line, restfreq, velocity_res, spw in line_to_image_list:
         fh = fits.open(fn)
         # integrate over 15 km/s...
         #noise = fits.getdata(noisefn) * 15
-        mask = threecore_reg.get_mask(fh[0])
-        mask_12m = twelvem_ptgs.get_mask(fh[0])
-        not_too_noisy_mask = not_too_noisy.get_mask(fh[0])
+        mask, mask_12m, not_too_noisy_mask = region_masks.get_masks([threecore_reg,
+                                                                     twelvem_ptgs,
+                                                                     not_too_noisy],
+                                                                    hdu=fh[0])
         pos = fh[0].data > np.nanstd(fh[0].data) * 2
 
         total_pos = fh[0].data[pos & mask_12m & not_too_noisy_mask].sum()
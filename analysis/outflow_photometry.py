@@ -5,11 +5,18 @@ from astropy import log
 from astropy import wcs
 import paths
 import pyregion
+import region_masks
 from astropy.io import fits
 from astropy.table import Table,Column
 import masscalc
 import constants
 from spectral_cube import SpectralCube
+from label_photometry import label_layers, grouped_channel_stats
+
+# rasterize all ellipses into one label cube and compute every statistic from
+# a single pass over the CO cube; set to False to use the (slow) per-region
+# masked-cube path
+use_label_photometry = True
 
 regions = pyregion.open(paths.rpath('outflow_ellipses.reg'))
 
@@ -42,6 +49,30 @@ suffixes = string.ascii_letters
 centralv_table = Table.read(paths.tpath('core_velocities.ipac'),
                             format='ascii.ipac')
 
+def co_mass_quantities(result, sumspec, spectral_axis, central_velo):
+    """
+    Column, mass and momentum from the brightness statistics of one region
+    """
+    result['peak_col'] = masscalc.co21_conversion_factor(result['peak'])*result['peak']*dv/masscalc.co_abund
+    result['peak_mass'] = (result['peak_col'] * pixsize_phys**2 *
+                           constants.mh2).to(u.M_sun)
+    result['mean_col'] = result['integ'] * masscalc.co21_conversion_factor(result['peak'])/masscalc.co_abund
+    result['total_mass'] = (result['mean_col'] * pixsize_phys**2 *
+                            result['npix'] *
+                            constants.mh2).to(u.M_sun)
+    channel_to_mass = (masscalc.co21_conversion_factor(result['peak']) /
+                       masscalc.co_abund * pixsize_phys**2 *
+                       result['npix'] * constants.mh2)
+    if central_velo is not None:
+        result['momentum'] = u.Quantity((np.abs(spectral_axis -
+                                                central_velo)
+                                         * sumspec * dv *
+                                         channel_to_mass).sum()).to(u.Msun * u.km/u.s)
+    else:
+        result['momentum'] = np.nan * u.Msun * u.km/u.s
+    return result
+
+outflows = []
 for reg in regions:
     if 'text' not in reg.attr[1]:
         continue
@@ -59,46 +90,74 @@ for reg in regions:
 
     ii = 0
     name = name_+'_a'
-    while name in results:
+    while name in results or name in [x[1] for x in outflows]:
         ii = ii+1
         name = name_+"_"+suffixes[ii]
 
-    log.info(name)
-
-    scube = cube.spectral_slab(v1, v2)
-    scube = scube.subcube_from_ds9region(shreg)
-    scube = scube.to(u.K, equivalencies=tb_equiv)
-
-    sumspec = scube.sum(axis=(1,2))
-
-    results[name] = {'peak': scube.max(),
-                     'mean': scube.mean(),
-                     'integ': np.nanmean(scube.moment0(axis=0).value)*u.K*u.km/u.s,
-                     'npix': scube.mask.include(view=(0, slice(None), slice(None))).sum(),
-                     'mean_velo': central_velo if central_velo is not None else np.nan*u.km/u.s,
-                     'pixsize': pixsize,
-                     'pixsize_phys': pixsize_phys,
-                     'v1': v1,
-                     'v2': v2,
-                     'SourceID': name_,
-                    }
-    results[name]['peak_col'] = masscalc.co21_conversion_factor(results[name]['peak'])*results[name]['peak']*dv/masscalc.co_abund
-    results[name]['peak_mass'] = (results[name]['peak_col'] * pixsize_phys**2 *
-                                  constants.mh2).to(u.M_sun)
-    results[name]['mean_col'] = results[name]['integ'] * masscalc.co21_conversion_factor(results[name]['peak'])/masscalc.co_abund
-    results[name]['total_mass'] = (results[name]['mean_col'] * pixsize_phys**2 *
-                                   results[name]['npix'] *
-                                   constants.mh2).to(u.M_sun)
-    channel_to_mass = (masscalc.co21_conversion_factor(results[name]['peak']) /
-                       masscalc.co_abund * pixsize_phys**2 *
-                       results[name]['npix'] * constants.mh2)
-    if central_velo is not None:
-        results[name]['momentum'] = u.Quantity((np.abs(scube.spectral_axis -
-                                                       central_velo)
-                                                * sumspec * dv *
-                                                channel_to_mass).sum()).to(u.Msun * u.km/u.s)
-    else:
-        results[name]['momentum'] = np.nan * u.Msun * u.km/u.s
+    outflows.append((shreg, name, name_, v1, v2, central_velo))
+
+if use_label_photometry:
+    masks = region_masks.get_masks([shreg for shreg, name, name_, v1, v2,
+                                    central_velo in outflows],
+                                   header=cube.wcs.celestial.to_header(),
+                                   shape=cube.shape[1:])
+    layers = label_layers(masks)
+    log.info("{0} outflow regions rasterized into {1} label layers"
+             .format(len(masks), len(layers)))
+    stats = grouped_channel_stats(cube, layers)
+
+    # the brightness temperature conversion is a single factor for a
+    # single-beam cube
+    jy_to_k = (1*cube.unit).to(u.K, equivalencies=tb_equiv).value
+    spectral_axis = cube.spectral_axis
+
+    for ii, (shreg, name, name_, v1, v2, central_velo) in enumerate(outflows):
+        log.info(name)
+        vmin, vmax = min(v1, v2), max(v1, v2)
+        chans = (spectral_axis >= vmin) & (spectral_axis <= vmax)
+
+        sumspec = stats['sum'][ii, chans] * jy_to_k * u.K
+        npix = stats['npix'][ii]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sumspec.sum() / stats['count'][ii, chans].sum()
+
+        results[name] = {'peak': np.nanmax(stats['max'][ii, chans]) * jy_to_k * u.K,
+                         'mean': mean,
+                         'integ': (sumspec.sum() * dv / npix).to(u.K*u.km/u.s),
+                         'npix': npix,
+                         'mean_velo': central_velo if central_velo is not None else np.nan*u.km/u.s,
+                         'pixsize': pixsize,
+                         'pixsize_phys': pixsize_phys,
+                         'v1': v1,
+                         'v2': v2,
+                         'SourceID': name_,
+                        }
+        co_mass_quantities(results[name], sumspec, spectral_axis[chans],
+                           central_velo)
+
+else:
+    for shreg, name, name_, v1, v2, central_velo in outflows:
+        log.info(name)
+
+        scube = cube.spectral_slab(v1, v2)
+        scube = scube.subcube_from_ds9region(shreg)
+        scube = scube.to(u.K, equivalencies=tb_equiv)
+
+        sumspec = scube.sum(axis=(1,2))
+
+        results[name] = {'peak': scube.max(),
+                         'mean': scube.mean(),
+                         'integ': np.nanmean(scube.moment0(axis=0).value)*u.K*u.km/u.s,
+                         'npix': scube.mask.include(view=(0, slice(None), slice(None))).sum(),
+                         'mean_velo': central_velo if central_velo is not None else np.nan*u.km/u.s,
+                         'pixsize': pixsize,
+                         'pixsize_phys': pixsize_phys,
+                         'v1': v1,
+                         'v2': v2,
+                         'SourceID': name_,
+                        }
+        co_mass_quantities(results[name], sumspec, scube.spectral_axis,
+                           central_velo)
 
 # invert the table to make it parseable by astropy...
 # (this shouldn't be necessary....)
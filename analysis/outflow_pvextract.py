@@ -15,6 +15,7 @@ from pvextractor import extract_pv_slice
 from pvextractor.geometry import Path
 
 from line_point_offset import offset_to_point
+from pv_batch import PVExtractor
 
 e8mm = coordinates.SkyCoord(290.93289, 14.507833, frame='fk5', unit=(u.deg,
                                                                      u.deg))
@@ -91,6 +92,14 @@ parameters = {'e8':
               },
              }
 
+def velocity_slab(cube):
+    cube = cube.with_spectral_unit(u.km/u.s, velocity_convention='radio')
+    return cube.spectral_slab(-200*u.km/u.s, 200*u.km/u.s)
+
+# the cube is only read if one of its PV slices is not on disk yet, and then
+# every slice requested from it comes from that one read
+pvservice = PVExtractor(preprocess=velocity_slab)
+
 for ii, (fn, stretch, vmin, vmax, source) in enumerate(
     (
      #('longbaseline/W51e2cax.CH3CN_K3_nat.image.fits',
@@ -110,15 +119,11 @@ for ii, (fn, stretch, vmin, vmax, source) in enumerate(
 
     pars = parameters[source]
 
-    cube = SpectralCube.read(paths.dpath(fn))
-    cube = cube.with_spectral_unit(u.km/u.s, velocity_convention='radio')
-    cube = cube.spectral_slab(-200*u.km/u.s, 200*u.km/u.s)
-
     outname = os.path.split('{0}_{1}.{{extension}}'.format(fn[:-5], source))[-1]
 
     outpath_pv = paths.dpath('pv/'+outname.format(extension='fits'))
     if not os.path.exists(outpath_pv):
-        pv = extract_pv_slice(cube.hdu, pars['path'])
+        pv = pvservice.extract(paths.dpath(fn), {source: pars['path']})[source]
         #pv.data -= np.nanmin(pv.data) - 1e-3
         pv.writeto(outpath_pv, clobber=True)
     else:
@@ -0,0 +1,216 @@
+"""
+Dependency-tracked cache of derived data products (moment maps, slabs, ...).
+
+Each product file is recorded in a json manifest in its directory together
+with the inputs it was made from: the source file's size and mtime (and
+optionally its md5 checksum), the parameters used to make it (slices,
+velocity range, beam cut, ...), and a code version string.  A product is
+valid only if its file exists and all of those still match, so changing a
+parameter or the input cube invalidates exactly the products that depend on
+it.  Invalid products are recomputed with `ProductCache.ensure`, optionally
+on a process pool; scripts that only consume products use
+`ProductCache.lookup` / `ProductCache.products`.
+"""
+import os
+import json
+import glob
+import fnmatch
+import hashlib
+import multiprocessing
+import numpy as np
+from astropy import units as u
+from astropy import log
+
+
+def file_signature(filename, checksum=False):
+    """
+    Identify the state of an input file by its size and mtime and, if
+    ``checksum`` is set, by its md5 (slow for big cubes, but robust to
+    copies that change the mtime)
+    """
+    st = os.stat(filename)
+    signature = {'path': os.path.abspath(filename),
+                 'size': st.st_size,
+                 'mtime': st.st_mtime,
+                }
+    if checksum:
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(2**24), b''):
+                md5.update(chunk)
+        signature['md5'] = md5.hexdigest()
+    return signature
+
+
+def normalize(value):
+    """
+    Convert parameters (Quantities, slices, numpy types, tuples) into json-able
+    values so they can be stored and compared
+    """
+    if isinstance(value, u.Quantity):
+        return [normalize(value.value), value.unit.to_string()]
+    elif isinstance(value, slice):
+        return ['slice', value.start, value.stop, value.step]
+    elif isinstance(value, np.ndarray):
+        return [normalize(x) for x in value.tolist()]
+    elif isinstance(value, (list, tuple)):
+        return [normalize(x) for x in value]
+    elif isinstance(value, dict):
+        return {str(k): normalize(v) for k, v in value.items()}
+    elif isinstance(value, np.generic):
+        return value.item()
+    else:
+        return value
+
+
+def _compute(args):
+    func, products, funcargs = args
+    return func(products, *funcargs)
+
+
+class ProductCache(object):
+    """
+    Parameters
+    ----------
+    directory : str
+        Directory holding the products and the manifest
+    manifest : str
+        Name of the manifest file within ``directory``
+    """
+    def __init__(self, directory, manifest='product_manifest.json'):
+        self.directory = directory
+        self.manifest_file = os.path.join(directory, manifest)
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            if os.path.exists(self.manifest_file):
+                with open(self.manifest_file, 'r') as fh:
+                    self._manifest = json.load(fh)
+            else:
+                self._manifest = {}
+        return self._manifest
+
+    def save(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        tmpfile = self.manifest_file + '.tmp'
+        with open(tmpfile, 'w') as fh:
+            json.dump(self.manifest, fh, indent=1, sort_keys=True)
+        os.rename(tmpfile, self.manifest_file)
+
+    def _key(self, product):
+        return os.path.relpath(os.path.abspath(product),
+                               os.path.abspath(self.directory))
+
+    @staticmethod
+    def inputs(source, code_version, checksum=False, **params):
+        """
+        The input record of a product made from ``source`` with ``params``
+        """
+        return {'source': file_signature(source, checksum=checksum),
+                'code_version': str(code_version),
+                'params': normalize(params),
+               }
+
+    def _source_unchanged(self, record):
+        source = record['inputs']['source']
+        if not os.path.exists(source['path']):
+            return False
+        current = file_signature(source['path'], checksum='md5' in source)
+        return current == source
+
+    def is_valid(self, products, inputs):
+        """
+        True if every product exists and was made from ``inputs``.  Products
+        recorded as skipped (the computation decided there was nothing to
+        make) are valid too, so they are not retried until the inputs change.
+        """
+        for product in products:
+            record = self.manifest.get(self._key(product))
+            if record is None or record['inputs'] != inputs:
+                return False
+            if record['status'] == 'ok' and not os.path.exists(product):
+                return False
+        return True
+
+    def record(self, products, inputs, status='ok'):
+        for product in products:
+            self.manifest[self._key(product)] = {'inputs': inputs,
+                                                 'status': status}
+
+    def lookup(self, product):
+        """
+        Return ``product`` if it can be used, else None.
+
+        Tracked products are checked against the current state of their
+        source file; untracked (legacy) products are returned if they exist.
+        """
+        record = self.manifest.get(self._key(product))
+        if record is None:
+            return product if os.path.exists(product) else None
+        if record['status'] != 'ok' or not os.path.exists(product):
+            return None
+        if not self._source_unchanged(record):
+            log.warning("{0} is stale: its source has changed".format(product))
+            return None
+        return product
+
+    def products(self, pattern):
+        """
+        All usable products whose path (relative to the cache directory)
+        matches the glob ``pattern``
+        """
+        candidates = set(os.path.join(self.directory, key)
+                         for key in self.manifest
+                         if fnmatch.fnmatch(key, pattern))
+        candidates |= set(glob.glob(os.path.join(self.directory, pattern)))
+        return sorted(fn for fn in candidates
+                      if self.lookup(fn) is not None)
+
+    def ensure(self, tasks, func, nprocs=1):
+        """
+        (Re)compute every invalid product.
+
+        Parameters
+        ----------
+        tasks : list
+            ``(products, inputs, args)`` tuples: the product file names made
+            together, their input record (see `inputs`), and extra arguments
+        func : function
+            ``func(products, *args)`` makes the products and returns False if
+            there was nothing to make (the task is then recorded as
+            skipped).  Must be a module-level function if ``nprocs > 1``.
+        nprocs : int
+            Number of processes used for the recomputation
+
+        Returns
+        -------
+        ncomputed : int
+            The number of tasks that were recomputed
+        """
+        todo = [(products, inputs, args) for products, inputs, args in tasks
+                if not self.is_valid(products, inputs)]
+        log.info("{0} of {1} product sets need to be (re)computed"
+                 .format(len(todo), len(tasks)))
+        if not todo:
+            return 0
+
+        jobs = [(func, products, args) for products, inputs, args in todo]
+        if nprocs > 1:
+            pool = multiprocessing.Pool(nprocs)
+            try:
+                statuses = pool.map(_compute, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            statuses = [_compute(job) for job in jobs]
+
+        for (products, inputs, args), status in zip(todo, statuses):
+            self.record(products, inputs,
+                        status='skipped' if status is False else 'ok')
+        self.save()
+
+        return len(todo)
@@ -0,0 +1,251 @@
+"""
+Radial profiles from precomputed radius-bin labels.
+
+`image_tools.radialprofile.azimuthalAverage` recomputes the radius grid and
+re-sorts it on every call.  Here the integer bin index of every pixel is
+computed once per (center, pixel grid) and reused: profiles of any number of
+images, or of every channel of a cube, are then `np.bincount` reductions over
+those labels.
+
+Bin ``b`` covers ``b*binsize <= r < (b+1)*binsize`` (the same bins as
+``azimuthalAverage``), ``bins`` are the bin centers in pixels.
+"""
+import numpy as np
+from astropy import units as u
+from astropy import wcs
+
+
+class RadialBinner(object):
+    def __init__(self, shape, center, binsize=1.0, mask=None, rmax=None):
+        """
+        Parameters
+        ----------
+        shape : tuple
+            The (ny, nx) shape of the images to be profiled
+        center : tuple
+            The (x, y) pixel center of the profile
+        binsize : float
+            Bin width in pixels
+        mask : np.ndarray of bool, optional
+            Pixels to include (e.g., an exclusion region has been removed)
+        rmax : float, optional
+            Maximum radius in pixels to include
+        """
+        self.shape = tuple(shape)
+        self.center = center
+        self.binsize = binsize
+
+        yy,xx = np.indices(self.shape)
+        rr = ((xx-center[0])**2 + (yy-center[1])**2)**0.5
+
+        include = np.ones(self.shape, dtype='bool')
+        if mask is not None:
+            include &= mask
+        if rmax is not None:
+            include &= rr < rmax
+
+        self.index = np.flatnonzero(include)
+        self.labels = (rr.flat[self.index] / binsize).astype('int')
+        self.nbins = self.labels.max()+1 if self.labels.size else 0
+        self.npix = np.bincount(self.labels, minlength=self.nbins)
+        self.bins = (np.arange(self.nbins)+0.5)*binsize
+
+    def _reduce(self, values):
+        """
+        Sum ``values`` ([nplanes, npix_included]) into the radial bins of each
+        plane with one bincount
+        """
+        nplanes = values.shape[0]
+        offsets = (np.arange(nplanes)*self.nbins)[:,None]
+        labels = (self.labels[None,:] + offsets).ravel()
+        return np.bincount(labels, weights=values.ravel(),
+                           minlength=nplanes*self.nbins).reshape(nplanes,
+                                                                 self.nbins)
+
+    def profile(self, data, weights=None):
+        """
+        Compute the radial profiles of a 2D image or of every plane of a 3D
+        cube.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            [ny, nx] image or [nplanes, ny, nx] cube.  NaNs are ignored.
+        weights : np.ndarray, optional
+            [ny, nx] per-pixel weights, as in ``azimuthalAverage``
+
+        Returns
+        -------
+        profile : dict
+            ``radius`` (bin centers, pixels), ``npix`` (pixels per bin,
+            including NaNs), and ``count``, ``sum``, ``mean`` and
+            ``cumulative`` (cumulative sum).  For a cube input each of the
+            last four is [nplanes, nbins].
+        """
+        data = np.asarray(data)
+        squeeze = data.ndim == 2
+        if squeeze:
+            data = data[None,:,:]
+        if data.shape[1:] != self.shape:
+            raise ValueError("Data shape {0} does not match the binner shape "
+                             "{1}".format(data.shape[1:], self.shape))
+
+        values = data.reshape(data.shape[0], -1)[:, self.index]
+        good = np.isfinite(values)
+        values = np.where(good, values, 0)
+        if weights is None:
+            wts = good.astype('float')
+        else:
+            wts = good * np.asarray(weights).flat[self.index][None,:]
+
+        count = self._reduce(good.astype('float'))
+        total = self._reduce(values)
+        wtsum = self._reduce(wts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._reduce(values*wts) / wtsum
+
+        result = {'radius': self.bins,
+                  'npix': self.npix,
+                  'count': count,
+                  'sum': total,
+                  'mean': mean,
+                  'cumulative': total.cumsum(axis=1),
+                 }
+        if squeeze:
+            for key in ('count', 'sum', 'mean', 'cumulative'):
+                result[key] = result[key][0]
+        return result
+
+
+def grid_key(mywcs, shape):
+    """
+    Hashable key identifying a celestial pixel grid
+    """
+    celwcs = mywcs.celestial
+    return (tuple(shape[-2:]),
+            tuple(np.round(celwcs.wcs.crval, 10)),
+            tuple(np.round(celwcs.wcs.crpix, 6)),
+            tuple(np.round(celwcs.pixel_scale_matrix.ravel(), 14)),
+            tuple(celwcs.wcs.ctype),
+           )
+
+
+class RegionBinners(object):
+    """
+    Cache of per-region cutout slices and `RadialBinner` s, computed once per
+    (region, pixel grid).
+
+    Parameters
+    ----------
+    names : list
+        Region names
+    positions : `~astropy.coordinates.SkyCoord`
+        Region centers
+    size : `~astropy.units.Quantity`
+        Full width of the square cutout around each center (angular)
+    binsize : float
+        Bin width in pixels
+    """
+    def __init__(self, names, positions, size, binsize=1.0):
+        self.names = list(names)
+        self.positions = positions
+        self.size = u.Quantity(size)
+        self.binsize = binsize
+        self._cache = {}
+
+    def for_grid(self, mywcs, shape):
+        """
+        Return ``{name: (slices, binner)}`` for the pixel grid, computing it
+        only the first time the grid is seen.  Regions that fall off the grid
+        are skipped.
+        """
+        key = grid_key(mywcs, shape)
+        if key in self._cache:
+            return self._cache[key]
+
+        celwcs = mywcs.celestial
+        ny, nx = shape[-2:]
+        pixscale = wcs.utils.proj_plane_pixel_scales(celwcs).mean() * u.deg
+        halfsize = (self.size.max()/pixscale).decompose().value / 2.
+
+        xpix, ypix = celwcs.wcs_world2pix(self.positions.ra.deg,
+                                          self.positions.dec.deg, 0)
+
+        binners = {}
+        for name, xc, yc in zip(self.names, np.atleast_1d(xpix),
+                                np.atleast_1d(ypix)):
+            x0 = max(int(np.round(xc-halfsize)), 0)
+            x1 = min(int(np.round(xc+halfsize))+1, nx)
+            y0 = max(int(np.round(yc-halfsize)), 0)
+            y1 = min(int(np.round(yc+halfsize))+1, ny)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            slices = (slice(y0, y1), slice(x0, x1))
+            binners[name] = (slices,
+                             RadialBinner((y1-y0, x1-x0), (xc-x0, yc-y0),
+                                          binsize=self.binsize))
+
+        self._cache[key] = binners
+        return binners
+
+    def profiles(self, data, mywcs, weights=None):
+        """
+        Profiles of every region for one image or cube
+
+        Parameters
+        ----------
+        data : np.ndarray
+            [ny, nx] image or [nchan, ny, nx] cube on the ``mywcs`` grid
+        mywcs : `~astropy.wcs.WCS`
+            The WCS of ``data``
+
+        Returns
+        -------
+        profiles : dict
+            ``{name: profile}`` with ``profile`` as returned by
+            `RadialBinner.profile`
+        """
+        binners = self.for_grid(mywcs, data.shape)
+        result = {}
+        for name, (slices, binner) in binners.items():
+            view = data[(Ellipsis,)+slices]
+            wtview = None if weights is None else weights[slices]
+            result[name] = binner.profile(view, weights=wtview)
+        return result
+
+
+def multi_image_profiles(filenames, names, positions, size, binsize=1.0):
+    """
+    Radial profiles of every region in every image, reading each file once.
+    Files sharing a pixel grid share their bin labels.
+
+    Returns
+    -------
+    profiles : dict
+        ``{filename: {name: profile}}``.  Each profile additionally carries
+        the ``pixscale`` (deg) and, if the file has a beam, the ``ppbeam``
+        (pixels per beam).
+    """
+    from astropy.io import fits
+    import radio_beam
+
+    binners = RegionBinners(names, positions, size, binsize=binsize)
+    results = {}
+    for fn in filenames:
+        fh = fits.open(fn)
+        mywcs = wcs.WCS(fh[0].header).celestial
+        data = fh[0].data.squeeze()
+        pixscale = wcs.utils.proj_plane_pixel_scales(mywcs).mean()
+        try:
+            beam = radio_beam.Beam.from_fits_header(fh[0].header)
+            ppbeam = (beam.sr/(pixscale**2*u.deg**2)).decompose().value
+        except (KeyError, TypeError):
+            ppbeam = None
+
+        profs = binners.profiles(data, mywcs)
+        for prof in profs.values():
+            prof['pixscale'] = pixscale
+            prof['ppbeam'] = ppbeam
+        results[fn] = profs
+        fh.close()
+    return results
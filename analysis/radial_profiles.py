@@ -17,8 +17,9 @@ from astropy import coordinates
 import itertools
 import masscalc
 import dust_emissivity
-import reproject
+import reprojection_cache
 from label_lines import labelLine
+from radial_bins import RegionBinners
 
 pl.matplotlib.rc_file('pubfiguresrc')
 pl.rcParams['backend'] = 'Qt5Agg'
@@ -62,6 +63,10 @@ def make_rprof(regions, ploteach=False):
 
     size = u.Quantity([1.25,1.25], u.arcsec)
 
+    # radius-bin labels are computed once per (region, pixel grid) and shared
+    # by all images on that grid
+    rbinners = RegionBinners(names, center_positions, size, binsize=1.0)
+
     if ploteach:
         nplots = len(names)
         for ii in range(nplots):
@@ -88,12 +93,15 @@ def make_rprof(regions, ploteach=False):
             pixscale = (mywcs.pixel_scale_matrix.diagonal()**2).sum()**0.5
             ppbeam = (beam.sr/(pixscale**2*u.deg**2)).decompose().value / u.beam
             #print("fn  {0} ppbeam={1:0.2f}".format(fn, ppbeam))
+
+            profiles = rbinners.profiles(fh[0].data, mywcs)
             
             for jj,(name,position) in enumerate(zip(names, center_positions)):
-                cutout = Cutout2D(fh[0].data, position, size, wcs=mywcs)
-
-                nr, bins, rprof = azimuthalAverage(cutout.data, binsize=1.0,
-                                                   return_nr=True)
+                if name not in profiles:
+                    continue
+                nr, bins, rprof = (profiles[name]['npix'],
+                                   profiles[name]['radius'],
+                                   profiles[name]['mean'])
 
                 linestyle = next(linestyles[name])
 
@@ -167,11 +175,11 @@ def make_rprof(regions, ploteach=False):
     beam = radio_beam.Beam.from_fits_header(fh[0].header)
     pixscale = (mywcs.pixel_scale_matrix.diagonal()**2).sum()**0.5
     ppbeam = (beam.sr/(pixscale**2*u.deg**2)).decompose().value / u.beam
+    profiles = rbinners.profiles(fh[0].data, mywcs)
     for ii,(name,position) in enumerate(zip(names, center_positions)):
-        cutout = Cutout2D(fh[0].data, position, size, wcs=mywcs)
-
-        nr, bins, rprof = azimuthalAverage(cutout.data, binsize=1.0,
-                                           return_nr=True)
+        nr, bins, rprof = (profiles[name]['npix'],
+                           profiles[name]['radius'],
+                           profiles[name]['mean'])
 
         pl.figure(nplots*3+1, figsize=figsize)
         #pl.title(fn.replace(".image.pbcor.fits",""))
@@ -369,7 +377,7 @@ def make_rprof(regions, ploteach=False):
         bigpixscale = (bigwcs.pixel_scale_matrix.diagonal()**2).sum()**0.5 * u.deg
         ch3ohN = ch3ohN_hdul[0].data
         ch3ohT = ch3ohT_hdul[0].data
-        dust_brightness,wts = reproject.reproject_interp(fits.open(paths.dpath('W51_te_continuum_best.fits')),
+        dust_brightness,wts = reprojection_cache.reproject_interp(fits.open(paths.dpath('W51_te_continuum_best.fits')),
                                                          ch3ohN_hdul[0].header)
         contbm = radio_beam.Beam.from_fits_header(paths.dpath("W51_te_continuum_best.fits"))
 
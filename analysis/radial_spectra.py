@@ -3,14 +3,19 @@ from astropy import coordinates
 import pylab as pl
 import spectral_cube
 from spectral_cube import SpectralCube
+from spectral_cube.lower_dimensional_structures import (OneDSpectrum,
+                                                       VaryingResolutionOneDSpectrum)
 import os
 from scipy import ndimage
+import scipy.sparse
 import itertools
 from astropy.io import fits
 import radio_beam
 import numpy as np
 from astropy import units as u
 import pyregion
+import region_masks
+from stage_timing import stage, staged
 import image_tools
 from astropy import wcs
 
@@ -18,40 +23,160 @@ import re
 import glob
 
 
-def extract_radial_spectrum(cube, coordinate, excludemask, radial_bins=[(0,1),(1,2)]):
-
-
-    yy,xx = np.indices(cube.shape[1:])
-    rr = ((yy-coordinate[1])**2 + (xx-coordinate[0])**2)**0.5
-
-    spectra = {}
-    for inner_bin_radius,outer_bin_radius in radial_bins:
-        radial_mask = (rr > inner_bin_radius) & (rr < outer_bin_radius)
-        radial_mask &= ~excludemask
-
-        avspec = cube.with_mask(radial_mask).mean(axis=(1,2))
-
-        spectra[(inner_bin_radius,outer_bin_radius)] = avspec
+def annulus_matrix(shape, coordinates, excludemasks, radial_bins):
+    """
+    Build the sparse (source, annulus) x pixel averaging matrix.
+
+    Row ``i`` of the returned matrix selects the pixels of annulus ``i``.
+    Annuli may overlap, both between sources and between the bins of one
+    source: a pixel is included in every annulus that contains it.
+
+    Parameters
+    ----------
+    shape : tuple
+        The (ny, nx) spatial shape of the cube
+    coordinates : list
+        (x, y) pixel coordinates of each source
+    excludemasks : list
+        Boolean [ny, nx] masks of the pixels to exclude for each source (or
+        None)
+    radial_bins : list
+        (inner, outer) radii in pixels for each source, or a single list
+        applied to every source
+
+    Returns
+    -------
+    matrix : `scipy.sparse.csr_matrix`
+        [nsources*nbins, ny*nx] selection matrix
+    keys : list
+        (source index, (inner, outer)) for each row
+    """
+    yy,xx = np.indices(shape)
+
+    if len(radial_bins) > 0 and np.ndim(radial_bins[0]) == 1:
+        radial_bins = [radial_bins] * len(coordinates)
+
+    rows, cols, keys = [], [], []
+    for ii, (coordinate, excludemask, srcbins) in enumerate(zip(coordinates,
+                                                               excludemasks,
+                                                               radial_bins)):
+        srcbins = np.asarray(srcbins, dtype='float')
+        rr = (((yy-coordinate[1])**2 + (xx-coordinate[0])**2)**0.5).ravel()
+        if excludemask is None:
+            pix = np.arange(rr.size)
+        else:
+            pix = np.flatnonzero(~excludemask.ravel())
+        rr = rr[pix]
+        # one (row, pixel) pair per pixel of each annulus
+        for inner_bin_radius, outer_bin_radius in srcbins:
+            inbin = (rr > inner_bin_radius) & (rr < outer_bin_radius)
+            rows.append(np.full(np.count_nonzero(inbin), len(keys),
+                                dtype='int'))
+            cols.append(pix[inbin])
+            keys.append((ii, (inner_bin_radius, outer_bin_radius)))
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    matrix = scipy.sparse.csr_matrix((np.ones(rows.size), (rows, cols)),
+                                     shape=(len(keys), shape[0]*shape[1]))
+    return matrix, keys
+
+def _spectrum_like(cube, values):
+    """
+    Make a OneDSpectrum carrying the cube's spectral WCS, units and beams
+    """
+    spwcs = cube.wcs.sub([wcs.WCSSUB_SPECTRAL])
+    if hasattr(cube, 'beams'):
+        return VaryingResolutionOneDSpectrum(value=values, unit=cube.unit,
+                                             wcs=spwcs, meta=cube.meta,
+                                             beams=cube.beams)
+    else:
+        return OneDSpectrum(value=values, unit=cube.unit, wcs=spwcs,
+                            meta=cube.meta, beam=getattr(cube, 'beam', None))
+
+@staged(kind='io')
+def extract_radial_spectra(cube, coordinates, excludemasks, radial_bins,
+                           chunksize=64):
+    """
+    Extract the mean spectrum of every annulus around every source in one
+    streaming pass over the cube.
+
+    The cube is read ``chunksize`` channels at a time; each chunk is
+    multiplied by the sparse annulus matrix, and the sum and the number of
+    finite pixels are accumulated so that NaNs and masked pixels are ignored
+    channel-by-channel (as in ``cube.with_mask(mask).mean(axis=(1,2))``).
+
+    Returns
+    -------
+    spectra : list
+        One ``{(inner, outer): spectrum}`` dict per source
+    """
+    matrix, keys = annulus_matrix(cube.shape[1:], coordinates, excludemasks,
+                                  radial_bins)
+
+    nchan = cube.shape[0]
+    sums = np.zeros([len(keys), nchan])
+    counts = np.zeros([len(keys), nchan])
+    for start in range(0, nchan, chunksize):
+        chunk = cube.filled_data[start:start+chunksize].value
+        chunk = chunk.reshape(chunk.shape[0], -1).T
+        finite = np.isfinite(chunk)
+        sums[:, start:start+chunksize] = matrix.dot(np.where(finite, chunk, 0))
+        counts[:, start:start+chunksize] = matrix.dot(finite.astype('float'))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+
+    spectra = [{} for coordinate in coordinates]
+    for (ii, key), values in zip(keys, means):
+        spectra[ii][key] = _spectrum_like(cube, values)
 
     return spectra
 
-def spectra_from_cubefn(cubefn, reg, bins_arcsec, coordinate):
-    cube = SpectralCube.read(cubefn)
+def extract_radial_spectrum(cube, coordinate, excludemask, radial_bins=[(0,1),(1,2)]):
+    return extract_radial_spectra(cube, [coordinate], [excludemask],
+                                  radial_bins)[0]
 
+def _source_geometry(cube, reg, bins_arcsec, coordinate):
     pixcoordinate = cube.wcs.celestial.wcs_world2pix(coordinate.ra.deg,
                                                      coordinate.dec.deg,
                                                      0)
 
-    pixscale = (cube.wcs.celestial.pixel_scale_matrix.diagonal()**2).sum()**0.5
+    pixscale = wcs.utils.proj_plane_pixel_scales(cube.wcs.celestial).mean()
 
-    includemask = reg.get_mask(header=cube.wcs.celestial.to_header(),
-                               shape=cube.shape[1:])
+    includemask = region_masks.get_mask(reg,
+                                        header=cube.wcs.celestial.to_header(),
+                                        shape=cube.shape[1:])
 
+    return pixcoordinate, ~includemask, bins_arcsec/(pixscale*3600)
 
-    spectra = extract_radial_spectrum(cube, pixcoordinate, ~includemask,
-                                      radial_bins=bins_arcsec/(pixscale*3600))
+@staged
+def spectra_from_cubefn_multi(cubefn, sources):
+    """
+    Read ``cubefn`` once and extract the radial spectra of every source.
 
-    return spectra
+    Parameters
+    ----------
+    sources : list
+        (reg, bins_arcsec, coordinate) for each source
+
+    Returns
+    -------
+    spectra : list
+        One ``{(inner, outer): spectrum}`` dict per source
+    """
+    with stage('read_cube', kind='io', filename=cubefn):
+        cube = SpectralCube.read(cubefn)
+
+    geometry = [_source_geometry(cube, reg, bins_arcsec, coordinate)
+                for reg, bins_arcsec, coordinate in sources]
+    pixcoordinates, excludemasks, radial_bins = zip(*geometry)
+
+    return extract_radial_spectra(cube, pixcoordinates, excludemasks,
+                                  radial_bins)
+
+def spectra_from_cubefn(cubefn, reg, bins_arcsec, coordinate):
+    return spectra_from_cubefn_multi(cubefn, [(reg, bins_arcsec, coordinate)])[0]
 
 if __name__ == "__main__":
 
@@ -0,0 +1,190 @@
+"""
+Cache of rasterized ds9 region masks.
+
+``pyregion``'s ``get_mask`` re-parses and re-rasterizes a region file every
+time it is called, although most scripts apply the same few region files to
+many images on one pixel grid.  Here each (region, celestial grid) pair is
+rasterized once; the result is kept in memory and stored on disk bit-packed
+(`np.packbits`, 1 bit per pixel), so later calls - in this or any other
+run - cost a dictionary lookup or one small file read.
+
+Many regions are rasterized together (`RegionMaskCache.get_masks`): the
+union of their filters is rasterized in one pass over the grid, and each
+region is then only tested on the pixels of that union.
+
+Regions are identified by their file's path, size and mtime, or, for
+``ShapeList`` objects built in a script, by the shapes' names, coordinates
+and attributes.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pyregion
+from pyregion import _region_filter as region_filter
+from pyregion.region_to_filter import as_region_filter
+from astropy import wcs
+from astropy.io import fits
+
+import paths
+from radial_bins import grid_key
+from product_cache import file_signature
+
+
+def _region_identity(region):
+    if isinstance(region, str):
+        signature = file_signature(region)
+        return [signature['path'], signature['size'], signature['mtime']]
+    return [[shape.name, list(shape.coord_list), shape.coord_format,
+             bool(shape.exclude), sorted(shape.attr[1].items())]
+            for shape in region]
+
+
+def _grid(hdu=None, header=None, shape=None):
+    if hdu is not None:
+        header = hdu.header if header is None else header
+        shape = hdu.data.shape if shape is None else shape
+    if header is None or shape is None:
+        raise ValueError("Need either an HDU or a header and a shape")
+    shape = tuple(shape[-2:])
+    celwcs = wcs.WCS(header).celestial
+    celheader = celwcs.to_header()
+    # pyregion needs the image size to work out the angles of rotated shapes
+    celheader['NAXIS'] = 2
+    celheader['NAXIS1'] = shape[1]
+    celheader['NAXIS2'] = shape[0]
+    return celheader, celwcs, shape
+
+
+class RegionMaskCache(object):
+    """
+    Parameters
+    ----------
+    directory : str
+        Where the bit-packed masks are stored
+    """
+    def __init__(self, directory=paths.dpath('region_mask_cache')):
+        self.directory = directory
+        self._masks = {}
+        self._shapelists = {}
+
+    def _key(self, region, celwcs, shape):
+        return hashlib.md5(json.dumps([_region_identity(region),
+                                       grid_key(celwcs, shape)],
+                                      default=str).encode()).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def _shapelist(self, region):
+        if isinstance(region, str):
+            if region not in self._shapelists:
+                self._shapelists[region] = pyregion.open(region)
+            return self._shapelists[region]
+        return region
+
+    def _load(self, key):
+        if key in self._masks:
+            return self._masks[key]
+        fn = self._filename(key)
+        if os.path.exists(fn):
+            packed = np.load(fn)
+            shape = tuple(packed['shape'])
+            mask = np.unpackbits(packed['bits'])[:np.prod(shape)].reshape(shape)
+            self._masks[key] = mask.astype('bool')
+            return self._masks[key]
+
+    def _store(self, key, mask):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # write to a temporary file first, so that another process never
+        # reads a partly written mask
+        fn = self._filename(key)
+        tmpfn = "{0}.{1}.tmp".format(fn, os.getpid())
+        with open(tmpfn, 'wb') as fh:
+            np.savez(fh, bits=np.packbits(mask), shape=np.array(mask.shape))
+        os.replace(tmpfn, fn)
+        self._masks[key] = mask
+
+    def get_mask(self, region, hdu=None, header=None, shape=None):
+        """
+        Drop-in for ``pyregion.open(region).get_mask(...)``
+
+        Parameters
+        ----------
+        region : str or ``pyregion.ShapeList``
+            Region file name or shape list
+        hdu : `~astropy.io.fits.PrimaryHDU`, optional
+            Image defining the grid
+        header, shape : optional
+            Header and shape of the grid if no ``hdu`` is given
+
+        Returns
+        -------
+        mask : np.ndarray
+            Boolean mask; do not modify it in place (it is shared)
+        """
+        celheader, celwcs, shape = _grid(hdu, header, shape)
+        key = self._key(region, celwcs, shape)
+        mask = self._load(key)
+        if mask is None:
+            mask = self._shapelist(region).get_mask(header=celheader,
+                                                    shape=shape)
+            self._store(key, mask)
+        return mask
+
+    def get_masks(self, regions, hdu=None, header=None, shape=None):
+        """
+        Masks of many regions (file names or shape lists) on one grid.
+
+        The uncached regions are converted to image coordinates in one pass
+        and rasterized together: the union of their filters is rasterized
+        once over the whole grid, and each region's filter is then evaluated
+        only at the pixels of the union.
+        """
+        celheader, celwcs, shape = _grid(hdu, header, shape)
+        keys = [self._key(region, celwcs, shape) for region in regions]
+        masks = [self._load(key) for key in keys]
+
+        todo = [ii for ii, mask in enumerate(masks) if mask is None]
+        if todo:
+            shapelists = [self._shapelist(regions[ii]) for ii in todo]
+            allshapes = pyregion.ShapeList([shp for shapelist in shapelists
+                                            for shp in shapelist])
+            imshapes = allshapes.as_imagecoord(celheader)
+            filters = []
+            start = 0
+            for shapelist in shapelists:
+                stop = start + len(shapelist)
+                filters.append(as_region_filter(imshapes[start:stop]))
+                start = stop
+
+            union = region_filter.RegionOrList(*filters).mask(shape)
+            yy, xx = np.nonzero(union)
+            xx = xx.astype('float')
+            yy = yy.astype('float')
+            for ii, regfilter in zip(todo, filters):
+                mask = np.zeros(shape, dtype='bool')
+                mask[union] = regfilter.inside(xx, yy)
+                self._store(keys[ii], mask)
+                masks[ii] = mask
+
+        return masks
+
+
+default_cache = RegionMaskCache()
+
+
+def get_mask(region, hdu=None, header=None, shape=None):
+    """
+    `RegionMaskCache.get_mask` with the default cache
+    """
+    return default_cache.get_mask(region, hdu=hdu, header=header, shape=shape)
+
+
+def get_masks(regions, hdu=None, header=None, shape=None):
+    """
+    `RegionMaskCache.get_masks` with the default cache
+    """
+    return default_cache.get_masks(regions, hdu=hdu, header=header,
+                                   shape=shape)
@@ -0,0 +1,185 @@
+"""
+Disk-cached drop-in for ``reproject.reproject_interp`` of 2D images.
+
+Reprojected arrays and footprints are stored as ``.npy`` files keyed by the
+source file's signature (see `product_cache.file_signature`; the md5 checksum
+is used if ``checksum=True``) and a hash of the target grid, and are returned
+memory-mapped, so repeated analyses of the same continuum / temperature /
+BGPS / Planck maps on the same target headers skip reprojection entirely.
+
+On a cache miss, the expensive part of the reprojection - transforming every
+output pixel into the input pixel frame - is itself cached per (input grid,
+output grid) pair, so different images on one source grid (e.g., the CH3OH
+column, temperature and peak maps of a field) share a single coordinate
+transformation and only pay for the bilinear interpolation.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+from scipy import ndimage
+from astropy import wcs
+from astropy.io import fits
+from astropy import log
+
+import paths
+from radial_bins import grid_key
+from product_cache import file_signature
+
+
+# reproject's names for the interpolation orders
+orders = {'nearest-neighbor': 0, 'bilinear': 1, 'biquadratic': 2,
+          'bicubic': 3}
+
+
+def _hash(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True,
+                                  default=str).encode()).hexdigest()
+
+
+def _load_input(input_data, hdu_in=0):
+    """
+    (data, WCS, identity) of a file name, HDUList, HDU or (array, WCS/header)
+    input; the identity is the file signature if the input is (or was read
+    from) a file, and the md5 of the data otherwise
+    """
+    filename = None
+    if isinstance(input_data, str):
+        filename = input_data
+        hdu = fits.open(input_data)[hdu_in]
+        data, mywcs = hdu.data, wcs.WCS(hdu.header).celestial
+    elif isinstance(input_data, fits.HDUList):
+        filename = input_data.filename()
+        hdu = input_data[hdu_in]
+        data, mywcs = hdu.data, wcs.WCS(hdu.header).celestial
+    elif isinstance(input_data, (fits.PrimaryHDU, fits.ImageHDU)):
+        if input_data.fileinfo() is not None:
+            filename = input_data.fileinfo()['file'].name
+        data, mywcs = input_data.data, wcs.WCS(input_data.header).celestial
+    else:
+        data, mywcs = input_data
+        if isinstance(mywcs, fits.Header):
+            mywcs = wcs.WCS(mywcs)
+        mywcs = mywcs.celestial
+
+    data = np.squeeze(data)
+    if filename is not None:
+        signature = file_signature(filename)
+        identity = [signature['path'], signature['size'], signature['mtime'],
+                    hdu_in]
+    else:
+        identity = hashlib.md5(np.ascontiguousarray(data).view('uint8')).hexdigest()
+    return data, mywcs, identity
+
+
+def _output_grid(output_projection, shape_out=None):
+    if isinstance(output_projection, fits.Header):
+        outwcs = wcs.WCS(output_projection).celestial
+        if shape_out is None:
+            shape_out = (output_projection['NAXIS2'],
+                         output_projection['NAXIS1'])
+    else:
+        outwcs = output_projection.celestial
+    if shape_out is None:
+        raise ValueError("shape_out is required if output_projection is a WCS")
+    return outwcs, tuple(shape_out[-2:])
+
+
+class ReprojectionCache(object):
+    """
+    Parameters
+    ----------
+    directory : str
+        Where the reprojected arrays are stored
+    checksum : bool
+        Identify input files by their md5 checksum rather than size and mtime
+    """
+    def __init__(self, directory=paths.dpath('reprojection_cache'),
+                 checksum=False):
+        self.directory = directory
+        self.checksum = checksum
+        self._coordinates = {}
+
+    def _filenames(self, key):
+        return (os.path.join(self.directory, key + '_array.npy'),
+                os.path.join(self.directory, key + '_footprint.npy'))
+
+    def pixel_coordinates(self, inwcs, outwcs, shape_out):
+        """
+        Input-frame pixel coordinates of every output pixel, computed once
+        per (input grid, output grid)
+        """
+        key = (grid_key(inwcs, (0, 0)), grid_key(outwcs, shape_out))
+        if key not in self._coordinates:
+            yy, xx = np.indices(shape_out, dtype='float')
+            world = outwcs.wcs_pix2world(xx, yy, 0)
+            xin, yin = inwcs.wcs_world2pix(world[0], world[1], 0)
+            self._coordinates[key] = np.array([yin, xin])
+        return self._coordinates[key]
+
+    def _reproject(self, data, inwcs, outwcs, shape_out, order):
+        coords = self.pixel_coordinates(inwcs, outwcs, shape_out)
+        data = np.asarray(data, dtype='float')
+        # interpolate with blanks zeroed, then blank every output pixel that
+        # touches a blank input pixel (NaNs would spread through the spline
+        # prefilter otherwise)
+        blank = ~np.isfinite(data)
+        array = ndimage.map_coordinates(np.where(blank, 0, data), coords,
+                                        order=order, mode='nearest')
+        if blank.any():
+            touched = ndimage.map_coordinates(blank.astype('float'), coords,
+                                              order=1, mode='nearest')
+            array[touched > 0] = np.nan
+        ny, nx = data.shape
+        footprint = ((coords[0] >= -0.5) & (coords[0] <= ny-0.5) &
+                     (coords[1] >= -0.5) & (coords[1] <= nx-0.5)).astype('float')
+        array[footprint == 0] = np.nan
+        return array, footprint
+
+    def reproject_interp(self, input_data, output_projection, shape_out=None,
+                         hdu_in=0, order=1):
+        """
+        Same call signature and return values as
+        ``reproject.reproject_interp`` for celestial images
+
+        Returns
+        -------
+        array, footprint : np.ndarray
+            Read-only (memory-mapped) arrays
+        """
+        order = orders.get(order, order)
+        data, inwcs, identity = _load_input(input_data, hdu_in=hdu_in)
+        if self.checksum and isinstance(identity, list):
+            identity = identity + [file_signature(identity[0],
+                                                  checksum=True)['md5']]
+        outwcs, shape_out = _output_grid(output_projection, shape_out)
+        key = _hash([identity, grid_key(inwcs, data.shape),
+                     grid_key(outwcs, shape_out), order])
+
+        arrayfn, footprintfn = self._filenames(key)
+        if os.path.exists(arrayfn) and os.path.exists(footprintfn):
+            return (np.load(arrayfn, mmap_mode='r'),
+                    np.load(footprintfn, mmap_mode='r'))
+
+        log.debug("Reprojecting onto a new grid (cache key {0})".format(key))
+        array, footprint = self._reproject(data, inwcs, outwcs, shape_out,
+                                           order)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        np.save(arrayfn, array)
+        np.save(footprintfn, footprint)
+        return (np.load(arrayfn, mmap_mode='r'),
+                np.load(footprintfn, mmap_mode='r'))
+
+
+default_cache = ReprojectionCache()
+
+
+def reproject_interp(input_data, output_projection, shape_out=None, hdu_in=0,
+                     order=1):
+    """
+    `ReprojectionCache.reproject_interp` with the default cache
+    """
+    return default_cache.reproject_interp(input_data, output_projection,
+                                          shape_out=shape_out, hdu_in=hdu_in,
+                                          order=order)
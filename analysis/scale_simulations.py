@@ -1,7 +1,10 @@
 import os
+import json
+import itertools
+import multiprocessing
 import numpy as np
 import paths
-from astropy.convolution import Tophat2DKernel
+from astropy.convolution import Tophat2DKernel, Gaussian2DKernel
 from simulated_cores import simulate_grid_for_fitsfile
 from astropy.io import fits
 from astropy import units as u
@@ -64,6 +67,25 @@ def ratio_ims(inpfn, outfn):
     ratio = dout[mask].sum() / din[mask].sum()
     return ratio
 
+def ratio_curve(din, dout, bins=np.logspace(-4, -1, 13)):
+    """
+    Recovered / injected flux ratio in bins of injected surface brightness.
+    This is the per-cell completeness curve; `ratio_ims` is its integral
+    over all bins.
+    """
+    isfin = np.isfinite(din) & np.isfinite(dout)
+    ispos = (din>0) & (dout>0)
+    mask = isfin & ispos
+    inds = np.digitize(din[mask], bins)
+    nbins = len(bins)+1
+    sum_in = np.bincount(inds, weights=din[mask], minlength=nbins)
+    sum_out = np.bincount(inds, weights=dout[mask], minlength=nbins)
+    npix = np.bincount(inds, minlength=nbins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = sum_out / sum_in
+    # drop the under/overflow bins
+    return ratio[1:-1], npix[1:-1]
+
 def analyze_sims(maxscale=3):
     gresults = {}
     tresults = {}
@@ -81,6 +103,151 @@ def analyze_sims(maxscale=3):
         
     return gresults, tresults
 
+
+# Completeness matrix: every (scale, amplitude range, seed, kernel) cell is
+# injected, imaged, and analyzed independently and its recovered-flux
+# statistics are cached in a json file keyed by the cell parameters.  Adding
+# seeds or scales to the matrix only computes the new cells.
+
+kernels = {'gaussian': Gaussian2DKernel,
+           'tophat': Tophat2DKernel}
+
+completeness_cache = paths.simpath('completeness_cache.json')
+
+def simulation_matrix(scales=(1,2), amplitude_ranges=((0.001,0.1),),
+                      seeds=(0,), kernelnames=('gaussian','tophat')):
+    """
+    Define every cell of the simulation matrix up front
+    """
+    return [dict(scale=scale, amplitude_range=list(amprange), seed=seed,
+                 kernel=kernelname)
+            for scale, amprange, seed, kernelname in
+            itertools.product(scales, amplitude_ranges, seeds, kernelnames)]
+
+def cell_key(cell):
+    return ("scale{scale}_{kernel}_amp{amplitude_range[0]:g}-"
+            "{amplitude_range[1]:g}_seed{seed}".format(**cell))
+
+def cell_filenames(cell):
+    key = cell_key(cell)
+    inpfn = paths.simpath("simimage_{0}.fits".format(key))
+    base_name = 'casa_simimage_{0}'.format(key)
+    outfn = '{0}_model_tclean_clean.image.fits'.format(base_name)
+    if not os.path.exists(outfn):
+        outfn = '{0}_model_tclean_clean.residual.fits'.format(base_name)
+    return inpfn, base_name, outfn
+
+def inject_cell(cell, basefile=paths.dpath("w51_te_continuum_best.fits")):
+    """
+    Injection stage: write the simulated image for one matrix cell.  The seed
+    makes the random amplitudes & offsets reproducible per cell.
+    """
+    inpfn, base_name, outfn = cell_filenames(cell)
+    if os.path.exists(inpfn):
+        return inpfn
+    np.random.seed(cell['seed'])
+    fh = simulate_grid_for_fitsfile(basefile,
+                                    separation=45*cell['scale'],
+                                    amplitude_range=cell['amplitude_range'],
+                                    kernel=kernels[cell['kernel']],
+                                    scale=cell['scale'],
+                                    random_offset=20)
+    fh[0].header['BUNIT'] = 'Jy/beam'
+    fh.writeto(inpfn, clobber=True)
+    return inpfn
+
+def analyze_cell(cell):
+    """
+    Recovery-analysis stage: recovered-flux statistics for one imaged cell
+    """
+    inpfn, base_name, outfn = cell_filenames(cell)
+    din = fits.getdata(inpfn).squeeze()
+    dout = fits.getdata(outfn).squeeze()
+    isfin = np.isfinite(din) & np.isfinite(dout)
+    ispos = (din>0) & (dout>0)
+    mask = isfin & ispos & (din > 0.0001)
+    binratio, npix = ratio_curve(din, dout)
+    return {'ratio': float(dout[mask].sum() / din[mask].sum()),
+            'flux_in': float(din[mask].sum()),
+            'flux_out': float(dout[mask].sum()),
+            'binned_ratio': [float(x) for x in binratio],
+            'binned_npix': [int(x) for x in npix],
+           }
+
+def load_completeness_cache(cachefile=completeness_cache):
+    if os.path.exists(cachefile):
+        with open(cachefile, 'r') as fh:
+            return json.load(fh)
+    return {}
+
+def run_matrix(cells, cachefile=completeness_cache, nprocs=4, image=True):
+    """
+    Run the injection and recovery-analysis stages for every cell that is not
+    already in the cache.  Injection and analysis are distributed over a
+    process pool; the synthetic imaging stage needs the CASA toolkit (``sm``,
+    ``tclean``) and is therefore run serially in this process.
+
+    Parameters
+    ----------
+    cells : list
+        Matrix cells from `simulation_matrix`
+    cachefile : str
+        The json file holding the per-cell recovered-flux statistics
+    nprocs : int
+        Number of worker processes
+    image : bool
+        Run CASA imaging for cells with no imaged output yet.  If False, only
+        cells whose imaged output already exists are analyzed.
+    """
+    cache = load_completeness_cache(cachefile)
+    todo = [cell for cell in cells if cell_key(cell) not in cache]
+    log.info("{0} of {1} cells need to be computed".format(len(todo), len(cells)))
+    if not todo:
+        return cache
+
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        pool.map(inject_cell, todo)
+
+        for cell in todo:
+            inpfn, base_name, outfn = cell_filenames(cell)
+            if image and not os.path.exists(outfn):
+                synthetically_image_fitsfile(inpfn, base_name=base_name,
+                                             cleanup=True)
+
+        todo = [cell for cell in todo
+                if os.path.exists(cell_filenames(cell)[2])]
+        results = pool.map(analyze_cell, todo)
+    finally:
+        pool.close()
+        pool.join()
+
+    for cell, result in zip(todo, results):
+        result.update(cell)
+        cache[cell_key(cell)] = result
+
+    with open(cachefile, 'w') as fh:
+        json.dump(cache, fh, indent=1, sort_keys=True)
+
+    return cache
+
+def completeness_curves(cache, bins=np.logspace(-4, -1, 13)):
+    """
+    Average the cached per-cell binned recovery ratios over seeds, giving one
+    completeness curve per (kernel, scale, amplitude range)
+    """
+    groups = {}
+    for key, result in cache.items():
+        gkey = (result['kernel'], result['scale'],
+                tuple(result['amplitude_range']))
+        groups.setdefault(gkey, []).append(result['binned_ratio'])
+
+    bincenters = (bins[1:]*bins[:-1])**0.5
+    curves = {gkey: (bincenters, np.nanmean(ratios, axis=0),
+                     np.nanstd(ratios, axis=0), len(ratios))
+              for gkey, ratios in groups.items()}
+    return curves
+
 def synthetically_image_fitsfile(fitsfilename, base_name,
                                  msfile="simulation_continuum.ms",
                                  cleanup=True,
@@ -56,8 +56,9 @@ def make_sim_grid(shape, g_size, separation, amplitude_range,
                 xcen += (np.random.rand()-0.5) * random_offset
                 ycen += (np.random.rand()-0.5) * random_offset
 
-            view = [slice(ycen-halfsz,ycen+halfsz),
-                    slice(xcen-halfsz,xcen+halfsz)]
+            # (numpy no longer truncates float slice indices itself)
+            view = (slice(int(ycen-halfsz),int(ycen+halfsz)),
+                    slice(int(xcen-halfsz),int(xcen+halfsz)))
 
             if blank_im[view].shape != model.shape:
                 #print("Skipping {0},{1}".format(xcen, ycen))
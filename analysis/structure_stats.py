@@ -0,0 +1,162 @@
+"""
+Per-structure statistics of a dendrogram from its index map.
+
+``structure.indices()`` walks the tree for every structure, so looping over a
+catalog costs O(nstructures x npix).  Instead, every statistic is first
+reduced over the pixels that the index map assigns to each structure (one
+`np.bincount` / `scipy.ndimage` pass per image), and the per-structure values
+(which include all descendants, like ``structure.indices()``) are then
+accumulated up the tree from the leaves in a single sweep.
+
+Aperture fluxes at many positions and radii are measured with one
+``photutils`` call per image, and several images are processed in parallel.
+"""
+import multiprocessing
+import numpy as np
+from scipy import ndimage
+from astropy import units as u
+from astropy import coordinates
+from astropy import wcs
+from astropy.io import fits
+
+
+def tree_arrays(dend):
+    """
+    Parent index and depth of every structure, and the leaf flags
+    """
+    nstruct = len(dend)
+    parent = np.full(nstruct, -1, dtype='int')
+    is_leaf = np.zeros(nstruct, dtype='bool')
+    for structure in dend:
+        if structure.parent is not None:
+            parent[structure.idx] = structure.parent.idx
+        is_leaf[structure.idx] = structure.is_leaf
+    depth = np.zeros(nstruct, dtype='int')
+    # parents always have lower depth; iterate until stable (depth of tree)
+    changed = True
+    while changed:
+        newdepth = np.where(parent >= 0, depth[parent] + 1, 0)
+        changed = np.any(newdepth != depth)
+        depth = newdepth
+    return parent, depth, is_leaf
+
+
+def _accumulate(values, parent, depth, ufunc):
+    """
+    Combine each structure's own-pixel value into all of its ancestors with
+    ``ufunc`` (np.add, np.maximum, np.minimum), deepest structures first
+    """
+    values = values.copy()
+    for level in range(depth.max(), 0, -1):
+        members = np.flatnonzero(depth == level)
+        ufunc.at(values, parent[members], values[members])
+    return values
+
+
+def structure_statistics(dend, images, index_map=None):
+    """
+    Sum, number of pixels, mean, max and min of each image over every
+    structure (including its descendants).
+
+    Parameters
+    ----------
+    dend : `astrodendro.Dendrogram`
+    images : dict
+        name -> [ny, nx] image on the dendrogram's grid
+    index_map : np.ndarray, optional
+        The dendrogram's index map (``dend.index_map`` by default)
+
+    Returns
+    -------
+    stats : dict
+        ``is_leaf``, ``npix``, and ``<name>_sum``, ``<name>_mean``,
+        ``<name>_max``, ``<name>_min`` arrays indexed by structure idx
+    """
+    if index_map is None:
+        index_map = dend.index_map
+    parent, depth, is_leaf = tree_arrays(dend)
+    nstruct = len(parent)
+
+    labels = index_map.ravel() + 1
+    inside = labels > 0
+    labels = labels[inside]
+    index = np.arange(1, nstruct+1)
+
+    own_npix = np.bincount(labels, minlength=nstruct+1)[1:]
+    npix = _accumulate(own_npix.astype('float'), parent, depth, np.add)
+
+    stats = {'is_leaf': is_leaf, 'npix': npix.astype('int')}
+    for name, image in images.items():
+        data = np.asarray(image).ravel()[inside]
+        own_sum = np.bincount(labels, weights=data, minlength=nstruct+1)[1:]
+        # structures with no pixels of their own (possible for branches)
+        # must not contribute to the max/min
+        has_pix = own_npix > 0
+        own_max = np.full(nstruct, -np.inf)
+        own_min = np.full(nstruct, np.inf)
+        own_max[has_pix] = ndimage.maximum(data, labels, index[has_pix])
+        own_min[has_pix] = ndimage.minimum(data, labels, index[has_pix])
+
+        total = _accumulate(own_sum, parent, depth, np.add)
+        stats[name+'_sum'] = total
+        stats[name+'_mean'] = total / npix
+        stats[name+'_max'] = _accumulate(own_max, parent, depth, np.maximum)
+        stats[name+'_min'] = _accumulate(own_min, parent, depth, np.minimum)
+    return stats
+
+
+def pruned_index_map(index_map, keep):
+    """
+    The index map with every structure not in ``keep`` set to -1
+    """
+    return np.where(np.isin(index_map, keep), index_map, -1)
+
+
+def aperture_fluxes(data, mywcs, ra, dec, radii):
+    """
+    Summed data in circular apertures of each radius around every position,
+    in one photutils call
+
+    Returns
+    -------
+    sums : np.ndarray
+        [nradii, npositions]
+    """
+    import photutils
+    positions = coordinates.SkyCoord(ra, dec, frame='fk5', unit=(u.deg, u.deg))
+    apertures = [photutils.SkyCircularAperture(positions=positions,
+                                               r=rr).to_pixel(mywcs)
+                 for rr in radii]
+    phot = photutils.aperture_photometry(data=data, apertures=apertures,
+                                         method='exact')
+    return np.array([np.asarray(phot['aperture_sum_{0}'.format(ii)])
+                     for ii in range(len(radii))])
+
+
+def _aperture_job(args):
+    filename, ra, dec, radii = args
+    fh = fits.open(filename)
+    data = fh[0].data.squeeze()
+    mywcs = wcs.WCS(fh[0].header).celestial
+    return aperture_fluxes(data, mywcs, ra, dec, radii)
+
+
+def multi_image_aperture_fluxes(filenames, ra, dec, radii, nprocs=None):
+    """
+    `aperture_fluxes` on several images (FITS file names) in parallel
+
+    Returns
+    -------
+    fluxes : list
+        [nradii, npositions] aperture sums of each image
+    """
+    jobs = [(fn, np.asarray(ra), np.asarray(dec), radii) for fn in filenames]
+    nprocs = len(jobs) if nprocs is None else nprocs
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            return pool.map(_aperture_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [_aperture_job(job) for job in jobs]
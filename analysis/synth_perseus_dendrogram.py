@@ -1,6 +1,5 @@
+import warnings
 import numpy as np
-from astropy.convolution import convolve_fft, Gaussian2DKernel
-from astropy.utils.console import ProgressBar
 from astropy import units as u
 import paths
 from astropy.io import fits
@@ -11,6 +10,8 @@ from astropy import wcs
 from astropy import coordinates
 from astropy import table
 from FITS_tools import hcongrid
+import structure_stats
+import local_noise
 
 from astropy.io.fits.verify import VerifyWarning
 warnings.simplefilter('ignore', category=VerifyWarning)
@@ -37,13 +38,15 @@ data_original = reproj_fits_in
 data_original[np.isnan(data)] = np.nan
 
 # estimate the noise from the local standard deviation of the residuals
-residfile = fits.open(paths.pspath('perseus_250_2_model_tclean_clean.residual.fits'))
-resid = residfile[0].data
-smresid = convolve_fft(np.nan_to_num(resid), Gaussian2DKernel(30))
+residfilename = paths.pspath('perseus_250_2_model_tclean_clean.residual.fits')
+residfile = fits.open(residfilename)
 # have *low* noise outside when adding noise to the input image
-synthnoise = convolve_fft(np.abs(resid-smresid),  Gaussian2DKernel(30))
-resid[np.isnan(resid)] = 0.01 # make the noise outside very high
-noise = convolve_fft(np.abs(resid-smresid),  Gaussian2DKernel(30))
+synthnoise = np.array(local_noise.cached_noise_map(residfilename, scale=30,
+                                                   stat='mean_abs_dev'))
+# make the noise outside very high
+noise = np.array(local_noise.cached_noise_map(residfilename, scale=30,
+                                              stat='mean_abs_dev',
+                                              fill_value=0.01))
 residfile[0].data = noise
 residfile.writeto(paths.pspath('perseus_250_2_model_tclean_clean_noise.fits'), clobber=True)
 # lowest reasonable noise level is 0.2 mJy/beam
@@ -87,17 +90,15 @@ orig_ppcat = astrodendro.pp_catalog(orig_dend, metadata)
 ppcat = astrodendro.pp_catalog(dend, metadata)
 
 # add a 'noise' column to the catalog
-keys = ['noise','is_leaf','peak_flux','min_flux','mean_flux']
-columns = {k:[] for k in (keys)}
-for ii, row in enumerate(ProgressBar(ppcat)):
-    structure = dend[row['_idx']]
-    assert structure.idx == row['_idx'] == ii
-    dend_inds = structure.indices()
-    columns['noise'].append(noise[dend_inds].mean())
-    columns['is_leaf'].append(structure.is_leaf)
-    columns['peak_flux'].append(contfile[0].data[dend_inds].max())
-    columns['min_flux'].append(contfile[0].data[dend_inds].min())
-    columns['mean_flux'].append(contfile[0].data[dend_inds].mean())
+stats = structure_stats.structure_statistics(dend, {'noise': noise,
+                                                    'flux': contfile[0].data})
+assert np.all(ppcat['_idx'] == np.arange(len(ppcat)))
+columns = {'noise': stats['noise_mean'],
+           'is_leaf': stats['is_leaf'],
+           'peak_flux': stats['flux_max'],
+           'min_flux': stats['flux_min'],
+           'mean_flux': stats['flux_mean'],
+          }
 
 for k in columns:
     if k not in ppcat.keys():
@@ -107,10 +108,7 @@ cat_mask = (ppcat['is_leaf'] & (ppcat['peak_flux']>8*ppcat['noise']) &
             (ppcat['mean_flux']>5*ppcat['noise']) &
             (ppcat['min_flux']>1*ppcat['noise']))
 pruned_ppcat = ppcat[cat_mask]
-mask = dend.index_map.copy()
-for ii in ProgressBar(list(range(len(ppcat)))):
-    if ii not in pruned_ppcat['_idx']:
-        mask[mask == ii] = -1
+mask = structure_stats.pruned_index_map(dend.index_map, pruned_ppcat['_idx'])
 outf = fits.PrimaryHDU(data=mask, header=contfile[0].header)
 outf.writeto('perseus_dendrograms_min1mJy_diff1mJy_mask_pruned.fits', clobber=True)
 
@@ -118,18 +116,16 @@ pruned_ppcat.write(paths.tpath("perseus_dendrogram_continuum_catalog.ipac"), for
 orig_ppcat.write(paths.tpath("perseus_original_dendrogram_continuum_catalog.ipac"), format='ascii.ipac')
 
 # Now mask the original data
-keys = ['noise','is_leaf','peak_flux','min_flux','mean_flux']
-columns = {k:[] for k in (keys)}
-for ii, row in enumerate(ProgressBar(orig_ppcat)):
-    structure = orig_dend[row['_idx']]
-    assert structure.idx == row['_idx'] == ii
-    dend_inds = structure.indices()
-    # do I want the real noise or the "measured" noise here?
-    columns['noise'].append(noise_level) # noise[dend_inds].mean())
-    columns['is_leaf'].append(structure.is_leaf)
-    columns['peak_flux'].append(data_original[dend_inds].max())
-    columns['min_flux'].append(data_original[dend_inds].min())
-    columns['mean_flux'].append(data_original[dend_inds].mean())
+orig_stats = structure_stats.structure_statistics(orig_dend,
+                                                  {'flux': data_original})
+assert np.all(orig_ppcat['_idx'] == np.arange(len(orig_ppcat)))
+# do I want the real noise or the "measured" noise here?
+columns = {'noise': np.repeat(noise_level, len(orig_ppcat)),
+           'is_leaf': orig_stats['is_leaf'],
+           'peak_flux': orig_stats['flux_max'],
+           'min_flux': orig_stats['flux_min'],
+           'mean_flux': orig_stats['flux_mean'],
+          }
 
 for k in columns:
     if k not in orig_ppcat.keys():
@@ -140,10 +136,8 @@ orig_cat_mask = (orig_ppcat['is_leaf'] &
                  (orig_ppcat['mean_flux']>5*orig_ppcat['noise']) &
                  (orig_ppcat['min_flux']>1*orig_ppcat['noise']))
 pruned_orig_ppcat = orig_ppcat[orig_cat_mask]
-orig_mask = orig_dend.index_map.copy()
-for ii in ProgressBar(list(range(len(orig_ppcat)))):
-    if ii not in pruned_orig_ppcat['_idx']:
-        orig_mask[orig_mask == ii] = -1
+orig_mask = structure_stats.pruned_index_map(orig_dend.index_map,
+                                             pruned_orig_ppcat['_idx'])
 outf = fits.PrimaryHDU(data=orig_mask, header=contfile[0].header)
 outf.writeto('original_perseus_dendrograms_mask_pruned.fits', clobber=True)
 
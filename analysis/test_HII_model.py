@@ -0,0 +1,45 @@
+"""
+Check the batched SED fitter against the single-source mpfit path
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip('pyspeckit')
+pytest.importorskip('radio_beam')
+pytest.importorskip('dust_emissivity')
+
+import HII_model
+
+nu = np.array([1.4, 5.0, 8.4, 15.0, 22.0, 45.0, 95.0])
+
+
+def synthetic_sed(em, normfac, seed=0, frac_err=0.05):
+    flux = HII_model.inufit(nu, em, normfac)
+    err = flux * frac_err
+    noisy = flux + np.random.RandomState(seed).randn(nu.size) * err
+    return noisy, err
+
+
+def test_batch_model_matches_inufit():
+    for logem in (5.5, 7.0, 8.5):
+        shape, dshape = HII_model._freefree_shape(nu, logem, 8500)
+        np.testing.assert_allclose(3e-6*shape,
+                                   HII_model.inufit(nu, 10**logem, 3e-6),
+                                   rtol=1e-10)
+
+
+@pytest.mark.parametrize(('em', 'normfac'), ((10**6.5, 2e-5),
+                                             (10**7.5, 3e-6),
+                                             (10**8.5, 4e-7)))
+def test_emtau_batch_matches_emtau(em, normfac):
+    flux, err = synthetic_sed(em, normfac)
+
+    bestEM, nu_tau, bestnormfac, chi2 = HII_model.emtau(nu, flux, err,
+                                                        EMguess=em*2,
+                                                        normfac=normfac*2)
+    result = HII_model.emtau_batch(nu, flux[None], err[None])
+
+    np.testing.assert_allclose(result['EM'][0], bestEM, rtol=1e-3)
+    np.testing.assert_allclose(result['normfac'][0], bestnormfac, rtol=1e-3)
+    np.testing.assert_allclose(result['nu_tau'][0], nu_tau, rtol=1e-3)
+    np.testing.assert_allclose(result['chi2'][0], chi2, rtol=1e-3)
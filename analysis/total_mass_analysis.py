@@ -15,6 +15,7 @@ from astropy import wcs
 import masscalc
 import photutils
 import pyregion
+import region_masks
 from astropy.nddata.utils import Cutout2D
 from astropy import coordinates
 
@@ -113,9 +114,8 @@ print("Total recovered flux minus protostars: {0}".format(total_minus_protostars
 print("Total mass minus protostars (20K): {0}".format(total_minus_protostars * masscalc.mass_conversion_factor()*u.M_sun/u.Jy))
 
 # determine BGPS total mass
-regions = pyregion.open(paths.rpath("12m_pointings.reg"))
 bgps_fh = fits.open("/Users/adam/work/w51/v2.0_ds2_l050_13pca_map20.fits")
-mask = regions.get_mask(bgps_fh[0])
+mask = region_masks.get_mask(paths.rpath("12m_pointings.reg"), hdu=bgps_fh[0])
 bgps_sum = bgps_fh[0].data[mask].sum() * u.Jy
 bgps_ppbeam = bgps_fh[0].header['PPBEAM']
 bgps_totalflux = bgps_sum/bgps_ppbeam
@@ -208,8 +208,8 @@ print()
 
 
 
-threecore_reg = pyregion.open(paths.rpath("three1ascores.reg"))
-threecore_mask = threecore_reg.get_mask(contfile[0])
+
+threecore_mask = region_masks.get_mask(paths.rpath("three1ascores.reg"), hdu=contfile[0])
 threecore_total = data[threecore_mask & (np.isfinite(data))].sum() / ppbeam
 print("Total flux in the three 'main cores': {0}".format(threecore_total))
 print("Fraction of total flux in the three 'main cores': {0}".format(threecore_total/total_signal))
@@ -225,16 +225,16 @@ beam_planck = radio_beam.Beam(4.990*u.arcmin)
 planck_217_flux = (planck_217[0].data*u.K).to(u.Jy, beam_planck.jtok_equiv(217*u.GHz))
 pixel_area_planck = np.abs(planck_217[0].header['CDELT1'] * planck_217[0].header['CDELT2'])*u.deg**2
 ppbeam_planck = (beam_planck.sr/pixel_area_planck).decompose()
-planck_12mptg_mask = regions.get_mask(planck_217[0])
+planck_12mptg_mask = region_masks.get_mask(paths.rpath("12m_pointings.reg"), hdu=planck_217[0])
 planck_12mptg_total = planck_217_flux[planck_12mptg_mask].sum() / ppbeam_planck
 print("Total Planck flux in 12m ptg area: {0}".format(planck_12mptg_total))
 
-whole_w51_reg = pyregion.open(paths.rpath('whole_w51_cloud.reg'))
-whole_w51_mask_planck = whole_w51_reg.get_mask(planck_217[0])
+
+whole_w51_mask_planck = region_masks.get_mask(paths.rpath('whole_w51_cloud.reg'), hdu=planck_217[0])
 planck_whole_total = planck_217_flux[whole_w51_mask_planck].sum() / ppbeam_planck
 print("Total Planck flux in entire cloud: {0}".format(planck_whole_total))
 
-whole_w51_mask_BGPS = whole_w51_reg.get_mask(bgps_fh[0])
+whole_w51_mask_BGPS = region_masks.get_mask(paths.rpath('whole_w51_cloud.reg'), hdu=bgps_fh[0])
 whole_w51_bgps_sum = bgps_fh[0].data[whole_w51_mask_BGPS].sum() * u.Jy / bgps_ppbeam
 whole_bgps_scaled_225 = whole_w51_bgps_sum*(masscalc.centerfreq/(271.4*u.GHz))**3.5
 whole_bgps_scaled_225_4 = whole_w51_bgps_sum*(masscalc.centerfreq/(271.4*u.GHz))**4.0
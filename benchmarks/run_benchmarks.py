@@ -0,0 +1,421 @@
+"""
+Benchmarks of the analysis hot paths on synthetic data.
+
+Each benchmark generates its data (`synthetic`) at one of several sizes,
+then times the entry point and measures its peak memory.  Results are
+compared against a stored baseline for this machine, so that a regression
+shows up as a flagged line rather than as a production run that takes all
+night.
+
+Usage::
+
+    python benchmarks/run_benchmarks.py                  # small + medium
+    python benchmarks/run_benchmarks.py --sizes large --only rprof,pca
+    python benchmarks/run_benchmarks.py --save-baseline  # after a good run
+
+Timing is the minimum (and median) wall time over ``--repeat`` runs;
+memory is the peak of the Python/numpy allocations (`tracemalloc`) during
+one separate run, since tracing slows pure-python loops down.  Data
+generation is not included in either.
+
+Benchmarks whose dependencies are not installed are reported as skipped
+(with the reason) instead of failing the suite.  The ``fit_all_tex``
+benchmarks import the rotational-diagram modules, which query the line
+catalogs (Splatalogue/VAMDC) at import: offline, they only run if those
+queries are in the astroquery cache.  Nothing else uses the network or the
+data directories.
+"""
+from __future__ import print_function
+import os
+import sys
+import gc
+import json
+import time
+import socket
+import argparse
+import importlib
+import tracemalloc
+import collections
+
+import numpy as np
+from astropy import units as u
+
+# the instrumented pipeline functions should not write stage logs here
+os.environ.setdefault('STAGE_TIMING', '0')
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+rootdir = os.path.dirname(benchdir)
+for subdir in ('analysis', 'analysis/longbaseline', 'singledish'):
+    path = os.path.join(rootdir, subdir)
+    if path not in sys.path:
+        sys.path.append(path)
+if benchdir not in sys.path:
+    sys.path.insert(0, benchdir)
+
+import synthetic
+
+default_baseline = os.path.join(benchdir, 'baselines',
+                                '{0}.json'.format(socket.gethostname()))
+
+# ``benchmarks[name] = (setup, sizes)``: ``setup(**sizes[size])`` generates
+# the data and returns the function to time
+benchmarks = collections.OrderedDict()
+
+
+def benchmark(name, **sizes):
+    def register(setup):
+        benchmarks[name] = (setup, sizes)
+        return setup
+    return register
+
+
+@benchmark('fit_all_tex_ch3oh',
+           small=dict(shape=(12, 12), nlines=8),
+           medium=dict(shape=(32, 32), nlines=12),
+           large=dict(shape=(96, 96), nlines=16))
+def setup_fit_all_tex_ch3oh(shape, nlines):
+    ch3oh = importlib.import_module('ch3oh_rotational_diagram_maps')
+    indices = np.arange(nlines)
+    (eupper, cube, errorcube, frequencies, aij, degeneracies,
+     tex) = synthetic.rotational_diagram_cube(shape, nlines=nlines,
+                                              aij=ch3oh.einsteinAij[indices])
+
+    def run():
+        return ch3oh.fit_all_tex(eupper, cube, frequencies, indices,
+                                 degeneracies, ecube=errorcube)
+    return run
+
+
+@benchmark('fit_all_tex_13ch3cn',
+           small=dict(shape=(12, 12), nlines=6),
+           medium=dict(shape=(32, 32), nlines=8),
+           large=dict(shape=(96, 96), nlines=10))
+def setup_fit_all_tex_13ch3cn(shape, nlines):
+    ch3cn = importlib.import_module('13ch3cn_fits')
+    (eupper, cube, errorcube, frequencies, aij, degeneracies,
+     tex) = synthetic.rotational_diagram_cube(shape, nlines=nlines)
+
+    def run():
+        return ch3cn.fit_all_tex(eupper, cube, frequencies, degeneracies,
+                                 aij, errorcube=errorcube)
+    return run
+
+
+@benchmark('lte_model',
+           small=dict(nlines=50, nchan=4000),
+           medium=dict(nlines=300, nchan=16000),
+           large=dict(nlines=1000, nchan=64000))
+def setup_lte_model(nlines, nchan):
+    from generic_lte_molecule_model import LTEModel
+    linecat, slaim = synthetic.splatalogue_catalogs(nlines=nlines,
+                                                    nslaim=10*nlines)
+    model = LTEModel.from_catalogs(linecat, slaim, molwt=32)
+    xarr, data = synthetic.synthetic_spectrum(nchan, fmin=216*u.GHz,
+                                              fmax=235*u.GHz)
+
+    def run():
+        return model.lte_model(xarr, vcen=55, width=3, tex=150,
+                               column=1e17)
+    return run
+
+
+@benchmark('h2co_set_constraints',
+           small=dict(gridsize=[50., 21., 20.], npix=10),
+           medium=dict(gridsize=[100., 51., 50.], npix=30),
+           large=dict(gridsize=[250., 101., 100.], npix=100))
+def setup_h2co_set_constraints(gridsize, npix):
+    from h2co.constrain_parameters import paraH2COmodel
+    model = paraH2COmodel(gridsize=gridsize, grids=synthetic.h2co_grids())
+    rs = np.random.RandomState(0)
+    taline303 = rs.uniform(0.5, 5, npix)
+    ratio = rs.uniform(0.1, 0.5, npix)
+
+    def run():
+        # the per-pixel loop of the h2co_fiteach scripts
+        for t303, rat in zip(taline303, ratio):
+            model.set_constraints(taline303=t303, etaline303=0.1*t303,
+                                  taline321=t303*rat, etaline321=0.1*t303,
+                                  taline322=t303*rat, etaline322=0.1*t303,
+                                  linewidth=5, fit_intensity=True)
+            model.get_parconstraints()
+    return run
+
+
+@benchmark('pca_clean',
+           small=dict(ntimes=1000, nchan=1024),
+           medium=dict(ntimes=4000, nchan=4096),
+           large=dict(ntimes=4000, nchan=16384))
+def setup_pca_clean(ntimes, nchan):
+    import makemaps
+    data = synthetic.apex_timestream(ntimes, nchan)
+
+    def run():
+        return makemaps.PCA_clean(data, ncomponents=3)
+    return run
+
+
+@benchmark('make_sim_grid',
+           small=dict(shape=(256, 256), g_size=2., separation=20),
+           medium=dict(shape=(1024, 1024), g_size=2., separation=20),
+           large=dict(shape=(4096, 4096), g_size=4., separation=40))
+def setup_make_sim_grid(shape, g_size, separation):
+    from simulated_cores import make_sim_grid
+
+    def run():
+        np.random.seed(0)
+        return make_sim_grid(shape, g_size, separation, (1e-3, 1e-1),
+                             random_offset=2)
+    return run
+
+
+@benchmark('rprof',
+           small=dict(shape=(512, 512), nsources=10, nimages=3),
+           medium=dict(shape=(2048, 2048), nsources=50, nimages=5),
+           large=dict(shape=(4096, 4096), nsources=200, nimages=10))
+def setup_rprof(shape, nsources, nimages):
+    # the engine of radial_profiles.make_rprof, without the plotting
+    from radial_bins import RegionBinners
+    from astropy import wcs
+    data, header, positions, names = synthetic.synthetic_image(
+        shape, nsources=nsources)
+    images = [data * (1+0.1*ii) for ii in range(nimages)]
+    mywcs = wcs.WCS(header)
+
+    def run():
+        binners = RegionBinners(names, positions, u.Quantity([2.5, 2.5],
+                                                             u.arcsec))
+        return [binners.profiles(data, mywcs) for data in images]
+    return run
+
+
+def _spectral_cube(shape, nsources):
+    from spectral_cube import SpectralCube
+    from astropy import wcs
+    data, header, positions, names = synthetic.synthetic_cube(shape,
+                                                              nsources=nsources)
+    return SpectralCube(data=data*u.Jy/u.beam, wcs=wcs.WCS(header)), header
+
+
+@benchmark('dendro_extraction',
+           small=dict(shape=(64, 128, 128), nsources=30),
+           medium=dict(shape=(256, 256, 256), nsources=100),
+           large=dict(shape=(256, 512, 512), nsources=400))
+def setup_dendro_extraction(shape, nsources):
+    # the per-leaf spectra of the dendrogram extraction scripts
+    import label_photometry
+    cube, header = _spectral_cube(shape, nsources)
+    catalog, header2d = synthetic.synthetic_catalog(shape[1:],
+                                                    nsources=nsources)
+    masks = synthetic.catalog_masks(catalog, header2d)
+
+    def run():
+        layers = label_photometry.label_layers(masks)
+        return label_photometry.grouped_channel_stats(cube, layers)
+    return run
+
+
+@benchmark('radial_extraction',
+           small=dict(shape=(64, 128, 128), nsources=4),
+           medium=dict(shape=(256, 256, 256), nsources=10),
+           large=dict(shape=(256, 512, 512), nsources=20))
+def setup_radial_extraction(shape, nsources):
+    import radial_spectra
+    cube, header = _spectral_cube(shape, nsources)
+    xpix, ypix, positions, names = synthetic.source_positions(shape, nsources,
+                                                             header)
+    bins = [(0, 2), (2, 4), (4, 8), (8, 16)]
+
+    def run():
+        return radial_spectra.extract_radial_spectra(cube,
+                                                     list(zip(xpix, ypix)),
+                                                     [None]*nsources, bins)
+    return run
+
+
+def measure(run, repeat=3):
+    """
+    Time ``run`` ``repeat`` times, then measure its peak memory once
+
+    Returns
+    -------
+    result : dict
+        ``time`` (the minimum), ``median_time`` (s) and ``peak_memory``
+        (bytes)
+    """
+    times = []
+    for ii in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter()-t0)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'time': min(times),
+            'median_time': float(np.median(times)),
+            'peak_memory': peak}
+
+
+def run_benchmarks(names=None, sizes=('small', 'medium'), repeat=3):
+    """
+    Run the selected benchmarks
+
+    Returns
+    -------
+    results : dict
+        ``{'name[size]': result}``; skipped benchmarks and errors have a
+        ``status`` and ``reason`` instead of timings
+    """
+    results = collections.OrderedDict()
+    for name, (setup, benchsizes) in benchmarks.items():
+        if names is not None and name not in names:
+            continue
+        for size in sizes:
+            if size not in benchsizes:
+                continue
+            key = '{0}[{1}]'.format(name, size)
+            try:
+                run = setup(**benchsizes[size])
+            except ImportError as ex:
+                results[key] = {'status': 'skipped', 'reason': str(ex)}
+                report_line(key, results[key])
+                continue
+            except Exception as ex:
+                results[key] = {'status': 'error',
+                                'reason': 'setup: {0!r}'.format(ex)}
+                report_line(key, results[key])
+                continue
+            try:
+                result = measure(run, repeat=repeat)
+                result['status'] = 'ok'
+            except Exception as ex:
+                result = {'status': 'error', 'reason': repr(ex)}
+            results[key] = result
+            report_line(key, result)
+    return results
+
+
+def _format_bytes(nbytes):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if abs(nbytes) < 1024 or unit == 'GB':
+            return '{0:0.1f} {1}'.format(nbytes, unit)
+        nbytes /= 1024.
+
+
+def report_line(key, result, baseline=None, tolerance=0.25, min_delta=0.005):
+    """
+    Print one result, with its ratio to the baseline; return True if it is
+    a regression (time or memory more than ``1+tolerance`` of the baseline).
+    Slowdowns of less than ``min_delta`` seconds are timer noise, not
+    regressions.
+    """
+    if result['status'] != 'ok':
+        print("{0:40s} {1}: {2}".format(key, result['status'],
+                                        result['reason']))
+        return False
+
+    line = "{0:40s} {1:10.4f} s  {2:>10s}".format(key, result['time'],
+                                                 _format_bytes(result['peak_memory']))
+    regression = False
+    if baseline is not None and baseline.get('status') == 'ok':
+        tratio = result['time'] / baseline['time']
+        mratio = (result['peak_memory'] / float(baseline['peak_memory'])
+                  if baseline['peak_memory'] else 1.0)
+        line += "  x{0:0.2f} time  x{1:0.2f} mem".format(tratio, mratio)
+        slower = (tratio > 1+tolerance and
+                  result['time']-baseline['time'] > min_delta)
+        if slower or mratio > 1+tolerance:
+            line += "  REGRESSION"
+            regression = True
+        elif tratio < 1/(1+tolerance):
+            line += "  faster"
+    print(line)
+    return regression
+
+
+def compare(results, baselines, tolerance=0.25):
+    """
+    Print the results against the baselines and return the regressions
+    """
+    print("\nCompared to the baseline (tolerance {0:0.0%}):".format(tolerance))
+    regressions = []
+    for key, result in results.items():
+        if report_line(key, result, baseline=baselines.get(key),
+                       tolerance=tolerance):
+            regressions.append(key)
+    return regressions
+
+
+def load_baseline(filename=default_baseline):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as fh:
+        return json.load(fh)['results']
+
+
+def save_baseline(results, filename=default_baseline):
+    """
+    Store the successful results, keeping the baselines of benchmarks that
+    were not run this time
+    """
+    baselines = load_baseline(filename)
+    baselines.update({key: result for key, result in results.items()
+                      if result['status'] == 'ok'})
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(filename, 'w') as fh:
+        json.dump({'host': socket.gethostname(),
+                   'python': sys.version.split()[0],
+                   'numpy': np.__version__,
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'results': baselines},
+                  fh, indent=2, sort_keys=True)
+    print("Saved baseline to {0}".format(filename))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--only', default=None,
+                        help='Comma-separated benchmark names '
+                        '(of: {0})'.format(', '.join(benchmarks)))
+    parser.add_argument('--skip', default='',
+                        help='Comma-separated benchmark names to skip')
+    parser.add_argument('--sizes', default='small,medium',
+                        help='Comma-separated sizes (small, medium, large)')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--baseline', default=default_baseline,
+                        help='Baseline file (default: one per host)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store these results as the baseline')
+    parser.add_argument('--tolerance', default=0.25, type=float,
+                        help='Fractional slowdown (or memory growth) that '
+                        'counts as a regression')
+    args = parser.parse_args()
+
+    names = list(benchmarks) if args.only is None else args.only.split(",")
+    names = [name for name in names if name not in args.skip.split(",")]
+    unknown = set(names) - set(benchmarks)
+    if unknown:
+        parser.error("Unknown benchmarks: {0}".format(", ".join(sorted(unknown))))
+
+    results = run_benchmarks(names=names, sizes=args.sizes.split(","),
+                             repeat=args.repeat)
+
+    regressions = []
+    baselines = load_baseline(args.baseline)
+    if baselines:
+        regressions = compare(results, baselines, tolerance=args.tolerance)
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+
+    if regressions:
+        print("\n{0} regression(s): {1}".format(len(regressions),
+                                               ", ".join(regressions)))
+        sys.exit(1)
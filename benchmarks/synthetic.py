@@ -0,0 +1,370 @@
+"""
+Synthetic data for the benchmarks: cubes, images, spectra, dendrogram-like
+catalogs, rotational-diagram moment cubes, line catalogs, H2CO RADEX-like
+grids and APEX-like timestreams.
+
+Everything is generated from a seed, so a given size always produces the
+same data, and nothing touches the disk or the network.
+"""
+import numpy as np
+from astropy import units as u
+from astropy import constants
+from astropy import coordinates
+from astropy import wcs
+from astropy.io import fits
+from astropy.table import Table, Column
+
+# W51 e2, so that the synthetic headers look like ours
+center = coordinates.SkyCoord('19:23:43.963', '+14:30:34.53', frame='fk5',
+                              unit=(u.hour, u.deg))
+
+
+def celestial_header(shape, pixscale=0.05*u.arcsec, center=center):
+    """
+    An RA/Dec header for a [ny, nx] image centered on ``center``
+    """
+    ny, nx = shape[-2:]
+    header = fits.Header()
+    header['NAXIS'] = 2
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    header['CTYPE1'] = 'RA---SIN'
+    header['CTYPE2'] = 'DEC--SIN'
+    header['CRPIX1'] = nx/2.+1
+    header['CRPIX2'] = ny/2.+1
+    header['CRVAL1'] = center.ra.deg
+    header['CRVAL2'] = center.dec.deg
+    header['CDELT1'] = -pixscale.to(u.deg).value
+    header['CDELT2'] = pixscale.to(u.deg).value
+    header['CUNIT1'] = 'deg'
+    header['CUNIT2'] = 'deg'
+    header['RADESYS'] = 'FK5'
+    header['EQUINOX'] = 2000.
+    header['BMAJ'] = 4*pixscale.to(u.deg).value
+    header['BMIN'] = 3*pixscale.to(u.deg).value
+    header['BPA'] = 0.
+    header['BUNIT'] = 'Jy/beam'
+    return header
+
+
+def cube_header(shape, pixscale=0.05*u.arcsec, center=center,
+                vstart=30*u.km/u.s, dv=0.5*u.km/u.s,
+                restfreq=220.74726*u.GHz):
+    """
+    An RA/Dec/VRAD header for a [nchan, ny, nx] cube
+    """
+    header = celestial_header(shape, pixscale=pixscale, center=center)
+    header['NAXIS'] = 3
+    header['NAXIS3'] = shape[0]
+    header['CTYPE3'] = 'VRAD'
+    header['CRPIX3'] = 1
+    header['CRVAL3'] = vstart.to(u.m/u.s).value
+    header['CDELT3'] = dv.to(u.m/u.s).value
+    header['CUNIT3'] = 'm/s'
+    header['RESTFRQ'] = restfreq.to(u.Hz).value
+    header['SPECSYS'] = 'LSRK'
+    return header
+
+
+def source_positions(shape, nsources, header, seed=0, border=10):
+    """
+    Random source pixel positions (away from the edges), their sky
+    coordinates and names
+    """
+    rs = np.random.RandomState(seed)
+    ny, nx = shape[-2:]
+    border = min(border, nx//4, ny//4)
+    xpix = rs.uniform(border, nx-border, nsources)
+    ypix = rs.uniform(border, ny-border, nsources)
+    mywcs = wcs.WCS(header).celestial
+    ra, dec = mywcs.wcs_pix2world(xpix, ypix, 0)
+    positions = coordinates.SkyCoord(ra*u.deg, dec*u.deg, frame='fk5')
+    names = ['src{0}'.format(ii) for ii in range(nsources)]
+    return xpix, ypix, positions, names
+
+
+def synthetic_image(shape, nsources=10, seed=0, noise=1e-4):
+    """
+    A continuum image of Gaussian cores on a noisy background
+
+    Returns
+    -------
+    data, header : the image and its header
+    positions, names : the source positions (`~astropy.coordinates.SkyCoord`)
+        and names
+    """
+    rs = np.random.RandomState(seed)
+    header = celestial_header(shape)
+    xpix, ypix, positions, names = source_positions(shape, nsources, header,
+                                                    seed=seed)
+    yy, xx = np.indices(shape)
+    data = rs.randn(*shape) * noise
+    for xc, yc in zip(xpix, ypix):
+        width = rs.uniform(2, 6)
+        data += (rs.uniform(1e-3, 1e-1) *
+                 np.exp(-((xx-xc)**2 + (yy-yc)**2) / (2*width**2)))
+    return data, header, positions, names
+
+
+def synthetic_cube(shape, nsources=10, seed=0, noise=0.01, dtype='float32'):
+    """
+    A [nchan, ny, nx] cube of Gaussian cores, each with a Gaussian line at
+    its own velocity, on a noisy background
+
+    Returns
+    -------
+    data, header : the cube and its header
+    positions, names : the source positions and names
+    """
+    rs = np.random.RandomState(seed)
+    header = cube_header(shape)
+    nchan = shape[0]
+    xpix, ypix, positions, names = source_positions(shape, nsources, header,
+                                                    seed=seed)
+    data = (rs.randn(*shape) * noise).astype(dtype)
+    yy, xx = np.indices(shape[1:])
+    chans = np.arange(nchan)
+    for xc, yc in zip(xpix, ypix):
+        width = rs.uniform(2, 6)
+        spatial = np.exp(-((xx-xc)**2 + (yy-yc)**2) / (2*width**2))
+        spectrum = rs.uniform(0.1, 1) * np.exp(-(chans-rs.uniform(0.3, 0.7)*nchan)**2 /
+                                               (2*rs.uniform(2, 8)**2))
+        data += (spectrum[:,None,None] * spatial[None,:,:]).astype(dtype)
+    return data, header, positions, names
+
+
+def synthetic_spectrum(nchan, nlines=20, fmin=218.0*u.GHz, fmax=220.0*u.GHz,
+                       seed=0, noise=0.05):
+    """
+    A frequency axis and a spectrum of ``nlines`` Gaussian lines
+    """
+    rs = np.random.RandomState(seed)
+    xarr = np.linspace(fmin.to(u.GHz).value, fmax.to(u.GHz).value, nchan)*u.GHz
+    data = rs.randn(nchan)*noise
+    dnu = (xarr[1]-xarr[0]).value
+    for cen in rs.uniform(xarr.value.min(), xarr.value.max(), nlines):
+        data += rs.uniform(0.5, 5) * np.exp(-(xarr.value-cen)**2 /
+                                            (2*(rs.uniform(2, 10)*dnu)**2))
+    return xarr, data
+
+
+def synthetic_catalog(shape, nsources=50, seed=0):
+    """
+    A dendrogram leaf catalog with the columns (and units) of
+    ``dendrogram_continuum_catalog.ipac``: world-coordinate centers and
+    ellipse sizes, as written by astrodendro's ``pp_catalog``
+
+    Returns
+    -------
+    catalog : `~astropy.table.Table`
+    header : the image header the catalog refers to
+    """
+    rs = np.random.RandomState(seed)
+    header = celestial_header(shape)
+    pixscale = abs(header['CDELT1'])
+    xpix, ypix, positions, names = source_positions(shape, nsources, header,
+                                                    seed=seed)
+    major = rs.uniform(1.5, 6, nsources) * pixscale
+    minor = major * rs.uniform(0.4, 1, nsources)
+    flux = rs.uniform(1e-3, 1e-1, nsources)
+    catalog = Table([Column(name='_idx', data=np.arange(nsources)),
+                     Column(name='area_exact', data=np.pi*major*minor*4,
+                            unit=u.deg**2),
+                     Column(name='flux', data=flux*10, unit=u.Jy),
+                     Column(name='major_sigma', data=major, unit=u.deg),
+                     Column(name='minor_sigma', data=minor, unit=u.deg),
+                     Column(name='position_angle',
+                            data=rs.uniform(0, 180, nsources), unit=u.deg),
+                     Column(name='radius', data=(major*minor)**0.5,
+                            unit=u.deg),
+                     Column(name='x_cen', data=positions.ra.deg),
+                     Column(name='y_cen', data=positions.dec.deg),
+                     Column(name='peak_cont_flux', data=flux),
+                     Column(name='is_leaf', data=['True']*nsources),
+                    ])
+    return catalog, header
+
+
+def catalog_masks(catalog, header, nsigma=2):
+    """
+    Elliptical boolean masks (``nsigma`` times the ellipse of each catalog
+    entry) on the pixel grid of ``header``, one per row
+    """
+    mywcs = wcs.WCS(header).celestial
+    pixscale = abs(header['CDELT1'])
+    xpix, ypix = mywcs.wcs_world2pix(catalog['x_cen'], catalog['y_cen'], 0)
+    yy, xx = np.indices([header['NAXIS2'], header['NAXIS1']])
+    masks = []
+    for row, xc, yc in zip(catalog, xpix, ypix):
+        pa = np.deg2rad(row['position_angle'])
+        dx, dy = xx-xc, yy-yc
+        xp = dx*np.cos(pa) + dy*np.sin(pa)
+        yp = -dx*np.sin(pa) + dy*np.cos(pa)
+        masks.append((xp/(nsigma*row['major_sigma']/pixscale))**2 +
+                     (yp/(nsigma*row['minor_sigma']/pixscale))**2 <= 1)
+    return masks
+
+
+def kkms_of_nupper(nupperoverg, freq, Aul):
+    """
+    Integrated intensity (K km/s) of an optically thin line with upper state
+    column ``nupperoverg`` per degeneracy; the inverse of ``nupper_of_kkms``
+    in the rotational diagram scripts
+    """
+    freq = u.Quantity(freq, u.GHz)
+    Aul = u.Quantity(Aul, u.Hz)
+    nupperoverg = u.Quantity(nupperoverg, u.cm**-2)
+    nline = 8 * np.pi * freq * constants.k_B / constants.h / Aul / constants.c**2
+    return (nupperoverg / nline * constants.c / freq).to(u.K*u.km/u.s)
+
+
+def rotational_diagram_cube(shape, nlines=8, seed=0, tex_range=(50, 300),
+                            logcolumn_range=(14, 17), noise=0.05,
+                            fmin=218*u.GHz, fmax=235*u.GHz, aij=None):
+    """
+    Moment-0 cubes ([nlines, ny, nx], K km/s) of ``nlines`` optically thin
+    transitions populated at a spatially varying excitation temperature
+
+    Returns
+    -------
+    eupper : np.ndarray
+        Upper state energies (K), the x axis of the rotational diagram
+    cube, errorcube : np.ndarray
+        The integrated intensities and their errors
+    frequencies : `~astropy.units.Quantity`
+    aij : `~astropy.units.Quantity`
+        Einstein A values (random unless given)
+    degeneracies : np.ndarray
+    tex : np.ndarray
+        The [ny, nx] input excitation temperature
+    """
+    rs = np.random.RandomState(seed)
+    ny, nx = shape
+    # draw the Aij's even if they are given so the rest of the data do not
+    # depend on ``aij``
+    random_aij = 10**rs.uniform(-5, -3.5, nlines)/u.s
+    aij = random_aij if aij is None else u.Quantity(aij, 1/u.s)
+    eupper = np.sort(rs.uniform(20, 800, nlines))
+    frequencies = np.sort(rs.uniform(fmin.to(u.GHz).value,
+                                     fmax.to(u.GHz).value, nlines))*u.GHz
+    degeneracies = rs.randint(5, 60, nlines)
+
+    yy, xx = np.indices(shape)
+    tex = tex_range[0] + (tex_range[1]-tex_range[0]) * (xx+yy) / float(nx+ny-2 or 1)
+    logcolumn = rs.uniform(*logcolumn_range, size=shape)
+    # partition function ~ T^1.5; only the slope of the diagram matters here
+    nupperoverg = (10**logcolumn / tex**1.5)[None,:,:] * np.exp(-eupper[:,None,None] /
+                                                               tex[None,:,:])
+    cube = np.array([kkms_of_nupper(nug, frq, aul).value
+                     for nug, frq, aul in zip(nupperoverg, frequencies, aij)])
+    errorcube = np.abs(cube)*noise + 1e-3
+    cube = cube + rs.randn(*cube.shape)*errorcube
+    return eupper, cube, errorcube, frequencies, aij, degeneracies, tex
+
+
+def splatalogue_catalogs(nlines=50, nslaim=500, fmin=216*u.GHz,
+                         fmax=235*u.GHz, seed=0):
+    """
+    Line tables with the columns of ``Splatalogue.query_lines(...,
+    show_upper_degeneracy=True)`` used by
+    `generic_lte_molecule_model.LTEModel`
+
+    Returns
+    -------
+    linecat : `~astropy.table.Table`
+        ``nlines`` lines between ``fmin`` and ``fmax``
+    slaim : `~astropy.table.Table`
+        ``nslaim`` lines over all frequencies (for the partition function)
+    """
+    rs = np.random.RandomState(seed)
+
+    def table(nrows, fmin, fmax):
+        # a few lines only have intrinsic strengths, not Einstein A's
+        logaij = rs.uniform(-6, -3, nrows)
+        logaij[rs.rand(nrows) < 0.1] = 0
+        return Table([Column(name='Freq-GHz',
+                             data=np.sort(rs.uniform(fmin, fmax, nrows))),
+                      Column(name='Log<sub>10</sub> (A<sub>ij</sub>)',
+                             data=logaij),
+                      Column(name='Upper State Degeneracy',
+                             data=rs.randint(1, 100, nrows)),
+                      Column(name='S<sub>ij</sub>&#956;<sup>2</sup> (D<sup>2</sup>)',
+                             data=rs.uniform(0.1, 50, nrows)),
+                      Column(name='E_U (K)', data=rs.uniform(5, 1500, nrows)),
+                     ])
+
+    linecat = table(nlines, fmin.to(u.GHz).value, fmax.to(u.GHz).value)
+    slaim = table(nslaim, 1, 1000)
+    return linecat, slaim
+
+
+def h2co_grids(shape=(50, 21, 20), seed=0):
+    """
+    Smooth RADEX-like p-H2CO Tex and tau grids ([temperature, log density,
+    log column]) and a header with the axes of the real grids (the input of
+    `h2co.constrain_parameters.paraH2COmodel`)
+    """
+    ntem, ndens, ncol = shape
+    hdr = fits.Header()
+    hdr['CTYPE1'] = 'LOG-COLU'
+    hdr['CRPIX1'] = 1
+    hdr['CRVAL1'] = 11.
+    hdr['CDELT1'] = 6./(ncol-1)
+    hdr['CTYPE2'] = 'LOG-DENS'
+    hdr['CRPIX2'] = 1
+    hdr['CRVAL2'] = 1.
+    hdr['CDELT2'] = 7./(ndens-1)
+    hdr['CTYPE3'] = 'TEMP'
+    hdr['CRPIX3'] = 1
+    hdr['CRVAL3'] = 5.
+    hdr['CDELT3'] = 295./(ntem-1)
+
+    tem, dens, col = np.indices(shape, dtype='float')
+    tem = hdr['CRVAL3'] + tem*hdr['CDELT3']
+    dens = hdr['CRVAL2'] + dens*hdr['CDELT2']
+    col = hdr['CRVAL1'] + col*hdr['CDELT1']
+
+    grids = {'hdr': hdr}
+    # thermalization with density, and a temperature-dependent level
+    # population for the 321 and 322 (Eu = 68 K) lines
+    thermalized = 1/(1+10**(5.5-dens))
+    for line, eu, ncrit in ((303, 21., 0.), (321, 68., 0.2), (322, 68., 0.2)):
+        tex = 2.73 + (tem-2.73)*thermalized*10**(-ncrit)
+        pop = np.exp(-eu/tem) if eu > 21 else 1.0
+        grids['texgrid{0}'.format(line)] = tex.astype('float32')
+        grids['taugrid{0}'.format(line)] = (10**(col-14) * pop /
+                                            tex**1.5).astype('float32')
+    return grids
+
+
+def apex_timestream(ntimes, nchan, ncomponents=3, seed=0, noise=0.1,
+                    nlines=3):
+    """
+    An APEX-like [ntimes, nchan] spectral timestream: a few correlated
+    baseline modes (drifts and standing-wave ripples) whose amplitudes vary
+    in time, plus astronomical lines that move between scans, plus noise
+
+    This is what `makemaps.PCA_clean` removes the baseline modes from.
+    """
+    rs = np.random.RandomState(seed)
+    chans = np.arange(nchan)
+    times = np.arange(ntimes)
+
+    modes = [np.linspace(-1, 1, nchan)]
+    for ii in range(ncomponents-1):
+        period = rs.uniform(nchan/20., nchan/2.)
+        modes.append(np.sin(2*np.pi*chans/period + rs.uniform(0, 2*np.pi)))
+    modes = np.array(modes)
+
+    amplitudes = np.array([np.cumsum(rs.randn(ntimes))*0.05 + rs.uniform(-2, 2)
+                           for ii in range(len(modes))])
+    data = amplitudes.T.dot(modes)
+
+    for ii in range(nlines):
+        cen = rs.uniform(0.2, 0.8)*nchan + 0.02*nchan*np.sin(2*np.pi*times/ntimes)
+        width = rs.uniform(3, 10)
+        data += rs.uniform(0.5, 2) * np.exp(-(chans[None,:]-cen[:,None])**2 /
+                                            (2*width**2))
+
+    data += rs.randn(ntimes, nchan)*noise
+    return data
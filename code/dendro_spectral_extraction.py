@@ -7,6 +7,7 @@ from astropy.table import Table
 import radio_beam
 import FITS_tools
 import pyregion
+from stage_timing import stage
 try:
     from paths import tpath
 except ImportError:
@@ -35,34 +36,35 @@ for spw in (0,1,2,3):
     for row in pruned_ppcat:
         name = row['_idx']
         print("Extracting {0} from {1}".format(name, spw))
-        SL = pyregion.parse("fk5; circle({0},{1},0.5\")"
-                            .format(row['x_cen'], row['y_cen']))
+        with stage('extract_source', kind='io', source=int(name), spw=spw):
+            SL = pyregion.parse("fk5; circle({0},{1},0.5\")"
+                                .format(row['x_cen'], row['y_cen']))
 
-        #mask = rmask == name
-        #dend_inds = np.where(mask)
+            #mask = rmask == name
+            #dend_inds = np.where(mask)
 
-        #view = (slice(None), # all spectral channels
-        #        slice(dend_inds[0].min(), dend_inds[0].max()+1),
-        #        slice(dend_inds[1].min(), dend_inds[1].max()+1),
-        #       )
-        #sc = cube[view].with_mask(mask[view[1:]])
-        sc = cube.subcube_from_ds9region(SL)
-        spec = sc.mean(axis=(1,2))
-        spec.meta['beam'] = radio_beam.Beam(major=np.nanmedian([bm.major.to(u.deg).value for bm in spec.beams]),
-                                            minor=np.nanmedian([bm.minor.to(u.deg).value for bm in spec.beams]),
-                                            pa=np.nanmedian([bm.pa.to(u.deg).value for bm in spec.beams]),
-                                           )
-        spec.hdu.writeto("spectra/dendro{0:03d}_spw{1}_mean{2}.fits".format(name, spw, suffix),
-                         clobber=True)
+            #view = (slice(None), # all spectral channels
+            #        slice(dend_inds[0].min(), dend_inds[0].max()+1),
+            #        slice(dend_inds[1].min(), dend_inds[1].max()+1),
+            #       )
+            #sc = cube[view].with_mask(mask[view[1:]])
+            sc = cube.subcube_from_ds9region(SL)
+            spec = sc.mean(axis=(1,2))
+            spec.meta['beam'] = radio_beam.Beam(major=np.nanmedian([bm.major.to(u.deg).value for bm in spec.beams]),
+                                                minor=np.nanmedian([bm.minor.to(u.deg).value for bm in spec.beams]),
+                                                pa=np.nanmedian([bm.pa.to(u.deg).value for bm in spec.beams]),
+                                               )
+            spec.hdu.writeto("spectra/dendro{0:03d}_spw{1}_mean{2}.fits".format(name, spw, suffix),
+                             clobber=True)
 
-        bgSL = pyregion.parse("fk5; circle({0},{1},1.0\")"
-                              .format(row['x_cen'], row['y_cen']))
-        bgsc = cube.subcube_from_ds9region(bgSL)
-        npix = np.count_nonzero(np.isfinite(bgsc[0,:,:]))
-        bgspec = (bgsc.sum(axis=(1,2)) - sc.sum(axis=(1,2))) / npix
-        bgspec.meta['beam'] = radio_beam.Beam(major=np.nanmedian([bm.major.to(u.deg).value for bm in spec.beams]),
-                                              minor=np.nanmedian([bm.minor.to(u.deg).value for bm in spec.beams]),
-                                              pa=np.nanmedian([bm.pa.to(u.deg).value for bm in spec.beams]),
-                                             )
-        bgspec.hdu.writeto("spectra/dendro{0:03d}_spw{1}_background_mean{2}.fits".format(name, spw, suffix),
-                           clobber=True)
+            bgSL = pyregion.parse("fk5; circle({0},{1},1.0\")"
+                                  .format(row['x_cen'], row['y_cen']))
+            bgsc = cube.subcube_from_ds9region(bgSL)
+            npix = np.count_nonzero(np.isfinite(bgsc[0,:,:]))
+            bgspec = (bgsc.sum(axis=(1,2)) - sc.sum(axis=(1,2))) / npix
+            bgspec.meta['beam'] = radio_beam.Beam(major=np.nanmedian([bm.major.to(u.deg).value for bm in spec.beams]),
+                                                  minor=np.nanmedian([bm.minor.to(u.deg).value for bm in spec.beams]),
+                                                  pa=np.nanmedian([bm.pa.to(u.deg).value for bm in spec.beams]),
+                                                 )
+            bgspec.hdu.writeto("spectra/dendro{0:03d}_spw{1}_background_mean{2}.fits".format(name, spw, suffix),
+                               clobber=True)
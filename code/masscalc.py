@@ -3,6 +3,7 @@ from astropy import units as u
 from constants import distance
 from astropy import constants
 from dust_emissivity import dust
+import dust_kernels
 
 """
 226.6 GHz is the weighted average of these:
@@ -19,15 +20,24 @@ centerfreq_lb = 225*u.GHz # TODO: FIX THIS
 
 #def mass_conversion_factor(TK=20, d=distance.to(u.kpc).value):
 #    return 14.30 * (np.exp(13.01/TK) - 1)*d**2
-def mass_conversion_factor(TK=20, d=distance.to(u.kpc)):
-    return dust.massofsnu(nu=centerfreq, snu=1*u.Jy, distance=d,
-                          temperature=u.Quantity(TK, u.K))
+def mass_conversion_factor(TK=20, d=distance.to(u.kpc), nu=centerfreq):
+    """
+    Mass of 1 Jy at temperature(s) TK (interpolated from the tabulated
+    `dust_kernels`; TK may be a map)
+    """
+    return dust_kernels.mass_per_jy(u.Quantity(TK, u.K), distance=d,
+                                    nu=nu)*u.M_sun
 
 #def col_conversion_factor(TK=20):
 #    return 2.19e22 * (np.exp(13.01/TK - 1))
-def col_conversion_factor(beamomega, TK=20):
-    return dust.colofsnu(nu=centerfreq, snu=1*u.Jy, beamomega=beamomega,
-                         temperature=u.Quantity(TK, u.K))
+def col_conversion_factor(beamomega, TK=20, nu=centerfreq):
+    """
+    Column of 1 Jy in beamomega (sr) at temperature(s) TK, from the tabulated
+    `dust_kernels`
+    """
+    return dust_kernels.column_per_jy(u.Quantity(TK, u.K),
+                                      beamomega=u.Quantity(beamomega, u.sr),
+                                      nu=nu)*u.cm**-2
 
 def Jnu(T, nu):
     return (2*constants.h*nu**3 / constants.c**2 *
@@ -0,0 +1,535 @@
+"""
+Stage-level timing and resource instrumentation for the long pipeline runs.
+
+Wrap a pipeline step in the `stage` context manager, or decorate it with
+`staged`::
+
+    @staged(kind='grid')
+    def add_apex_data(...):
+        ...
+
+    with stage('read_cube', kind='io', filename=fn):
+        cube = SpectralCube.read(fn)
+
+The stages always time themselves (``stage.wall``), but the stage log is
+opt-in: set ``STAGE_TIMING=1`` or ``$STAGE_TIMING_LOG``, or call `enable`.
+Then every completed stage appends one JSON record (a line) to the stage log,
+``stage_timing.jsonl`` in the working directory unless ``$STAGE_TIMING_LOG``
+(or `set_logfile`) says otherwise, with
+
+* ``wall``, ``cpu`` (s): wall-clock and process CPU time; ``cpu_children``
+  for subprocesses that finished during the stage
+* ``read_bytes``, ``write_bytes``: bytes passed through read/write calls
+  (``/proc/self/io`` rchar/wchar; not available on OS X)
+* ``disk_read_bytes``, ``disk_write_bytes``: bytes that actually hit the
+  disk (not served from the page cache)
+* ``rss_start``, ``rss_end``, ``peak_rss`` (bytes): resident memory.  On
+  Linux the peak is that of the stage itself (the kernel high-water mark is
+  reset when a stage starts, if logging is on); elsewhere it is the peak of the process so
+  far, and ``peak_rss_scope`` is ``'process'``
+* ``stage``, ``path`` (the enclosing stages, ``/``-separated), ``kind``
+  (``io``, ``grid``, ``fit``, ``plot``...), ``run``, ``status`` and any
+  keyword metadata given to the stage.
+
+Functions called thousands of times (per-pixel fits) should use
+``staged(aggregate=True)``: their calls are summed (``calls``, ``wall``,
+``cpu``) into one record per enclosing stage instead of one record each.
+
+``python stage_timing.py summary`` reports where the time of a run went
+(total and self time per stage, and self time per kind), ``python
+stage_timing.py compare RUN1 RUN2`` compares two runs stage by stage.
+Runs are named by ``$STAGE_TIMING_RUN`` (or `set_run`); by default each
+process is its own run.  ``STAGE_TIMING=0`` keeps the logging off even if
+``$STAGE_TIMING_LOG`` is set.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import atexit
+import resource
+import functools
+import collections
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+enabled = (os.environ.get('STAGE_TIMING', '1' if 'STAGE_TIMING_LOG' in os.environ
+                          else '0') not in ('0', 'false', 'False', ''))
+logfile = os.environ.get('STAGE_TIMING_LOG', 'stage_timing.jsonl')
+run_id = os.environ.get('STAGE_TIMING_RUN',
+                        '{0}-{1}-{2}'.format(socket.gethostname(), os.getpid(),
+                                             time.strftime('%Y%m%dT%H%M%S')))
+
+# the open stages, innermost last
+_stack = []
+# (path, name) -> summed calls of aggregated functions
+_aggregates = collections.OrderedDict()
+
+_pagesize = resource.getpagesize()
+# ru_maxrss is in kB on Linux and in bytes on OS X
+_maxrss_unit = 1 if sys.platform == 'darwin' else 1024
+
+
+def set_logfile(filename):
+    global logfile
+    logfile = filename
+
+
+def enable(filename=None):
+    """
+    Turn the stage log on (writing to ``filename`` if given)
+    """
+    global enabled
+    if filename is not None:
+        set_logfile(filename)
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def set_run(name):
+    """
+    Name the current run (e.g. ``'before-gridding-fix'``) for `compare`
+    """
+    global run_id
+    run_id = name
+
+
+def _can_reset_peak():
+    """
+    Whether the kernel high-water mark can be reset; probed on first use
+    """
+    global _peak_resettable
+    if _peak_resettable is None:
+        try:
+            with open('/proc/self/clear_refs', 'w') as fh:
+                fh.write('5')
+            _peak_resettable = _hwm() is not None
+        except (IOError, OSError):
+            _peak_resettable = False
+    return _peak_resettable
+
+
+def _hwm():
+    """
+    The kernel RSS high-water mark (bytes), or None
+    """
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _reset_peak():
+    with open('/proc/self/clear_refs', 'w') as fh:
+        fh.write('5')
+
+
+_peak_resettable = None
+
+
+def current_rss():
+    """
+    Resident set size of this process (bytes), or None if unknown
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1])*_pagesize
+    except (IOError, OSError):
+        if psutil is not None:
+            return psutil.Process().memory_info().rss
+    return None
+
+
+def io_counters():
+    """
+    Cumulative ``read_bytes``, ``write_bytes`` (read/write calls) and
+    ``disk_read_bytes``, ``disk_write_bytes`` of this process
+    """
+    try:
+        with open('/proc/self/io') as fh:
+            proc = dict((key.strip(), int(value))
+                        for key, value in (line.split(':') for line in fh))
+        return {'read_bytes': proc['rchar'], 'write_bytes': proc['wchar'],
+                'disk_read_bytes': proc['read_bytes'],
+                'disk_write_bytes': proc['write_bytes']}
+    except (IOError, OSError, KeyError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # block counts, in 512-byte blocks
+        return {'read_bytes': None, 'write_bytes': None,
+                'disk_read_bytes': usage.ru_inblock*512,
+                'disk_write_bytes': usage.ru_oublock*512}
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _fold_peaks():
+    """
+    Fold the current high-water mark into every open stage's peak
+    """
+    hwm = _hwm()
+    if hwm is not None:
+        for open_stage in _stack:
+            open_stage._peak = max(open_stage._peak, hwm)
+
+
+def _current_path():
+    return "/".join(open_stage.name for open_stage in _stack)
+
+
+def write_record(record):
+    """
+    Append one record to the stage log
+    """
+    global enabled
+    try:
+        with open(logfile, 'a') as fh:
+            fh.write(json.dumps(record, sort_keys=True, default=str) + "\n")
+    except (IOError, OSError) as ex:
+        # never let the bookkeeping kill a pipeline run
+        print("Could not write the stage log {0} ({1}); stage timing is "
+              "disabled".format(logfile, ex), file=sys.stderr)
+        enabled = False
+
+
+def _flush_aggregates(path):
+    """
+    Write the aggregated records of the functions called directly within
+    ``path``
+    """
+    for key in [key for key in _aggregates if key[0] == path]:
+        record = _aggregates.pop(key)
+        if enabled:
+            write_record(record)
+
+
+class stage(object):
+    """
+    Time a pipeline stage and record its resource use
+
+    Parameters
+    ----------
+    name : str
+        The stage name
+    kind : str, optional
+        What the stage mostly does, for the per-kind breakdown: ``'io'``,
+        ``'grid'``, ``'fit'``, ``'plot'``...
+    meta :
+        Anything else to record with the stage (file names, sizes...)
+
+    Attributes
+    ----------
+    record : dict
+        The stage's record, available after it completes (``wall`` etc.)
+    """
+    def __init__(self, name, kind=None, **meta):
+        self.name = name
+        self.kind = kind
+        self.meta = meta
+        self.record = None
+
+    def __enter__(self):
+        self.path = _current_path()
+        self.start = time.time()
+        self._peak = 0
+        # resetting the peak costs a page-table walk; only worth it for the log
+        self._stage_peak = enabled and _can_reset_peak()
+        if self._stage_peak:
+            _fold_peaks()
+            _reset_peak()
+        self.rss_start = current_rss()
+        self._peak = self.rss_start or 0
+        self.io_start = io_counters()
+        self.children_start = _children_cpu()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        _stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        children = _children_cpu() - self.children_start
+        io_end = io_counters()
+        rss_end = current_rss()
+        if self._stage_peak:
+            _fold_peaks()
+            peak, scope = self._peak, 'stage'
+        else:
+            peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss *
+                    _maxrss_unit)
+            scope = 'process'
+        _stack.remove(self)
+
+        record = dict(self.meta)
+        record.update({'run': run_id,
+                       'host': socket.gethostname(),
+                       'pid': os.getpid(),
+                       'stage': self.name,
+                       'path': self.path,
+                       'kind': self.kind,
+                       'start': self.start,
+                       'wall': wall,
+                       'cpu': cpu,
+                       'cpu_children': children,
+                       'rss_start': self.rss_start,
+                       'rss_end': rss_end,
+                       'peak_rss': peak,
+                       'peak_rss_scope': scope,
+                       'status': 'ok' if exc_type is None else 'error',
+                      })
+        for key, value in io_end.items():
+            record[key] = (None if value is None or self.io_start[key] is None
+                           else value - self.io_start[key])
+        if exc_type is not None:
+            record['error'] = '{0}: {1}'.format(exc_type.__name__, exc_value)
+        self.record = record
+
+        full_path = "/".join(filter(None, (self.path, self.name)))
+        _flush_aggregates(full_path)
+        if enabled:
+            write_record(record)
+        return False
+
+    @property
+    def wall(self):
+        return self.record['wall'] if self.record is not None else None
+
+
+def staged(name=None, kind=None, aggregate=False):
+    """
+    Decorator form of `stage`; the stage is named after the function
+    unless ``name`` is given.  ``@staged`` works without arguments.
+
+    Parameters
+    ----------
+    aggregate : bool
+        Sum the calls (count, wall and CPU time only) into one record per
+        enclosing stage, for functions called too often for a record each
+    """
+    if callable(name):
+        return staged()(name)
+
+    def decorator(function):
+        stagename = name or function.__name__
+
+        if aggregate:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                path = _current_path()
+                cpu0 = time.process_time()
+                wall0 = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    key = (path, stagename)
+                    if key not in _aggregates:
+                        _aggregates[key] = {'run': run_id,
+                                            'host': socket.gethostname(),
+                                            'pid': os.getpid(),
+                                            'stage': stagename, 'path': path,
+                                            'kind': kind, 'start': time.time(),
+                                            'calls': 0, 'wall': 0.,
+                                            'cpu': 0., 'status': 'ok'}
+                    agg = _aggregates[key]
+                    agg['calls'] += 1
+                    agg['wall'] += time.perf_counter() - wall0
+                    agg['cpu'] += time.process_time() - cpu0
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with stage(stagename, kind=kind):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@atexit.register
+def _flush_all():
+    for path in set(key[0] for key in _aggregates):
+        _flush_aggregates(path)
+
+
+def read_log(filename=None, run=None):
+    """
+    Read the stage records, optionally of one run only
+    """
+    records = []
+    if not os.path.exists(filename or logfile):
+        return records
+    with open(filename or logfile) as fh:
+        for line in fh:
+            if line.strip():
+                record = json.loads(line)
+                if run is None or record['run'] == run:
+                    records.append(record)
+    return records
+
+
+def runs(records):
+    """
+    Run names in order of first appearance
+    """
+    return list(collections.OrderedDict((rec['run'], None)
+                                        for rec in records))
+
+
+def summarize(records):
+    """
+    Combine the records of a run per stage (``path/stage``)
+
+    Returns
+    -------
+    stages : OrderedDict
+        ``{key: summary}`` in order of first appearance, where ``summary``
+        has the ``calls``, the summed ``wall``, ``self`` (wall minus that of
+        the child stages), ``cpu``, I/O bytes, and the largest ``peak_rss``
+    kinds : dict
+        Self time per kind
+    """
+    stages = collections.OrderedDict()
+    for rec in sorted(records, key=lambda rec: rec['start']):
+        key = "/".join(filter(None, (rec['path'], rec['stage'])))
+        if key not in stages:
+            stages[key] = {'kind': rec['kind'], 'depth': key.count('/'),
+                           'calls': 0, 'wall': 0., 'cpu': 0., 'child': 0.,
+                           'read_bytes': 0, 'write_bytes': 0,
+                           'disk_read_bytes': 0, 'disk_write_bytes': 0,
+                           'peak_rss': None, 'errors': 0}
+        summary = stages[key]
+        summary['calls'] += rec.get('calls', 1)
+        summary['wall'] += rec['wall']
+        summary['cpu'] += rec['cpu']
+        summary['errors'] += rec['status'] != 'ok'
+        for col in ('read_bytes', 'write_bytes', 'disk_read_bytes',
+                    'disk_write_bytes'):
+            if rec.get(col) is not None:
+                summary[col] += rec[col]
+        if rec.get('peak_rss') is not None:
+            summary['peak_rss'] = max(summary['peak_rss'] or 0,
+                                      rec['peak_rss'])
+
+    for key, summary in stages.items():
+        parent = key.rsplit('/', 1)[0] if '/' in key else None
+        if parent in stages:
+            stages[parent]['child'] += summary['wall']
+
+    kinds = collections.defaultdict(float)
+    for summary in stages.values():
+        summary['self'] = summary['wall'] - summary['child']
+        kinds[summary['kind'] or 'other'] += summary['self']
+
+    return stages, dict(kinds)
+
+
+def _mb(nbytes):
+    return '' if nbytes is None else '{0:0.1f}'.format(nbytes/1024.**2)
+
+
+def print_summary(records):
+    stages, kinds = summarize(records)
+    print("{0:50s} {1:>6s} {2:>9s} {3:>9s} {4:>9s} {5:>9s} {6:>9s} {7:>9s}"
+          .format('stage', 'calls', 'wall [s]', 'self [s]', 'cpu [s]',
+                  'read MB', 'write MB', 'peak MB'))
+    for key, summary in stages.items():
+        label = "  "*summary['depth'] + key.rsplit('/', 1)[-1]
+        if summary['errors']:
+            label += " ({0} failed)".format(summary['errors'])
+        print("{0:50s} {1:6d} {2:9.2f} {3:9.2f} {4:9.2f} {5:>9s} {6:>9s} {7:>9s}"
+              .format(label[:50], summary['calls'], summary['wall'],
+                      summary['self'], summary['cpu'],
+                      _mb(summary['read_bytes']), _mb(summary['write_bytes']),
+                      _mb(summary['peak_rss'])))
+
+    total = sum(kinds.values())
+    print("\nSelf time by kind:")
+    for kind, selftime in sorted(kinds.items(), key=lambda kv: -kv[1]):
+        print("  {0:12s} {1:9.2f} s  {2:5.1f}%".format(kind, selftime,
+                                                       100*selftime/total
+                                                       if total else 0))
+
+
+def print_comparison(records1, records2, labels=('A', 'B')):
+    """
+    Compare the wall time and peak memory of two runs stage by stage
+    """
+    stages1, kinds1 = summarize(records1)
+    stages2, kinds2 = summarize(records2)
+    print("{0:50s} {1:>10s} {2:>10s} {3:>7s} {4:>10s} {5:>10s}"
+          .format('stage', 'wall ' + labels[0], 'wall ' + labels[1], 'ratio',
+                  'peak MB ' + labels[0], 'peak MB ' + labels[1]))
+    keys = list(stages1) + [key for key in stages2 if key not in stages1]
+    for key in keys:
+        s1, s2 = stages1.get(key), stages2.get(key)
+        wall1 = '{0:0.2f}'.format(s1['wall']) if s1 else '-'
+        wall2 = '{0:0.2f}'.format(s2['wall']) if s2 else '-'
+        ratio = ('{0:0.2f}'.format(s2['wall']/s1['wall'])
+                 if s1 and s2 and s1['wall'] > 0 else '')
+        depth = (s1 or s2)['depth']
+        label = "  "*depth + key.rsplit('/', 1)[-1]
+        print("{0:50s} {1:>10s} {2:>10s} {3:>7s} {4:>10s} {5:>10s}"
+              .format(label[:50], wall1, wall2, ratio,
+                      _mb(s1['peak_rss']) if s1 else '-',
+                      _mb(s2['peak_rss']) if s2 else '-'))
+
+    print("\nSelf time by kind:")
+    for kind in sorted(set(kinds1) | set(kinds2)):
+        print("  {0:12s} {1:9.2f} s {2:9.2f} s".format(kind, kinds1.get(kind, 0),
+                                                       kinds2.get(kind, 0)))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Report on a stage log")
+    parser.add_argument('command', choices=('summary', 'compare', 'runs'))
+    parser.add_argument('runs', nargs='*',
+                        help="Run names (default: the last run, or the last "
+                        "two for compare)")
+    parser.add_argument('--log', default=logfile,
+                        help="The stage log (default: %(default)s)")
+    parser.add_argument('--log2', default=None,
+                        help="A second stage log holding the other run to "
+                        "compare against")
+    args = parser.parse_args()
+
+    records = read_log(args.log)
+    if args.command != 'runs' and not records:
+        parser.error("no runs in {0}".format(args.log))
+    if args.command == 'runs':
+        for name in runs(records):
+            nrec = sum(rec['run'] == name for rec in records)
+            print("{0}  ({1} records)".format(name, nrec))
+    elif args.command == 'summary':
+        name = args.runs[0] if args.runs else runs(records)[-1]
+        print("Run {0}\n".format(name))
+        print_summary([rec for rec in records if rec['run'] == name])
+    else:
+        if args.log2 is not None:
+            records2 = read_log(args.log2)
+            if not records2:
+                parser.error("no runs in {0}".format(args.log2))
+            names = args.runs or [runs(records)[-1], runs(records2)[-1]]
+        else:
+            records2 = records
+            names = args.runs or runs(records)[-2:]
+        if len(names) != 2:
+            parser.error("compare needs two runs")
+        print("A = {0}\nB = {1}\n".format(*names))
+        print_comparison([rec for rec in records if rec['run'] == names[0]],
+                         [rec for rec in records2 if rec['run'] == names[1]])
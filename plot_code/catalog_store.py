@@ -0,0 +1 @@
+../analysis/catalog_store.py
\ No newline at end of file
@@ -12,8 +12,11 @@ from spectral_cube.lower_dimensional_structures import Projection
 from astropy.io import fits
 from astropy import wcs
 from astropy.stats import mad_std
+import cube_stats
+from product_cache import ProductCache
 from line_to_image_list import labeldict
-import reproject
+from fits_index import default_index
+import reprojection_cache
 
 import re
 import glob
@@ -53,12 +56,81 @@ for key in list(labeldict.keys()):
 def get_cont(header):
     contfn = paths.dpath('W51_te_continuum_best.fits')
     beam = radio_beam.Beam.from_fits_header(contfn)
-    cont_Jy = reproject.reproject_interp(input_data=contfn,
+    cont_Jy = reprojection_cache.reproject_interp(input_data=contfn,
                                          output_projection=header)[0]*u.Jy
     cont_K = cont_Jy.to(u.K, u.brightness_temperature(beam,
                                                       continuum_frequency))
     return cont_K
 
+# bump this when the slab computation changes to invalidate cached products
+chemslab_version = '2'
+
+chemslab_cache = ProductCache(paths.dpath('chemslices'))
+
+def chemslab_filenames(sourcename, linename, suffix=""):
+    return {kind: paths.dpath("chemslices/chemical_{3}_slabs_{0}_{1}{2}.fits"
+                              .format(sourcename, linename, suffix, kind))
+            for kind in ('m0', 'm1', 'm2', 'max', 'max_sub', 'madstd')}
+
+def make_chem_slabs(products, fn, yslice, xslice, vrange, maxbeam):
+    """
+    Compute the moment, max and noise maps of one cube and write them to
+    ``products`` (from `chemslab_filenames`).  Returns False if the cube had
+    nothing usable.
+    """
+    print()
+    print("Extracting max/m0/m1/m2 for {0}".format(fn))
+    cube = SpectralCube.read(fn)[:,yslice,xslice]
+    goodbeams = np.array([bm.major < maxbeam for bm in cube.beams], dtype='bool')
+    if np.count_nonzero(goodbeams) < 5:
+        print()
+        print("Skipping {0} because it has too few good beams.".format(fn))
+        return False
+
+    cube = cube.with_mask(goodbeams[:,None,None])
+    cube = cube.minimal_subcube()
+
+
+    if cube.shape[0] == 0:
+        print()
+        print("Skipping {0} because it was masked out".format(fn))
+        return False
+
+    bm = cube.beams[0]
+    restfreq = cube.wcs.wcs.restfrq
+    cube = cube.to(u.K, bm.jtok_equiv(restfreq*u.Hz))
+
+    slab = cube.spectral_slab(*vrange)
+    cube.beam_threshold = 1
+    #contguess = cube.spectral_slab(0*u.km/u.s, 40*u.km/u.s).percentile(50, axis=0)
+    #contguess = cube.spectral_slab(70*u.km/u.s, 100*u.km/u.s).percentile(50, axis=0)
+    mask = (cube.spectral_axis<40*u.km/u.s) | (cube.spectral_axis > 75*u.km/u.s)
+    try:
+        contguess = cube_stats.percentile_map(cube, 30,
+                                              channel_mask=mask)
+    except ValueError as ex:
+        print()
+        print("skipping {0}".format(fn))
+        print(ex)
+        return False
+    slabsub = (slab-contguess)
+    slab.beam_threshold = 0.25
+    slabsub.beam_threshold = 0.25
+    m0 = slabsub.moment0()
+    m1 = slabsub.moment1()
+    m2 = slabsub.moment2()
+    max_sub = slabsub.max(axis=0)
+    max = slab.max(axis=0)
+    madstd = cube_stats.mad_std_map(cube, channel_mask=mask)
+
+    m0.write(products['m0'], overwrite=True)
+    m1.write(products['m1'], overwrite=True)
+    m2.write(products['m2'], overwrite=True)
+    max.write(products['max'], overwrite=True)
+    max_sub.write(products['max_sub'], overwrite=True)
+    madstd.write(products['madstd'], overwrite=True)
+    return True
+
 def chem_plot(linere, yslice=slice(367,467), xslice=slice(114,214),
               vrange=[51,60]*u.km/u.s, sourcename='e2',
               filelist=glob.glob(paths.dpath('12m/cutouts/*e2e8*fits')),
@@ -74,6 +146,7 @@ def chem_plot(linere, yslice=slice(367,467), xslice=slice(114,214),
               maxbeam=0.5*u.arcsec,
               contourlevels=None,
               filetype='pdf',
+              nprocs=1,
              ):
     nplots = np.product(plotgrid)
 
@@ -114,114 +187,74 @@ def chem_plot(linere, yslice=slice(367,467), xslice=slice(114,214),
     gs6.update(wspace=0.0, hspace=0.0)
 
 
-    figcounter = 0
-
-    for ii,fn in enumerate(ProgressBar(filelist)):
+    # beams from the header index, so cubes with no usable beam are skipped
+    # without opening them
+    default_index.update(filelist)
 
+    # (re)compute only the slab products whose inputs have changed
+    tasks = []
+    plotfiles = []
+    for fn in filelist:
         linename = linere.search(fn).groups()[0]
         if linename not in labeldict:
             print()
             print("Skipping {0} because it's not in the label dict".format(linename))
             continue
+        row = default_index.row(fn)
+        if row is not None and row['bmaj_min'] >= maxbeam.to(u.deg).value:
+            print()
+            print("Skipping {0} because it has no good beams.".format(fn))
+            continue
+        products = chemslab_filenames(sourcename, linename, suffix)
+        inputs = chemslab_cache.inputs(fn, chemslab_version, yslice=yslice,
+                                       xslice=xslice, vrange=vrange,
+                                       maxbeam=maxbeam)
+        tasks.append((list(products.values()), inputs,
+                      (fn, yslice, xslice, vrange, maxbeam)))
+        plotfiles.append((fn, linename, products))
+    chemslab_cache.ensure(tasks, make_chem_slabs, nprocs=nprocs)
+
+    figcounter = 0
+
+    for ii,(fn,linename,products) in enumerate(ProgressBar(plotfiles)):
+
         label = labeldict[linename]
 
-        # cache the results for use in other work, later use, ...
-        m0fitsfn = paths.dpath("chemslices/chemical_m0_slabs_{0}_{1}{2}.fits".format(sourcename, linename, suffix))
-        m1fitsfn = paths.dpath("chemslices/chemical_m1_slabs_{0}_{1}{2}.fits".format(sourcename, linename, suffix))
-        m2fitsfn = paths.dpath("chemslices/chemical_m2_slabs_{0}_{1}{2}.fits".format(sourcename, linename, suffix))
-        maxfitsfn = paths.dpath("chemslices/chemical_max_slabs_{0}_{1}{2}.fits".format(sourcename, linename, suffix))
-        maxsubfitsfn = paths.dpath("chemslices/chemical_max_sub_slabs_{0}_{1}{2}.fits".format(sourcename, linename, suffix))
-        madstdfitsfn = paths.dpath("chemslices/chemical_madstd_slabs_{0}_{1}{2}.fits".format(sourcename, linename, suffix))
-        if not (os.path.exists(m0fitsfn) and
-                os.path.exists(m2fitsfn) and
-                os.path.exists(maxfitsfn) and
-                os.path.exists(madstdfitsfn)):
+        if chemslab_cache.lookup(products['m0']) is None:
             print()
-            print("Extracting max/m0/m1/m2 for {0}".format(fn))
-            cube = SpectralCube.read(fn)[:,yslice,xslice]
-            goodbeams = np.array([bm.major < maxbeam for bm in cube.beams], dtype='bool')
-            if np.count_nonzero(goodbeams) < 5:
-                print()
-                print("Skipping {0} because it has too few good beams.".format(fn))
-                continue
-
-            cube = cube.with_mask(goodbeams[:,None,None])
-            cube = cube.minimal_subcube()
-
-
-            if cube.shape[0] == 0:
-                print()
-                print("Skipping {0} because it was masked out".format(fn))
-                continue
-
-            bm = cube.beams[0]
-            restfreq = cube.wcs.wcs.restfrq
-            cube = cube.to(u.K, bm.jtok_equiv(restfreq*u.Hz))
-
-            slab = cube.spectral_slab(*vrange)
-            cube.beam_threshold = 1
-            #contguess = cube.spectral_slab(0*u.km/u.s, 40*u.km/u.s).percentile(50, axis=0)
-            #contguess = cube.spectral_slab(70*u.km/u.s, 100*u.km/u.s).percentile(50, axis=0)
-            mask = (cube.spectral_axis<40*u.km/u.s) | (cube.spectral_axis > 75*u.km/u.s)
-            try:
-                contguess = cube.with_mask(mask[:,None,None]).percentile(30, axis=0)
-            except ValueError as ex:
-                print()
-                print("skipping {0}".format(fn))
-                print(ex)
-                continue
-            slabsub = (slab-contguess)
-            slab.beam_threshold = 0.25
-            slabsub.beam_threshold = 0.25
-            m0 = slabsub.moment0()
-            m1 = slabsub.moment1()
-            m2 = slabsub.moment2()
-            max_sub = slabsub.max(axis=0)
-            max = slab.max(axis=0)
-            madstd = cube.with_mask(mask[:,None,None]).apply_function(mad_std,
-                                                                      axis=0,
-                                                                      projection=True,
-                                                                      progressbar=True,
-                                                                      unit=cube.unit,)
-
-            m0.write(m0fitsfn, overwrite=True)
-            m1.write(m1fitsfn, overwrite=True)
-            m2.write(m2fitsfn, overwrite=True)
-            max.write(maxfitsfn, overwrite=True)
-            max_sub.write(maxsubfitsfn, overwrite=True)
-            madstd.write(madstdfitsfn, overwrite=True)
-            maxfh = max.hdu
-        else:
-            m0fh = fits.open(m0fitsfn)
-            m1fh = fits.open(m1fitsfn)
-            m2fh = fits.open(m2fitsfn)
-            maxfh = fits.open(maxfitsfn)[0]
-            maxsubfh = fits.open(maxsubfitsfn)
-            madstdfh = fits.open(madstdfitsfn)
-
-            m0 = Projection(value=m0fh[0].data, header=m0fh[0].header,
-                            wcs=wcs.WCS(m0fh[0].header),
-                            unit=u.Unit(m0fh[0].header['BUNIT']),)
-            m1 = Projection(value=m1fh[0].data, header=m1fh[0].header,
-                            wcs=wcs.WCS(m1fh[0].header),
-                            unit=u.Unit(m1fh[0].header['BUNIT']),)
-            m2 = Projection(value=m2fh[0].data, header=m2fh[0].header,
-                            wcs=wcs.WCS(m2fh[0].header),
-                            unit=u.Unit(m2fh[0].header['BUNIT']),)
-            max = Projection(value=maxfh.data, header=maxfh.header,
-                             wcs=wcs.WCS(maxfh.header),
-                             unit=u.Unit(maxfh.header['BUNIT']),)
-            max_sub = Projection(value=maxsubfh[0].data,
-                                 header=maxsubfh[0].header,
-                                 wcs=wcs.WCS(maxsubfh[0].header),
-                                 unit=u.Unit(maxsubfh[0].header['BUNIT']),)
-            madstd = Projection(value=madstdfh[0].data,
-                                header=madstdfh[0].header,
-                                wcs=wcs.WCS(madstdfh[0].header),
-                                unit=u.Unit(madstdfh[0].header['BUNIT']),)
-
-            bm = radio_beam.Beam.from_fits_header(m0fh[0].header)
-            restfreq = m0fh[0].header['RESTFRQ']
+            print("Skipping {0}: no valid slab products".format(fn))
+            continue
+
+        m0fh = fits.open(products['m0'])
+        m1fh = fits.open(products['m1'])
+        m2fh = fits.open(products['m2'])
+        maxfh = fits.open(products['max'])[0]
+        maxsubfh = fits.open(products['max_sub'])
+        madstdfh = fits.open(products['madstd'])
+
+        m0 = Projection(value=m0fh[0].data, header=m0fh[0].header,
+                        wcs=wcs.WCS(m0fh[0].header),
+                        unit=u.Unit(m0fh[0].header['BUNIT']),)
+        m1 = Projection(value=m1fh[0].data, header=m1fh[0].header,
+                        wcs=wcs.WCS(m1fh[0].header),
+                        unit=u.Unit(m1fh[0].header['BUNIT']),)
+        m2 = Projection(value=m2fh[0].data, header=m2fh[0].header,
+                        wcs=wcs.WCS(m2fh[0].header),
+                        unit=u.Unit(m2fh[0].header['BUNIT']),)
+        max = Projection(value=maxfh.data, header=maxfh.header,
+                         wcs=wcs.WCS(maxfh.header),
+                         unit=u.Unit(maxfh.header['BUNIT']),)
+        max_sub = Projection(value=maxsubfh[0].data,
+                             header=maxsubfh[0].header,
+                             wcs=wcs.WCS(maxsubfh[0].header),
+                             unit=u.Unit(maxsubfh[0].header['BUNIT']),)
+        madstd = Projection(value=madstdfh[0].data,
+                            header=madstdfh[0].header,
+                            wcs=wcs.WCS(madstdfh[0].header),
+                            unit=u.Unit(madstdfh[0].header['BUNIT']),)
+
+        bm = radio_beam.Beam.from_fits_header(m0fh[0].header)
+        restfreq = m0fh[0].header['RESTFRQ']
 
         jtok = bm.jtok(restfreq*u.Hz)
 
@@ -13,7 +13,7 @@ from astropy.io import fits
 from astropy import wcs
 from astropy.stats import mad_std
 from line_to_image_list import labeldict
-import reproject
+import reprojection_cache
 
 import re
 import glob
@@ -35,7 +35,7 @@ if 'PN5-4' in labeldict:
 def get_cont(header):
     contfn = paths.dpath('W51_te_continuum_best.fits')
     beam = radio_beam.Beam.from_fits_header(contfn)
-    cont_Jy = reproject.reproject_interp(input_data=contfn,
+    cont_Jy = reprojection_cache.reproject_interp(input_data=contfn,
                                          output_projection=header)[0]*u.Jy
     cont_K = cont_Jy.to(u.K, u.brightness_temperature(beam,
                                                       continuum_frequency))
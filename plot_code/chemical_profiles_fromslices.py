@@ -11,6 +11,9 @@ from astropy import units as u
 
 import re
 import glob
+from product_cache import ProductCache
+
+chemslab_cache = ProductCache(paths.dpath('chemslices'))
 
 linere = re.compile("chemical_m0_slabs_[^_]*_(.*?)(_merge.fits|.fits)")
 
@@ -26,11 +29,12 @@ for slicetype in ('m0','max'):
         fig.clf()
         ax = pl.gca()
         ax.set_title(region)
-        path_template = paths.dpath("chemslices/chemical_{1}_slabs*_{0}_*.fits".format(region, slicetype))
+        path_template = "chemical_{1}_slabs*_{0}_*.fits".format(region, slicetype)
 
         slices = {}
 
-        for ii,fn in enumerate(glob.glob(path_template)):
+        # only up-to-date products (see chem_images.chem_plot)
+        for ii,fn in enumerate(chemslab_cache.products(path_template)):
             if 'natural' in fn or 'merge' in fn:
                 continue
 
@@ -12,6 +12,7 @@ from matplotlib.patches import Circle
 
 # can take time:
 from volume_integrals import mass_scalings
+from catalog_store import default_store as store
 
 pl.style.use('classic')
 pl.matplotlib.rc_file('pubfiguresrc')
@@ -23,7 +24,7 @@ pl.mpl.rcParams['axes.color_cycle'] = ('338ADD', '9A44B6', 'A60628', '467821',
                                        'g', 'm', 'k')
 
 #pruned_ppcat = Table.read(paths.tpath("dendrogram_continuum_catalog.ipac"), format='ascii.ipac')
-dendro_merge = Table.read(paths.tpath('dendro_merge_continuum_and_line.ipac'), format='ascii.ipac')
+dendro_merge = store.read('dendro_merge_continuum_and_line')
 corelike = dendro_merge['corelike'] == 'True'
 
 fig1 = pl.figure(1)
@@ -61,9 +62,9 @@ fig2.savefig(paths.fpath('coreplots/dendro_flux_powerlaw_histogram_fit.png'), bb
 print("Fit parameters: alpha={0}".format(fit.power_law.alpha))
 
 radii = (0.2,0.4,0.6,0.8,1.0,1.5)*u.arcsec
-lines = np.array([[row['peak_cont_flux']] + [row['cont_flux{0}arcsec'.format(rad).replace(".","p")]
-                                        for rad in radii.value]
-                  for row in dendro_merge])
+lines = np.array([dendro_merge['peak_cont_flux']] +
+                 [dendro_merge['cont_flux{0}arcsec'.format(rad).replace(".","p")]
+                  for rad in radii.value]).T
 pradii = (0.0,0.2,0.4,0.6,0.8,1.0,1.5)
 
 pl.clf()
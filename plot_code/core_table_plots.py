@@ -12,6 +12,7 @@ import matplotlib
 import os
 from astropy import log
 import contextlib
+from catalog_store import default_store as store
 devnull = open(os.devnull,'w')
 
 log.setLevel('CRITICAL')
@@ -31,9 +32,10 @@ pl.mpl.rcParams['axes.prop_cycle'] = matplotlib.cycler('color', ('338ADD',
                                                                  'r', 'g', 'm',
                                                                  'k'))
 
-core_velo_tbl = Table.read(paths.tpath("core_velocities.ipac"), format="ascii.ipac")
-core_phot_tbl = Table.read(paths.tpath("continuum_photometry.ipac"), format='ascii.ipac')
-cores_merge = Table.read(paths.tpath('core_continuum_and_line.ipac'), format='ascii.ipac')
+core_phot_tbl = store.load('continuum_photometry',
+                           paths.tpath("continuum_photometry.ipac"),
+                           rename={'name': 'SourceID'}, columns=['peak'])
+cores_merge = store.read('core_continuum_and_line')
 
 beam_area = cores_merge['beam_area']
 jy_to_k = (1*u.Jy).to(u.K, u.brightness_temperature(u.Quantity(beam_area, u.sr),
@@ -0,0 +1 @@
+../analysis/cube_stats.py
\ No newline at end of file
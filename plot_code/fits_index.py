@@ -0,0 +1 @@
+../analysis/fits_index.py
\ No newline at end of file
@@ -4,6 +4,8 @@ from astroquery.splatalogue import Splatalogue
 from astropy import units as u
 import paths
 import pylab as pl
+import numpy as np
+from spectrum_atlas import LineCatalogIndex, plot_panel
 
 
 plot_kwargs = {'color':'r', 'linestyle':'--'}
@@ -40,29 +42,48 @@ velo = {'e8mm': 61*u.km/u.s,
 
 pl.figure(1).clf()
 
+# the catalog queries only depend on the frequency range and species, so
+# they are shared by all targets observed with the same spws
+catalogs = {}
+def query_catalog(fmin, fmax, chemid, tmax):
+    key = (np.round(fmin, 3), np.round(fmax, 3), chemid, tmax)
+    if key not in catalogs:
+        catalogs[key] = Splatalogue.query_lines(fmin*u.GHz, fmax*u.GHz,
+                                                chemical_name=chemid,
+                                                energy_max=tmax,
+                                                energy_type='eu_k', noHFS=True,
+                                                line_lists=['SLAIM'])
+    return catalogs[key]
+
 for target,species_list in spectra_to_species.items():
     spectra = pyspeckit.Spectra(glob.glob(paths.spath("*{0}*fits".format(target))))
+    # load the arrays once per target
+    arrays = []
+    for ii in range(4):
+        freq = spectra[ii].xarr.as_unit(u.GHz).value
+        order = np.argsort(freq)
+        arrays.append((freq[order],
+                       np.ma.filled(spectra[ii].data.astype('float'), np.nan)[order]))
 
     for species_tuple in species_list:
         species_name, chemid, tmax = species_tuple
 
         for ii in range(4):
-            cat = Splatalogue.query_lines(spectra[ii].xarr.min(),
-                                          spectra[ii].xarr.max(),
-                                          chemical_name=chemid,
-                                          energy_max=tmax,
-                                          energy_type='eu_k', noHFS=True,
-                                          line_lists=['SLAIM'])
-            spectra[ii].plotter(figure=pl.figure(1))
-            spectra[ii].plotter.axis.set_ylim(snu_min[target], spectra[ii].plotter.axis.get_ylim()[1])
-            spectra[ii].plotter.line_ids(cat['Resolved QNs'],
-                                         cat['Freq-GHz']*u.GHz,
-                                         velocity_offset=velo[target],
-                                         plot_kwargs=plot_kwargs,
-                                         annotate_kwargs=annotate_kwargs)
-            spectra[ii].plotter.savefig(paths.fpath('line_id_spectra/{target}_{species_name}_{chemid}_spw{0}.png'.format(ii,
-                                                                                                                         target=target,
-                                                                                                                         chemid=chemid,
-                                                                                                                         species_name=species_name,
-                                                                                                                        )),
-                                        bbox_extra_artists=[])
+            freq, data = arrays[ii]
+            cat = query_catalog(freq.min(), freq.max(), chemid, tmax)
+            # a list, not a dict: quantum numbers repeat between transitions
+            lineindex = LineCatalogIndex(list(zip(cat['Resolved QNs'],
+                                                  cat['Freq-GHz']*u.GHz)))
+            fig = pl.figure(1)
+            fig.clf()
+            ax = fig.gca()
+            plot_panel(ax, freq, data, lineindex=lineindex,
+                       velocity=velo[target].to(u.km/u.s).value,
+                       ymin=snu_min[target], fontsize=8, linewidth=1,
+                       line_color=plot_kwargs['color'])
+            fig.savefig(paths.fpath('line_id_spectra/{target}_{species_name}_{chemid}_spw{0}.png'.format(ii,
+                                                                                                         target=target,
+                                                                                                         chemid=chemid,
+                                                                                                         species_name=species_name,
+                                                                                                        )),
+                        bbox_extra_artists=[])
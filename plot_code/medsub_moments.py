@@ -3,8 +3,7 @@ import glob
 import collections
 from astropy import units as u
 from spectral_cube import SpectralCube
-#from astropy.stats import mad_std
-from mad import mad_std_nan
+import cube_stats
 import numpy as np
 
 import matplotlib
@@ -188,11 +187,11 @@ for fn in files:
             if key in fname:
                 pct = cont_percentiles[key]
 
-        contmasked_cube = vcube.with_mask(((vcube.spectral_axis < 35*u.km/u.s)
-                                           | (vcube.spectral_axis >
-                                              80*u.km/u.s))[:,None,None])
+        contmask = ((vcube.spectral_axis < 35*u.km/u.s) |
+                    (vcube.spectral_axis > 80*u.km/u.s))
 
-        med = contmasked_cube.percentile(pct, axis=0)
+        med = cube_stats.percentile_map(vcube, pct, channel_mask=contmask)
+        madstd = cube_stats.mad_std_map(vcube, channel_mask=contmask)
         vcube = vcube.spectral_slab(50*u.km/u.s, 65*u.km/u.s)
         # I hope this isn't needed....
         vcube.allow_huge_operations=True
@@ -201,19 +200,6 @@ for fn in files:
         m0 = vcube_msub.moment0(axis=0)
         m1 = vcube_msub.moment1(axis=0)
         m2 = vcube_msub.moment2(axis=0)
-        # required if mad_std can't handle NaNs
-        #madstd = contmasked_cube.apply_function(mad_std, axis=0,
-        #                                        projection=True,
-        #                                        progressbar=True,
-        #                                        unit=cube.unit,)
-        madstd = contmasked_cube.apply_numpy_function(mad_std_nan,
-                                                      axis=0,
-                                                      projection=True,
-                                                      unit=cube.unit,
-                                                      fill=np.nan,
-                                                      how='cube',
-                                                      reduce=True,
-                                                      progressbar=True)
         pmax = vcube_msub.max(axis=0)
 #        argmax = vcube.spectral_axis[vcube_msub.argmax(axis=0)]
 
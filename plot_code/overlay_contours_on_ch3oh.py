@@ -2,7 +2,7 @@ import numpy as np
 import aplpy
 import paths
 import matplotlib
-import reproject
+import reprojection_cache
 import radio_beam
 import dust_emissivity
 from astropy.io import fits
@@ -87,14 +87,14 @@ for source in ('e8','north','e2',):
     ch3ohN_hdul = fits.open(paths.dpath('12m/moments/CH3OH_{0}_cutout_columnmap.fits'.format(source)))
     ch3ohT_hdul = fits.open(paths.dpath('12m/moments/CH3OH_{0}_cutout_temperaturemap.fits'.format(source)))
     ch3oh_808_mx = fits.open(paths.dpath('chemslices/chemical_max_slabs_{0}_CH3OH808-716_merge.fits'.format(source)))
-    dust_brightness,wts = reproject.reproject_interp(fits.open(paths.dpath('W51_te_continuum_best.fits')),
+    dust_brightness,wts = reprojection_cache.reproject_interp(fits.open(paths.dpath('W51_te_continuum_best.fits')),
                                                      ch3ohN_hdul[0].header)
     # it's already in K!
     #ch3oh_808_mx_K = (ch3oh_808_mx[0].data*u.Jy).to(u.K,
     #                                                u.brightness_temperature(radio_beam.Beam.from_fits_header(ch3oh_808_mx[0].header),
     #                                                                         ch3oh_808_mx[0].header['RESTFRQ']*u.Hz))
     #ch3oh_808_mx[0].data = ch3oh_808_mx_K.value
-    ch3oh_808_peak,_ = reproject.reproject_interp(ch3oh_808_mx,
+    ch3oh_808_peak,_ = reprojection_cache.reproject_interp(ch3oh_808_mx,
                                                   ch3ohN_hdul[0].header)
 
 
@@ -8,6 +8,7 @@ from astropy import units as u
 import paths
 import pylab as pl
 import matplotlib as mpl
+import spectrum_atlas
 
 line_ids = {line_to_image_list.labeldict[linename]:
             float(freqstr.strip('GHz'))*u.GHz
@@ -95,45 +96,22 @@ if __name__ == "__main__":
                     for row in line_table}
     all_line_ids.update(line_ids)
 
+    # the all-lines and default line-ID figures of every core are rendered
+    # in parallel from the cached spectra
+    all_line_index = spectrum_atlas.LineCatalogIndex(all_line_ids)
+    default_line_index = spectrum_atlas.LineCatalogIndex(line_ids)
+    jobs = []
     for row in myvtbl:
-
-        speclist = [pyspeckit.Spectrum(fn) for fn in
-                    glob.glob(paths.spath("{0}_spw*_peak.fits".format(row['source'])))]
-        if len(speclist) == 0:
-            continue
-
-        for sp in speclist:
-            beam = radio_beam.Beam.from_fits_header(sp.header)
-            sp.data *= beam.jtok(sp.xarr)
-            sp.unit='K'
-
-        plot_whole_spectrum(speclist,
-                            title=row['source'],
-                            line_id=all_line_ids,
-                            figname='fullspectra/ALLLINES_{0}.png'.format(row['source']),
-                            velocity=row['velocity']*u.km/u.s,
-                           )
-
-
-
-    # default: show only line-to-image-list lines
-    for row in myvtbl:
-
-        speclist = [pyspeckit.Spectrum(fn) for fn in
-                    glob.glob(paths.spath("{0}_spw*_peak.fits".format(row['source'])))]
-        if len(speclist) == 0:
-            continue
-
-        for sp in speclist:
-            beam = radio_beam.Beam.from_fits_header(sp.header)
-            sp.data *= beam.jtok(sp.xarr)
-            sp.unit='K'
-
-        plot_whole_spectrum(speclist,
-                            title=row['source'],
-                            figname='fullspectra/{0}.png'.format(row['source']),
-                            velocity=row['velocity']*u.km/u.s,
-                           )
+        jobs.append((row['source'], all_line_index,
+                     row['velocity']*u.km/u.s,
+                     'fullspectra/ALLLINES_{0}.png'.format(row['source']),
+                     row['source']))
+        # default: show only line-to-image-list lines
+        jobs.append((row['source'], default_line_index,
+                     row['velocity']*u.km/u.s,
+                     'fullspectra/{0}.png'.format(row['source']),
+                     row['source']))
+    spectrum_atlas.render_figure_set(jobs, nprocs=4)
 
 
     # Methanol lines (for identification purposes - similar to ch3oh spectral
@@ -0,0 +1 @@
+../analysis/product_cache.py
\ No newline at end of file
@@ -0,0 +1 @@
+../analysis/radial_bins.py
\ No newline at end of file
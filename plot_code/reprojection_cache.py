@@ -0,0 +1 @@
+../analysis/reprojection_cache.py
\ No newline at end of file
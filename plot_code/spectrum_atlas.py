@@ -0,0 +1,250 @@
+"""
+Fast rendering backend for full-band, line-identified spectrum plots.
+
+* Each core's four spw spectra are loaded once (converted to K) into compact
+  float32 arrays, kept in memory and in an ``.npz`` cache next to the spectra
+  so other processes can share them.
+* Spectra are drawn after min/max-preserving decimation to the pixel width of
+  the axes: every pixel column keeps its minimum and maximum sample, so
+  narrow lines are not lost, but a 3840-channel spw is drawn with ~2 points
+  per pixel.
+* Line annotations are placed from a sorted rest-frequency index: the lines
+  in each panel are found with two `np.searchsorted` calls.
+* Figures are made with the object-oriented matplotlib API (no pyplot state)
+  so whole figure sets can be rendered on a process pool.
+"""
+import os
+import glob
+import zipfile
+import multiprocessing
+import numpy as np
+from astropy import units as u
+from astropy import constants
+import paths
+
+ckms = constants.c.to(u.km/u.s).value
+
+_spectra_cache = {}
+
+
+def _spectrum_files(source, pattern="{0}_spw*_peak.fits"):
+    return sorted(glob.glob(paths.spath(pattern.format(source))))
+
+
+def load_core_spectra(source, pattern="{0}_spw*_peak.fits", use_disk_cache=True):
+    """
+    Load the spw spectra of ``source`` once, in GHz and K.
+
+    Returns
+    -------
+    spectra : list
+        (frequency [GHz], brightness [K]) float32 array pairs, one per spw,
+        sorted by frequency
+    """
+    files = _spectrum_files(source, pattern)
+    if len(files) == 0:
+        return []
+    key = (source, pattern)
+    mtimes = [os.path.getmtime(fn) for fn in files]
+    if key in _spectra_cache and _spectra_cache[key][0] == mtimes:
+        return _spectra_cache[key][1]
+
+    cachefn = paths.spath("{0}_atlas_cache.npz".format(source))
+    spectra = None
+    if use_disk_cache and os.path.exists(cachefn):
+        try:
+            cached = np.load(cachefn)
+            if (list(cached['files']) == files and
+                    np.allclose(cached['mtimes'], mtimes)):
+                spectra = [(cached['freq{0}'.format(ii)],
+                            cached['data{0}'.format(ii)])
+                           for ii in range(len(files))]
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+            # an unreadable cache is rebuilt
+            spectra = None
+
+    if spectra is None:
+        import pyspeckit
+        import radio_beam
+        spectra = []
+        for fn in files:
+            sp = pyspeckit.Spectrum(fn)
+            beam = radio_beam.Beam.from_fits_header(sp.header)
+            freq = sp.xarr.as_unit(u.GHz).value
+            data = np.ma.filled(sp.data.astype('float'), np.nan)
+            data = data * beam.jtok(freq*u.GHz).value
+            order = np.argsort(freq)
+            spectra.append((freq[order].astype('float32'),
+                            data[order].astype('float32')))
+        if use_disk_cache:
+            arrays = {'files': np.array(files), 'mtimes': np.array(mtimes)}
+            for ii, (freq, data) in enumerate(spectra):
+                arrays['freq{0}'.format(ii)] = freq
+                arrays['data{0}'.format(ii)] = data
+            # write to a temporary file first: other processes may be
+            # reading (or writing) the same cache
+            tmpfn = "{0}.{1}.tmp".format(cachefn, os.getpid())
+            with open(tmpfn, 'wb') as fh:
+                np.savez(fh, **arrays)
+            os.replace(tmpfn, cachefn)
+
+    _spectra_cache[key] = (mtimes, spectra)
+    return spectra
+
+
+def minmax_decimate(x, y, npix):
+    """
+    Reduce (x, y) to at most ``2*npix`` points, keeping the minimum and the
+    maximum of y in each of ``npix`` equal-count buckets, in their original
+    order.  NaNs are ignored.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(y) <= 2*npix:
+        return x, y
+    bucketsize = int(np.ceil(len(y)/float(npix)))
+    nbuckets = int(np.ceil(len(y)/float(bucketsize)))
+    pad = nbuckets*bucketsize - len(y)
+    yy = np.concatenate([y, np.full(pad, np.nan)]).reshape(nbuckets, bucketsize)
+    allnan = np.all(np.isnan(yy), axis=1)
+    yy[allnan] = 0
+    imin = np.nanargmin(yy, axis=1)
+    imax = np.nanargmax(yy, axis=1)
+    first = np.minimum(imin, imax)
+    second = np.maximum(imin, imax)
+    offsets = np.arange(nbuckets)*bucketsize
+    inds = np.array([first+offsets, second+offsets]).T.ravel()
+    inds = inds[~np.repeat(allnan, 2)]
+    return x[inds], y[inds]
+
+
+class LineCatalogIndex(object):
+    """
+    Sorted rest-frequency index of a {name: frequency} line dictionary, or of
+    a list of (name, frequency) pairs.  Use the list when names repeat (e.g.
+    the same quantum numbers of different species or transitions): every
+    pair is kept.
+    """
+    def __init__(self, line_ids):
+        if isinstance(line_ids, dict):
+            line_ids = list(line_ids.items())
+        names = [name for name, freq in line_ids]
+        freqs = u.Quantity([freq for name, freq in line_ids], u.GHz).value
+        order = np.argsort(freqs)
+        self.names = np.array(names)[order]
+        self.freqs = freqs[order]
+
+    def in_range(self, fmin, fmax, velocity=0.0):
+        """
+        The lines whose observed frequency at ``velocity`` (km/s) falls in
+        [fmin, fmax] GHz.  Returns (names, observed frequencies).
+        """
+        shift = 1 - velocity/ckms
+        lo = np.searchsorted(self.freqs, fmin/shift, side='left')
+        hi = np.searchsorted(self.freqs, fmax/shift, side='right')
+        return self.names[lo:hi], self.freqs[lo:hi]*shift
+
+
+def plot_panel(ax, freq, data, lineindex=None, velocity=0.0, fontsize=4,
+               linewidth=0.25, ymin=None, nlevels=4, color='k',
+               line_color='r'):
+    """
+    Draw one (decimated) spectrum panel with line annotations
+    """
+    fig = ax.figure
+    npix = int(np.ceil(ax.get_position().width * fig.get_figwidth() * fig.dpi))
+    xx, yy = minmax_decimate(freq, data, max(npix, 1))
+    ax.plot(xx, yy, color=color, linewidth=0.5, drawstyle='steps-mid')
+    ax.set_xlim(np.nanmin(freq), np.nanmax(freq))
+    lo, hi = np.nanmin(data), np.nanmax(data)
+    if ymin is not None:
+        lo = ymin
+    span = hi - lo
+    ax.set_ylim(lo, hi + 0.35*span)
+    ax.set_xlabel("Frequency (GHz)")
+    ax.ticklabel_format(useOffset=False, axis='x')
+
+    if lineindex is not None:
+        names, lfreqs = lineindex.in_range(np.nanmin(freq), np.nanmax(freq),
+                                           velocity=velocity)
+        # stagger the labels over a few heights to limit overlaps
+        for ii, (name, lfreq) in enumerate(zip(names, lfreqs)):
+            ylabel = hi + span*(0.05 + 0.07*(ii % nlevels))
+            ax.vlines(lfreq, lo, ylabel, color=line_color,
+                      linewidth=linewidth)
+            ax.text(lfreq, ylabel, name, rotation=90, fontsize=fontsize,
+                    ha='center', va='bottom', color=line_color)
+
+
+def render_whole_spectrum(spectra, line_ids=None, velocity=55*u.km/u.s,
+                          figsize=(8.3,11.7), figname=None, title=None,
+                          fontsize=4, linewidth=0.25, dpi=300):
+    """
+    The seven-panel layout of ``plot_whole_spectrum``: spw0 on top, then the
+    low and high halves of spws 1-3.
+
+    Parameters
+    ----------
+    spectra : list
+        (frequency [GHz], data [K]) pairs from `load_core_spectra`
+    line_ids : dict, list or `LineCatalogIndex`
+        Lines to annotate
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    if line_ids is not None and not isinstance(line_ids, LineCatalogIndex):
+        line_ids = LineCatalogIndex(line_ids)
+    velocity = u.Quantity(velocity, u.km/u.s).value
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+
+    panels = [spectra[0]]
+    for freq, data in spectra[1:4]:
+        half = int(len(freq)/2)
+        panels += [(freq[:half], data[:half]), (freq[half:], data[half:])]
+
+    for ii, (freq, data) in enumerate(panels):
+        ax = fig.add_subplot(7, 1, ii+1)
+        plot_panel(ax, freq, data, lineindex=line_ids, velocity=velocity,
+                   fontsize=fontsize, linewidth=linewidth)
+        ax.set_ylabel("$T_B$ [K]")
+        if ii == 0 and title is not None:
+            ax.set_title(title)
+
+    if figname is not None:
+        fig.savefig(paths.fpath(figname), dpi=dpi, bbox_inches='tight',
+                    bbox_extra_artists=[])
+    return fig
+
+
+def _render_job(job):
+    source, line_ids, velocity, figname, title = job
+    spectra = load_core_spectra(source)
+    if len(spectra) == 0:
+        return None
+    render_whole_spectrum(spectra, line_ids=line_ids, velocity=velocity,
+                          figname=figname, title=title)
+    return figname
+
+
+def render_figure_set(jobs, nprocs=4):
+    """
+    Render many whole-spectrum figures in parallel.
+
+    Parameters
+    ----------
+    jobs : list
+        (source, line_ids, velocity, figname, title) tuples; ``line_ids`` may
+        be a dict, a list of (name, frequency) pairs or a `LineCatalogIndex`
+        (build it once and share it)
+    """
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            return pool.map(_render_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [_render_job(job) for job in jobs]
@@ -35,6 +35,7 @@ from scipy import signal,interpolate
 import warnings
 import image_tools
 import spectral_cube
+from stage_timing import stage, staged
 from spectral_cube import SpectralCube,BooleanArrayMask
 import matplotlib
 
@@ -121,6 +122,7 @@ def load_dataset_for_debugging(lowhigh='low', downsample_factor=8,
 def get_sourcenames(headers):
     return list(set([h['SOURC'].strip() for h in headers]))
 
+@staged(kind='io')
 def load_apex_cube(apex_filename='data/E-085.B-0964A-2010.apex',
                    skip_data=False, DEBUG=False, downsample_factor=None,
                    sourcename=None, xtel=None,
@@ -134,6 +136,7 @@ def load_apex_cube(apex_filename='data/E-085.B-0964A-2010.apex',
         return None,None,None
     return found_data
 
+@staged(kind='compute')
 def select_apex_data(spectra, headers, indices, sourcename=None,
                      shapeselect=None, tsysrange=None, rchanrange=None,
                      xscan=None,
@@ -244,6 +247,7 @@ def select_apex_data(spectra, headers, indices, sourcename=None,
 
     return data,hdrs,coords
 
+@staged(kind='compute')
 def process_data(data, coords, hdrs, dataset, scanblsub=False,
                  subspectralmeans=True, verbose=False, noisefactor=3.0,
                  linemask=False, automask=2,
@@ -411,6 +415,7 @@ def hdr_to_velo(h):
     veloarr = (np.arange(h['NCHAN'])+1-h['RCHAN']) * h['VRES'] + h['VOFF']
     return veloarr
 
+@staged(kind='grid')
 def add_apex_data(data, hdrs, coords, cubefilename, noisecut=np.inf,
                   retfreq=False, excludefitrange=None, varweight=True,
                   coordframe='fk5',
@@ -523,6 +528,7 @@ def add_pipeline_header_data(header):
     header['BUNIT'] = ('K', 'T_A*; ETAMB has efficiency')
     header['ETAMB'] = (0.75, 'http://www.apex-telescope.org/telescope/efficiency/')
 
+@staged(kind='io')
 def make_blanks(coords, header, cubefilename, clobber=True,
                 pixsize=7.2*u.arcsec, coordframe='fk5'):
 
@@ -567,6 +573,7 @@ def make_blanks(coords, header, cubefilename, clobber=True,
                                flatheader=flatheader, clobber=clobber,
                                dtype='float32')
 
+@staged(kind='io')
 def make_blanks_freq(coords, header, cubefilename, clobber=True,
                      pixsize=7.2*u.arcsec, coordframe='fk5'):
     """ complete freq covg """
@@ -618,6 +625,7 @@ def make_blanks_freq(coords, header, cubefilename, clobber=True,
                                dtype='float32')
 
 
+@staged(kind='io')
 def make_blanks_merge(cubefilename, clobber=True,
                       width=1.0*u.GHz, lowest_freq=None, pixsize=7.2*u.arcsec,
                       restfreq=218222.192*u.MHz, cd_kms=0.25, naxis1=88,
@@ -662,6 +670,7 @@ def make_blanks_merge(cubefilename, clobber=True,
                                cubeheader=cubeheader, clobber=clobber,
                                dtype='float32')
 
+@staged(kind='plot')
 def data_diagplot(data, dataset, diagplotdir, ext='png', newfig=False,
                   max_size=1024, freq=None, scans=None, figure=None,
                   axis=None):
@@ -714,6 +723,7 @@ def data_diagplot(data, dataset, diagplotdir, ext='png', newfig=False,
         print(ex)
     return axis
 
+@staged(kind='plot')
 def diagplot(data, tsys, noise, dataset, diagplotdir, freq=None, mask=None,
              noisefactor=None, ext='png', newfig=False, theoretical_rms=None,
              **kwargs):
@@ -810,6 +820,7 @@ def diagplot(data, tsys, noise, dataset, diagplotdir, freq=None, mask=None,
 
     data_diagplot(data, os.path.basename(dataset), diagplotdir, ext=ext, newfig=newfig, freq=freq, **kwargs)
 
+@staged
 def build_cube_generic(window, line, freq=True, mergefile=None, datapath='./',
                        outpath='./', datasets=[], scanblsub=False,
                        shapeselect=None,
@@ -961,6 +972,7 @@ def build_cube_generic(window, line, freq=True, mergefile=None, datapath='./',
 
     log.info("Done with "+cubefilename)
 
+@staged(kind='io')
 def downsample_cube(cubefilename, downsample_factor):
     log.info("Downsampling "+cubefilename)
     cube = fits.open(cubefilename+".fits")
@@ -973,6 +985,7 @@ def downsample_cube(cubefilename, downsample_factor):
     cube.writeto(cubefilename+'_downsampled.fits', clobber=True)
 
 
+@staged
 def do_plait_h2comerge(mergepath=None, mergefile2=None):
     """
     doplait, not yoplait
@@ -1064,6 +1077,7 @@ def do_plait_h2comerge(mergepath=None, mergefile2=None):
  
 
 
+@staged
 def make_individual_cubes_12CO():
 
     # In [7]: set([(h['LINE'], h['XTEL'], h['RESTF'], h['FRES'] - h['FRES']%0.00001) for h in found_data[1]])
@@ -1092,6 +1106,7 @@ def make_individual_cubes_12CO():
                        automask=False,
                        noisefactor=10)
 
+@staged
 def make_individual_cubes_H2CO():
     datasets_H2CO_13CO = ["/Volumes/passport/w51-apex/raw/E-098.C-0421A.2016AUG02/E-098.C-0421A-2016-2016-08-01",
                           "/Volumes/passport/w51-apex/raw/E-098.C-0421A.2016AUG03/E-098.C-0421A-2016-2016-08-02",
@@ -1109,6 +1124,7 @@ def make_individual_cubes_H2CO():
 
 
 
+@staged
 def make_12CO_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                           mergefile1 = 'W51_12CO_merge',
                           datasets_H2CO_13CO_OS = ["/Volumes/passport/w51-apex/raw/E-098.C-0421A.2016AUG02/E-098.C-0421A-2016-2016-08-01",
@@ -1140,6 +1156,7 @@ def make_12CO_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                        flagdata=False,
                       )
 
+@staged
 def make_232_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                        mergefile1='W51_232GHz_merge',
                        datasets_H2CO_13CO_OS=["/Volumes/passport/w51-apex/raw/E-098.C-0421A.2016AUG02/E-098.C-0421A-2016-2016-08-01",
@@ -1169,6 +1186,7 @@ def make_232_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                        noisefactor=10,
                       )
 
+@staged
 def make_H2CO_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                         mergefile1='W51_217GHz_merge',
                         datasets_H2CO_13CO=["/Volumes/passport/w51-apex/raw/E-098.C-0421A.2016AUG02/E-098.C-0421A-2016-2016-08-01",
@@ -1195,6 +1213,7 @@ def make_H2CO_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                       )
 
 
+@staged
 def make_218_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                        mergefile1='W51_218GHz_merge',
                        datasets_H2CO_13CO=["/Volumes/passport/w51-apex/raw/E-098.C-0421A.2016AUG02/E-098.C-0421A-2016-2016-08-01",
@@ -1223,6 +1242,7 @@ def make_218_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                       )
 
 
+@staged
 def make_291_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                        mergefile1='W51_291GHz_merge',
                        datasets=[
@@ -1251,6 +1271,7 @@ def make_291_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                       )
 
 
+@staged
 def make_293_mergecube(mergepath='/Volumes/passport/w51-apex/processed/merge/',
                        mergefile1='W51_293GHz_merge',
                        datasets=[
@@ -1391,6 +1412,7 @@ def compute_noise_extras(prefix=None,
     hdu1 = fits.PrimaryHDU(data=integ1, header=hdr)
     hdu1.writeto(prefix+"_noise.fits", clobber=True)
 
+@staged(kind='io')
 def signal_to_noise_mask_cube(prefix=None, cube=None, noise=None,
                               kernelsize=[2,2,2], grow=1, sigmacut=3,
                               mask_hc3n=False):
@@ -1429,13 +1451,13 @@ def signal_to_noise_mask_cube(prefix=None, cube=None, noise=None,
         raise ValueError("Must specify cube and noise if you do not "
                          "specify a prefix")
 
-    t0 = time.time()
-    smcube = cube_regrid.gsmooth_cube(cube, kernelsize, use_fft=False,
-                                      kernelsize_mult=3)
-    log.info("Completed cube smooth in %i seconds" % (time.time()-t0))
-    mask = smcube > noise*sigmacut
+    with stage('smooth_and_mask', kind='compute') as smooth:
+        smcube = cube_regrid.gsmooth_cube(cube, kernelsize, use_fft=False,
+                                          kernelsize_mult=3)
+        mask = smcube > noise*sigmacut
 
-    mask_grow = scipy.ndimage.morphology.binary_dilation(mask, iterations=grow)
+        mask_grow = scipy.ndimage.morphology.binary_dilation(mask, iterations=grow)
+    log.info("Completed cube smooth in %i seconds" % smooth.wall)
 
     cube[~mask_grow] = np.nan
     if prefix is None:
@@ -1458,6 +1480,7 @@ def do_sncube_masking_hi(prefix=None):
     signal_to_noise_mask_cube(prefix)
     integrate_slices_high(prefix+'_snmasked')
 
+@staged(kind='io')
 def extract_subcube(cubefilename, outfilename, linefreq=218.22219*u.GHz,
                     debug=False, smooth=False, vsmooth=False, naxis3=300,
                     vmin=-155*u.km/u.s, vmax=155*u.km/u.s):
@@ -1536,6 +1559,7 @@ def make_line_mask(freqarr, lines=None):
     return mask
 
 
+@staged
 def do_extract_subcubes(outdir=None, merge_prefix='APEX_H2CO_merge',
                         cubefilename=None,
                         frange=None, lines=None,
@@ -1615,6 +1639,7 @@ def do_extract_subcubes(outdir=None, merge_prefix='APEX_H2CO_merge',
 
 
 
+@staged(kind='io')
 def contsub_cube(cubefilename,):
     cube = fits.open(cubefilename+'.fits', memmap=False)
     cont = fits.getdata(cubefilename+'_continuum.fits')
@@ -1636,6 +1661,7 @@ def neighborly_masking(cube, sigma=1, roll=2):
     return mask
 
 
+@staged(kind='io')
 def baseline_cube(cubefn, mask=None, maskfn=None, mask_level=None,
                   mask_level_sigma=None, order=5,
                   outfilename=None,
@@ -1657,18 +1683,18 @@ def baseline_cube(cubefn, mask=None, maskfn=None, mask_level=None,
         elif mask_level_sigma is not None:
             mask = ((cube-cube.mean(axis=0)) >
                     (cube.std(axis=0)*mask_level_sigma))
-    t0 = time.time()
-    if polyspline == 'poly':
-        log.info("Baselining cube {0} with order {1}...".format(cubefn, order))
-        bc = baseline_cube(cube, polyorder=order, cubemask=mask)
-    elif polyspline == 'spline':
-        log.info("Baselining cube {0} with sample scale {1}...".format(cubefn,
-                                                                       splinesampling))
-        # Splines can't be pickled
-        bc = baseline_cube(cube, splineorder=order,
-                           sampling=splinesampling, cubemask=mask,
-                           numcores=1)
-    log.info("Baselining done ({0} seconds)".format(time.time()-t0))
+    with stage('baseline_fit', kind='fit', polyspline=polyspline) as blfit:
+        if polyspline == 'poly':
+            log.info("Baselining cube {0} with order {1}...".format(cubefn, order))
+            bc = baseline_cube(cube, polyorder=order, cubemask=mask)
+        elif polyspline == 'spline':
+            log.info("Baselining cube {0} with sample scale {1}...".format(cubefn,
+                                                                           splinesampling))
+            # Splines can't be pickled
+            bc = baseline_cube(cube, splineorder=order,
+                               sampling=splinesampling, cubemask=mask,
+                               numcores=1)
+    log.info("Baselining done ({0} seconds)".format(blfit.wall))
     f[0].data = bc
     if outfilename is None:
         outfilename = cubefn.replace(".fits","_bl.fits")
@@ -1797,6 +1823,7 @@ def per_scan_fourier_clean(data, scans, mask_pixels=None,
     return dsub
 
 
+@staged(kind='fit')
 def subtract_scan_linear_fit(data, scans, mask_pixels=None,
                              verbose=False, smoothing_width=10,
                              automask=False, smooth_all=False,
@@ -2007,6 +2034,7 @@ def efuncs(arr, neig=None, return_others=False, huge_limit=500):
     else:
         return efuncarr
 
+@staged(kind='fit')
 def PCA_clean(data,
               smoothing_scale=25., # should be ~200 for SEDIGISM
               timeaxis=0,
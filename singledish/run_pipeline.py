@@ -1,3 +1,6 @@
+import stage_timing
+# the summary at the end is read back from the stage log
+stage_timing.enable()
 from makemaps import (make_12CO_mergecube, make_218_mergecube,
                       make_232_mergecube, make_H2CO_mergecube,
                       make_291_mergecube, make_293_mergecube,
@@ -9,3 +12,6 @@ make_218_mergecube()
 make_291_mergecube()
 make_293_mergecube()
 make_12CO_mergecube()
+
+# where did the time go?  (compare runs with `python stage_timing.py compare`)
+stage_timing.print_summary(stage_timing.read_log(run=stage_timing.run_id))
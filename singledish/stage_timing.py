@@ -0,0 +1 @@
+../code/stage_timing.py
\ No newline at end of file
@@ -0,0 +1,345 @@
+"""
+Native LTE forward model driven by XCLASS molfit files.
+
+Replaces the external myXCLASS run in ``w51north_plot_multi.py``: the molfit
+file is parsed into components (source size, T_rot, N_tot, FWHM, v_off), the
+line parameters of each species come from a local catalog (fetched from
+Splatalogue once and stored as .npz files), and the summed multi-species
+spectrum is computed with numpy over [lines, channels] arrays for each spw.
+
+Optical depth is linear in the column, so each component's opacity profile
+is cached per unit column and keyed on (T_rot, width, v_off); each component's
+emission is cached too.  Changing one component's column therefore only
+rescales and re-exponentiates that component, and the other components are
+reused as they are.
+
+The radiative transfer follows the XCLASS "core" components: each component
+is an independent slab of excitation temperature T_rot in front of the
+continuum background ``tback``,
+
+    T(nu) = tback + sum_c eta_c [J(T_rot,c) - J(tback)] (1 - exp(-tau_c(nu)))
+
+with beam filling eta = s^2 / (s^2 + theta_beam^2).
+"""
+import os
+import re
+import numpy as np
+from astropy import units as u
+from astropy import constants
+from astropy import log
+
+ckms = constants.c.to(u.km/u.s).value
+h_cgs = constants.h.cgs.value
+k_cgs = constants.k_B.cgs.value
+c_cgs = constants.c.cgs.value
+fwhm_to_sigma = 1/np.sqrt(8*np.log(2))
+
+parameter_names = ['size', 'tex', 'column', 'width', 'voff']
+
+# XCLASS names whose Splatalogue chemical name is not simply the part
+# before the first ';'
+splatalogue_names = {'C-13-S': '13CS',
+                     'HCCCN;v7=1;': 'HC3N v7=1',
+                     'HCCCN': 'HC3N',
+                     'HC(O)NH2': 'NH2CHO',
+                    }
+
+
+def parse_molfit(filename):
+    """
+    Read an XCLASS molfit file.
+
+    Each species line ("NAME;v=0; ncomp") is followed by ``ncomp`` component
+    lines of five ``flag lower upper value`` groups (source size, T_rot, N_tot,
+    V_width, V_off) and a core/envelope flag.  Lines starting with '%' are
+    comments.
+
+    Returns
+    -------
+    components : list
+        One dict per component with the species name, the five parameter
+        values, their fit flags and limits, and the core/envelope flag
+    """
+    components = []
+    with open(filename, 'r') as fh:
+        lines = [line.strip() for line in fh
+                 if line.strip() and not line.strip().startswith('%')]
+
+    ii = 0
+    while ii < len(lines):
+        name, ncomp = lines[ii].rsplit(None, 1)
+        for line in lines[ii+1:ii+1+int(ncomp)]:
+            tokens = line.split()
+            groups = [tokens[jj:jj+4] for jj in range(0, 20, 4)]
+            component = {'species': name,
+                         'cfflag': tokens[20] if len(tokens) > 20 else 'c',
+                         'fit': {}, 'limits': {}}
+            for pname, (flag, lower, upper, value) in zip(parameter_names,
+                                                          groups):
+                component[pname] = float(value)
+                component['fit'][pname] = flag == 'y'
+                component['limits'][pname] = (float(lower), float(upper))
+            components.append(component)
+        ii += int(ncomp) + 1
+
+    return components
+
+
+def catalog_name(species):
+    """
+    Splatalogue chemical name of an XCLASS species name, e.g.
+    'CH3OH;v=0;' -> 'CH3OH' and 'HC(O)NH2;v=0;#1' -> 'NH2CHO'
+    """
+    species = re.sub('#[0-9]+$', '', species)
+    if species in splatalogue_names:
+        return splatalogue_names[species]
+    base = species.split(';')[0]
+    return splatalogue_names.get(base, base)
+
+
+def jnu(frequency, temperature):
+    """
+    Radiation temperature J_nu(T) in K (frequency in Hz)
+    """
+    hnuk = h_cgs * frequency / k_cgs
+    return hnuk / np.expm1(hnuk / temperature)
+
+
+def velocity_extent(components, vlsr=0.0, nsigma=6):
+    """
+    The largest velocity (km/s) by which any component shifts or broadens a
+    line: |v_off + vlsr| plus ``nsigma`` line widths.  A `LineCatalog` needs
+    at least this ``vmax`` to include every line that reaches the band.
+    """
+    return max(abs(comp['voff'] + vlsr) + nsigma*comp['width']*fwhm_to_sigma
+               for comp in components)
+
+
+class LineCatalog(object):
+    """
+    Local per-species line catalog.
+
+    Each species is stored in ``directory/<name>_<range>.npz`` with the line
+    frequencies (GHz), log10 Einstein A, upper-state degeneracies and upper
+    energies (K) in the catalog range, plus all SLAIM levels (degeneracy,
+    E_U) for the partition function.  Missing species are fetched from
+    Splatalogue once.
+
+    The catalog range is [nu_min, nu_max] widened by ``vmax`` (km/s), so
+    that lines Doppler-shifted into the band by up to ``vmax`` are included
+    (see `velocity_extent`).  The range is part of the file name: a catalog
+    fetched for one range is never used for another.
+    """
+    def __init__(self, directory='linecat', nu_min=216*u.GHz, nu_max=235*u.GHz,
+                 energy_max=2500, vmax=0.0):
+        self.directory = directory
+        self.vmax = u.Quantity(vmax, u.km/u.s).value
+        # rest frequencies observed in [nu_min, nu_max] at |v| <= vmax
+        self.nu_min = u.Quantity(nu_min, u.GHz) / (1 + self.vmax/ckms)
+        self.nu_max = u.Quantity(nu_max, u.GHz) / (1 - self.vmax/ckms)
+        self.energy_max = energy_max
+        self._species = {}
+
+    def filename(self, name):
+        frange = "{0:.4f}-{1:.4f}GHz_Emax{2:g}".format(self.nu_min.value,
+                                                       self.nu_max.value,
+                                                       self.energy_max)
+        return os.path.join(self.directory,
+                            re.sub('[^A-Za-z0-9_+-]', '_', name) + '_' +
+                            frange + '.npz')
+
+    def fetch(self, name):
+        from astroquery.splatalogue import Splatalogue
+        Splatalogue.LINES_LIMIT = 100000
+        linecat = Splatalogue.query_lines(self.nu_min, self.nu_max,
+                                          chemical_name=name,
+                                          energy_max=self.energy_max,
+                                          energy_type='eu_k',
+                                          line_lists=['SLAIM'],
+                                          show_upper_degeneracy=True)
+        levels = Splatalogue.query_lines(1*u.Hz, 10000*u.GHz,
+                                         chemical_name=name,
+                                         energy_max=self.energy_max,
+                                         energy_type='eu_k',
+                                         line_lists=['SLAIM'],
+                                         show_upper_degeneracy=True)
+        entry = {'freq': np.array(linecat['Freq-GHz'], dtype='float'),
+                 'aij': np.array(linecat['Log<sub>10</sub> (A<sub>ij</sub>)'],
+                                 dtype='float'),
+                 'deg': np.array(linecat['Upper State Degeneracy'],
+                                 dtype='float'),
+                 'eu': np.array(linecat['E_U (K)'], dtype='float'),
+                 'all_deg': np.array(levels['Upper State Degeneracy'],
+                                     dtype='float'),
+                 'all_eu': np.array(levels['E_U (K)'], dtype='float'),
+                }
+        # drop entries that cannot be used in the LTE opacity
+        ok = ((entry['freq'] > 0) & np.isfinite(entry['aij']) &
+              (entry['deg'] > 0))
+        for key in ('freq', 'aij', 'deg', 'eu'):
+            entry[key] = entry[key][ok]
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        np.savez(self.filename(name), **entry)
+        return entry
+
+    def species(self, name):
+        if name not in self._species:
+            fn = self.filename(name)
+            if os.path.exists(fn):
+                entry = dict(np.load(fn))
+            else:
+                log.info("Fetching {0} from Splatalogue".format(name))
+                entry = self.fetch(name)
+            self._species[name] = entry
+        return self._species[name]
+
+    def partition_function(self, name, tex):
+        """
+        Approximate Q_rot from the SLAIM levels (as in
+        `generic_lte_molecule_model.LTEModel`)
+        """
+        entry = self.species(name)
+        return (entry['all_deg'] * np.exp(-entry['all_eu']/tex)).sum()
+
+
+class MolfitModel(object):
+    """
+    Parameters
+    ----------
+    components : list or str
+        Components from `parse_molfit`, or the molfit file name
+    frequencies : list
+        Frequency axes (GHz) of the spectral windows
+    catalog : `LineCatalog`
+        The local line catalog.  By default, one covering the spws with the
+        `velocity_extent` of the components
+    beam_size : float
+        Synthesized beam size (arcsec) for the beam filling factor
+    tback : float or list
+        Continuum background temperature (K), per spw if a list
+    vlsr : float
+        Velocity (km/s) added to every component's v_off
+    nsigma : float
+        Lines are evaluated only within ``nsigma`` widths of their center
+    """
+    def __init__(self, components, frequencies, catalog=None, beam_size=0.42,
+                 tback=0.0, vlsr=0.0, nsigma=6):
+        if not isinstance(components, list):
+            components = parse_molfit(components)
+        self.components = components
+        self.frequencies = [np.asarray(ff, dtype='float') for ff in frequencies]
+        if catalog is None:
+            catalog = LineCatalog(nu_min=min(ff.min() for ff in self.frequencies)*u.GHz,
+                                  nu_max=max(ff.max() for ff in self.frequencies)*u.GHz,
+                                  vmax=velocity_extent(components, vlsr=vlsr,
+                                                       nsigma=nsigma))
+        self.catalog = catalog
+        self.beam_size = beam_size
+        self.tback = np.broadcast_to(tback, len(self.frequencies)).astype('float')
+        self.vlsr = vlsr
+        self.nsigma = nsigma
+        self._unit_tau = {}
+        self._emission = {}
+        self._warned = set()
+
+    def set_parameters(self, index, **kwargs):
+        """
+        Change parameters (size, tex, column, width, voff) of one component;
+        only that component is recomputed in the next `spectrum` call
+        """
+        for key, value in kwargs.items():
+            if key not in parameter_names:
+                raise KeyError("Unknown parameter {0}".format(key))
+            self.components[index][key] = float(value)
+
+    def unit_tau(self, index, spw):
+        """
+        Opacity profile of component ``index`` in ``spw`` for a column of
+        1 cm^-2
+        """
+        comp = self.components[index]
+        key = (comp['tex'], comp['width'], comp['voff'])
+        cached = self._unit_tau.get((index, spw))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        name = catalog_name(comp['species'])
+        entry = self.catalog.species(name)
+        freq = self.frequencies[spw]
+        tex = comp['tex']
+        shift = 1 - (comp['voff'] + self.vlsr)/ckms
+        sigma_v = comp['width'] * fwhm_to_sigma
+
+        if (abs(comp['voff'] + self.vlsr) + self.nsigma*sigma_v >
+                self.catalog.vmax and index not in self._warned):
+            self._warned.add(index)
+            log.warning("{0} is shifted beyond the catalog's vmax={1} km/s; "
+                        "lines shifted into the band from outside the catalog "
+                        "range are missing".format(comp['species'],
+                                                   self.catalog.vmax))
+
+        # only the lines that can reach the band
+        fmin, fmax = freq.min(), freq.max()
+        pad = self.nsigma * sigma_v / ckms * fmax
+        nu0 = entry['freq']
+        inband = (nu0*shift > fmin - pad) & (nu0*shift < fmax + pad)
+        nu0 = nu0[inband]
+        aul = 10**entry['aij'][inband]
+        gu = entry['deg'][inband]
+        eu = entry['eu'][inband]
+
+        tau = np.zeros_like(freq)
+        if len(nu0) > 0:
+            qrot = self.catalog.partition_function(name, tex)
+            nu_hz = nu0 * 1e9
+            # integrated opacity per unit column [Hz]
+            tau_int = (c_cgs**2 / (8*np.pi*nu_hz**2) * aul * gu / qrot *
+                       np.exp(-eu/tex) * np.expm1(h_cgs*nu_hz/(k_cgs*tex)))
+            fcen = nu0 * shift
+            sigma_nu = sigma_v / ckms * nu0
+            # [nlines, nchan] Gaussian profiles normalized in frequency
+            # (GHz -> Hz for the normalization)
+            profile = (np.exp(-(freq[None,:] - fcen[:,None])**2 /
+                              (2*sigma_nu[:,None]**2)) /
+                       ((2*np.pi)**0.5 * sigma_nu[:,None] * 1e9))
+            tau = (tau_int[:,None] * profile).sum(axis=0)
+
+        self._unit_tau[(index, spw)] = (key, tau)
+        return tau
+
+    def component_spectrum(self, index, spw):
+        """
+        Emission of one component above the background in ``spw`` (K)
+        """
+        comp = self.components[index]
+        key = tuple(comp[pname] for pname in parameter_names) + (self.tback[spw],)
+        cached = self._emission.get((index, spw))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        freq_hz = self.frequencies[spw] * 1e9
+        eta = comp['size']**2 / (comp['size']**2 + self.beam_size**2)
+        tau = self.unit_tau(index, spw) * comp['column']
+        emission = (eta * (jnu(freq_hz, comp['tex']) -
+                           jnu(freq_hz, max(self.tback[spw], 1e-3))) *
+                    -np.expm1(-tau))
+
+        self._emission[(index, spw)] = (key, emission)
+        return emission
+
+    def spectrum(self, spw, species=None):
+        """
+        The summed model spectrum (K, including the background) in ``spw``.
+        If ``species`` is given, only the components of those species are
+        included.
+        """
+        model = np.full_like(self.frequencies[spw], self.tback[spw])
+        for index, comp in enumerate(self.components):
+            if species is not None and comp['species'] not in species:
+                continue
+            model = model + self.component_spectrum(index, spw)
+        return model
+
+    def spectra(self):
+        return [self.spectrum(spw) for spw in range(len(self.frequencies))]
@@ -9,8 +9,11 @@ import matplotlib.pyplot as plt
 import numpy as np
 from scipy.constants import codata
 from astropy.io import fits
+from astropy import units as u
 from astropy.wcs import WCS
 
+from molfit_model import MolfitModel, LineCatalog, parse_molfit, velocity_extent
+
 plt.close()
 
 ################################################################
@@ -60,7 +63,6 @@ MolfitsFileBaseNames = ["w51north"]
 #colors = ["MediumBlue", "DarkRed", "DeepSkyBlue", "MediumVioletRed", "SpringGreen", "DarkViolet","DarkGreen", "Lime", "Chocolate", "SaddleBrown", "DodgerBlue", "DeepPink", "MediumVioletRed", "Teal", "MidnightBlue",  "LimeGreen", "OrangeRed", "ForestGreen", "Goldenrod", "Navy", "Purple", "Maroon", "DarkOrange", "Yellow", "Fuchsia", "Indigo", "GreenYellow", "Aqua", "SaddleBrown", "SlateBlue", "DarkGoldenrod", "HotPink"]
 colors = ["Red"]
 
-NumberProcessors = 20
 NumHeaderLines = 0
 NumLegendColumns = 4
 
@@ -88,6 +90,27 @@ ny = len(chunks)
 
 fig = plt.figure(figsize=(nx * 24, ny * 5), dpi=160)
 
+#
+# frequency axes (GHz) of the observed spectra, shared by the models
+
+spw_frequencies = []
+for c, chunk in enumerate(chunks):
+    f = fits.open("spectra/north_spw%s_mean.fits" % c)
+    w = WCS(f[0].header)
+    spw_frequencies.append(w.wcs_pix2world(np.arange(f[0].data.size), 0)[0] / 1.e9)
+
+#
+# the catalog range is widened by the largest velocity shift of any component,
+# so lines shifted into the band are included
+
+vmax = max(velocity_extent(parse_molfit("%s.molfit" % MolfitsFileBaseName), vlsr=vLSR)
+           for MolfitsFileBaseName in MolfitsFileBaseNames)
+catalog = LineCatalog(directory="linecat",
+                      nu_min=min(FreqsMin) / 1000. * u.GHz,
+                      nu_max=max(FreqsMax) / 1000. * u.GHz,
+                      vmax=vmax)
+models = {}
+
 #
 # generate plot
 
@@ -136,23 +159,27 @@ for c, chunk in enumerate(chunks):
     ax1.plot(dfreq, data, color='Gray', drawstyle = 'steps-mid', label="Data", lw=2)
 
     #
-    # run XCLASS if wanted
+    # evaluate the molfit models (the line catalog and per-component
+    # opacities are cached, so only changed components are recomputed)
     #
 
     for m, MolfitsFileBaseName in enumerate(MolfitsFileBaseNames):
 
           MolfitsFileName = "%s.molfit" % MolfitsFileBaseName
 
-          modeldata, log, TransEnergies, IntOptical, jobDir = myXCLASS()
+          if MolfitsFileName not in models:
+                models[MolfitsFileName] = MolfitModel(parse_molfit(MolfitsFileName),
+                                                      frequencies=spw_frequencies,
+                                                      catalog=catalog,
+                                                      beam_size=TelescopeSize,
+                                                      tback=tBacks, vlsr=vLSR)
+          fit = models[MolfitsFileName].spectrum(c)
 
           #
           # plot output
           #
 
-          freq = modeldata[:,0] / 1000.
-          mvel = modeldata[:,1]
-          fit = modeldata[:,2]
-          ax1.plot(freq, fit, color=colors[m], alpha=0.7, label=MolfitsFileBaseName, lw=2)
+          ax1.plot(spw_frequencies[c], fit, color=colors[m], alpha=0.7, label=MolfitsFileBaseName, lw=2)
 
     ax1.set_xlim(xLowerLimit,xUpperLimit)
     ax1.set_ylim(yLowerLimit,yUpperLimit)